@@ -8,7 +8,8 @@ from django.http import HttpResponseRedirect
 from pki.models import CertificateAuthority, Certificate, x509Extension
 from pki.forms import CertificateAuthorityForm, CertificateForm, x509ExtensionForm
 from pki.views import admin_delete, admin_history
-from pki.settings import PKI_DIR, PKI_LOG, PKI_LOGLEVEL, JQUERY_URL
+from pki.settings import PKI_DIR, PKI_LOG, PKI_LOGLEVEL, JQUERY_URL, PKI_ENABLE_EMAIL
+from pki.email import queue_certificate_emails, subtree_objects
 
 ##------------------------------------------------------------------##
 ## Create PKI_DIR if it's missing
@@ -48,6 +49,30 @@ logger.addHandler(l_hdlr)
 ## Disable delete_selected
 admin.site.disable_action('delete_selected')
 
+##---------------------------------##
+## Admin actions
+##---------------------------------##
+
+def queue_emails(request, objs):
+    """Queue the certificate data emails of objs and report the result"""
+    
+    if PKI_ENABLE_EMAIL is not True:
+        messages.warning(request, "Email delivery is disabled unless setting PKI_ENABLE_EMAIL is set to True")
+        return
+    
+    queued, skipped = queue_certificate_emails(objs, request.user)
+    messages.info(request, "%d emails were queued for delivery. %d revoked objects or objects without email address were skipped" % (queued, skipped))
+
+def email_selected(modeladmin, request, queryset):
+    queue_emails(request, queryset)
+
+email_selected.short_description = "Email certificate data of selected objects"
+
+def email_subtree(modeladmin, request, queryset):
+    queue_emails(request, subtree_objects(queryset))
+
+email_subtree.short_description = "Email certificate data of selected CA's, all CA's below and their certificates"
+
 class CertificateBaseAdmin(admin.ModelAdmin):
     """Base class for Certificate* Admin models"""
     
@@ -55,6 +80,10 @@ class CertificateBaseAdmin(admin.ModelAdmin):
     actions       = []
     list_per_page = 25
     
+    ## Related objects are fetched by queryset(). list_select_related=True would do a plain
+    ## select_related() that skips the nullable parent and extension foreign keys
+    list_select_related = False
+    
     class Media:
         js  = ( JQUERY_URL, 'pki/js/jquery.tipsy.js', 'pki/js/pki_admin.min.js', )
         css = { 'screen': ( 'pki/css/pki.css', 'pki/css/tipsy.css', ), }
@@ -68,6 +97,7 @@ class CertificateBaseAdmin(admin.ModelAdmin):
 class Certificate_Authority_Admin(CertificateBaseAdmin):
     """CertificateAuthority admin definition"""
     
+    actions            = [ email_selected, email_subtree, ]
     form               = CertificateAuthorityForm
     list_display       = ( 'id', 'common_name', 'Serial_align_right', 'Valid_center', 'Chain_link', 'Tree_link', 'Parent_link',
                            'Expiry_date', 'Description', 'Creation_date', 'Revocation_date', 'Child_certs', 'Download_link', 'Email_link', )
@@ -107,6 +137,9 @@ class Certificate_Authority_Admin(CertificateBaseAdmin):
     def history_view(self, request, object_id, extra_context=None):
         return admin_history(request, self.model._meta.module_name, object_id)
     
+    def queryset(self, request):
+        return super(Certificate_Authority_Admin, self).queryset(request).for_changelist()
+    
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         """Filter foreign key parent field.
         
@@ -126,6 +159,7 @@ admin.site.register(CertificateAuthority, Certificate_Authority_Admin)
 
 class Certificate_Admin(CertificateBaseAdmin):
     """CertificateAuthority admin definition"""
+    actions            = [ email_selected, ]
     form               = CertificateForm
     list_display       = ( 'id', 'common_name', 'Serial_align_right', 'Valid_center', 'Chain_link', 'Parent_link',
                            'Expiry_date', 'Description', 'Creation_date', 'Revocation_date', 'Download_link', 'Email_link' )
@@ -172,6 +206,9 @@ class Certificate_Admin(CertificateBaseAdmin):
     def history_view(self, request, object_id, extra_context=None):
         return admin_history(request, self.model._meta.module_name, object_id)
     
+    def queryset(self, request):
+        return super(Certificate_Admin, self).queryset(request).for_changelist()
+    
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         """Filter foreign key parent field.
         
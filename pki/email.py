@@ -1,19 +1,23 @@
-import os
+import time
+import Queue
+import datetime
 import logging
+import threading
 
-from pki.settings import PKI_ENABLE_EMAIL
+from pki.settings import PKI_ENABLE_EMAIL, PKI_EMAIL_MAX_ATTEMPTS, PKI_EMAIL_RETRY_DELAY, PKI_EMAIL_WORKERS, PKI_EMAIL_BATCH_SIZE, \
+                         PKI_EMAIL_LEASE
 
 if PKI_ENABLE_EMAIL is True:
     try:
-        from django.core.mail import EmailMessage
         import zipfile
     except ImportError, e:
         raise Exception( "Library import failed. Disable PKI_ENABLE_EMAIL or install/update the missing Python lib: %s" % e )
 
-from django.shortcuts import get_object_or_404
+from django.core.mail import EmailMessage, get_connection
+from django.contrib.contenttypes.models import ContentType
 
-from pki.models import Certificate, CertificateAuthority
-from pki.helper import files_for_object, subject_for_object, build_zip_for_object
+from pki.models import Certificate, CertificateAuthority, PkiEmail, changelog_model_id, bulk_insert
+from pki.helper import files_for_object, subject_for_object, build_zip_for_object, subtree_for_ca
 
 logger = logging.getLogger("pki")
 
@@ -21,37 +25,282 @@ logger = logging.getLogger("pki")
 ## Email functions
 ##------------------------------------------------------------------##
 
+def build_certificate_email(obj, connection=None, recipient=None):
+    """Return the EmailMessage with the zipped certificate data of obj for recipient (default: obj.email)"""
+    
+    zip_f = build_zip_for_object(obj, None)
+    
+    ## Read ZIP content. Closing releases the spooled file
+    try:
+        x = zip_f.read()
+    finally:
+        zip_f.close()
+    
+    ## Build email obj
+    parent_name = 'self-signed'
+    if obj.parent:
+        parent_name = obj.parent.common_name
+    
+    subj_msg = subject_for_object(obj)
+    body_msg = "Certificate data sent by django-pki:\n\n  * subject: %s\n  * parent: %s\n" % (subj_msg, parent_name)
+    
+    email = EmailMessage( to=[recipient or obj.email,], subject="Certificate data for \"%s\"" % subj_msg, body=body_msg, connection=connection, )
+    email.attach( 'PKI_DATA_%s.zip' % obj.name, x, 'application/zip' )
+    
+    return email
+
 def SendCertificateData(obj, request):
-    """Send the zipped certificate data as email.
+    """Queue the zipped certificate data for delivery as email.
     
-    Verify that the given object has all the flags set, create a zipfile and mail it to the
-    email address from the certificate.
+    The email is sent to the email address from the certificate by the delivery
+    worker ("manage.py pki_email", see deliver_queued_emails). Returns the PkiEmail.
     """
     
     ## Check that email flag is set in the DB
     if obj.email:
-        zip_f = build_zip_for_object(obj, request)
+        user = getattr(request, 'user', None)
         
-        ## Read ZIP content and remove it
-        try:
-            if os.path.exists(zip_f):
-                f = open(zip_f)
-                x = f.read()
-                f.close()
-                
-                os.remove(zip_f)
-        except OSError,e:
-            logger.error( "Failed to read zipfile: %s" % e)
-            raise Exception( e )
+        if user is not None and not user.is_authenticated():
+            user = None
         
-        ## Build email obj and send it out
-        parent_name = 'self-signed'
-        if obj.parent:
-            parent_name = obj.parent.common_name
+        return PkiEmail.objects.create(model_id=changelog_model_id(obj), object_id=obj.pk, recipient=obj.email, user=user)
+
+def queue_certificate_emails(objs, user=None):
+    """Queue the certificate data of many objects. Returns the number of (queued, skipped) objects.
+    
+    Revoked objects and objects without email address are skipped. The emails are inserted
+    with one executemany() per PKI_EMAIL_BATCH_SIZE objects (see models.bulk_insert).
+    """
+    
+    items   = []
+    skipped = 0
+    
+    for obj in objs:
+        if obj.active and obj.email:
+            items.append(PkiEmail(model_id=changelog_model_id(obj), object_id=obj.pk, recipient=obj.email, user=user))
+        else:
+            skipped += 1
+    
+    bulk_insert(PkiEmail, items, PKI_EMAIL_BATCH_SIZE)
+    
+    logger.info( "Queued %d emails, skipped %d objects" % (len(items), skipped) )
+    
+    return (len(items), skipped)
+
+def subtree_objects(cas):
+    """Return the given CA's, all CA's below them and their certificates (each object once)"""
+    
+    result = []
+    seen   = set()
+    
+    for ca in cas:
+        sub_cas, certs = subtree_for_ca(ca)
         
-        subj_msg = subject_for_object(obj)
-        body_msg = "Certificate data sent by django-pki:\n\n  * subject: %s\n  * parent: %s\n" % (subj_msg, parent_name)
+        for obj in sub_cas + certs:
+            if (obj.__class__, obj.pk) not in seen:
+                seen.add( (obj.__class__, obj.pk) )
+                result.append(obj)
+    
+    return result
+
+##------------------------------------------------------------------##
+## Delivery worker
+##------------------------------------------------------------------##
+
+def retry_delay(attempts):
+    """Return the timedelta until the next delivery attempt after attempts failed ones"""
+    
+    return datetime.timedelta(seconds=PKI_EMAIL_RETRY_DELAY * 2 ** max(attempts - 1, 0))
+
+def objects_for_emails(items):
+    """Return the objects of the PkiEmail items as {(model_id, object_id): obj}. One query per model"""
+    
+    ids = {}
+    for item in items:
+        ids.setdefault(item.model_id, []).append(item.object_id)
+    
+    objects = {}
+    for model_id, object_ids in ids.items():
+        model = ContentType.objects.get_for_id(model_id).model_class()
         
-        email = EmailMessage( to=[obj.email,], subject="Certificate data for \"%s\"" % subj_msg, body=body_msg,  )
-        email.attach( 'PKI_DATA_%s.zip' % obj.name, x, 'application/zip' )
-        email.send(fail_silently=False)
+        for obj in model.objects.filter(pk__in=object_ids).select_related('parent'):
+            objects[(model_id, obj.pk)] = obj
+    
+    return objects
+
+def build_messages(jobs_list, connection, workers=None):
+    """Build the emails for a list of (obj, recipient) tuples with up to PKI_EMAIL_WORKERS threads.
+    
+    Returns a list of (message, error) tuples in the same order. obj.parent has to be
+    loaded, the threads don't access the database.
+    """
+    
+    results = [None] * len(jobs_list)
+    jobs    = Queue.Queue()
+    
+    for job in enumerate(jobs_list):
+        jobs.put(job)
+    
+    def work():
+        while True:
+            try:
+                i, (obj, recipient) = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            
+            try:
+                results[i] = (build_certificate_email(obj, connection, recipient), None)
+            except Exception, e:
+                results[i] = (None, e)
+    
+    threads = [threading.Thread(target=work) for n in range(min(workers or PKI_EMAIL_WORKERS, len(jobs_list)))]
+    
+    for t in threads:
+        t.start()
+    
+    for t in threads:
+        t.join()
+    
+    return results
+
+def email_sent(item):
+    """Record a successful delivery"""
+    
+    item.attempts += 1
+    item.status    = 'sent'
+    item.sent      = datetime.datetime.now()
+    item.save()
+
+def email_failed(item, error, permanent=False):
+    """Record a failed delivery attempt.
+    
+    The item is queued again for a retry or marked as failed when permanent is set
+    or PKI_EMAIL_MAX_ATTEMPTS is reached.
+    """
+    
+    item.attempts  += 1
+    item.last_error = str(error)
+    
+    if permanent or item.attempts >= PKI_EMAIL_MAX_ATTEMPTS:
+        item.status = 'failed'
+        logger.error( "Email %d to %s failed: %s" % (item.pk, item.recipient, error) )
+    else:
+        item.status       = 'queued'
+        item.next_attempt = datetime.datetime.now() + retry_delay(item.attempts)
+        logger.warning( "Email %d to %s failed (attempt %d): %s" % (item.pk, item.recipient, item.attempts, error) )
+    
+    item.save()
+
+def claim_email(item, now=None):
+    """Mark the due item as being sent for PKI_EMAIL_LEASE seconds.
+    
+    Due are queued items and items whose lease expired (the claiming worker died).
+    Returns False if another worker claimed it first.
+    """
+    
+    now   = now or datetime.datetime.now()
+    lease = now + datetime.timedelta(seconds=PKI_EMAIL_LEASE)
+    
+    if PkiEmail.objects.filter(pk=item.pk, status__in=('queued', 'sending'), next_attempt__lte=now).update(status='sending', next_attempt=lease):
+        if item.status == 'sending':
+            logger.warning( "Lease of email %d to %s expired, sending it again" % (item.pk, item.recipient) )
+        
+        item.status       = 'sending'
+        item.next_attempt = lease
+        return True
+    
+    return False
+
+def deliver_queued_emails(limit=None, connection=None):
+    """Send the queued emails that are due over one SMTP connection.
+    
+    Every email is claimed with a conditional UPDATE before it is built, so parallel
+    workers never send the same email. The claim is a lease of PKI_EMAIL_LEASE seconds,
+    emails of a worker that died are sent by a later run. The zips of PKI_EMAIL_BATCH_SIZE emails are
+    built in parallel (see build_messages), then the batch is sent. Failed deliveries
+    are retried with exponential backoff (PKI_EMAIL_RETRY_DELAY) and marked as failed
+    after PKI_EMAIL_MAX_ATTEMPTS. Emails go to the recipient stored when they were queued.
+    Emails of deleted or revoked objects and emails without recipient fail right away.
+    Returns the number of sent emails.
+    """
+    
+    now = datetime.datetime.now()
+    due = PkiEmail.objects.filter(status__in=('queued', 'sending'), next_attempt__lte=now).order_by('next_attempt', 'pk')
+    
+    if limit:
+        due = due[:limit]
+    
+    due = list(due)
+    
+    if not due:
+        return 0
+    
+    objects    = objects_for_emails(due)
+    connection = connection or get_connection()
+    sent       = 0
+    claimed    = set()
+    
+    try:
+        connection.open()
+        
+        for i in range(0, len(due), PKI_EMAIL_BATCH_SIZE):
+            batch = []
+            
+            for item in due[i:i+PKI_EMAIL_BATCH_SIZE]:
+                if not claim_email(item, now):
+                    continue
+                
+                claimed.add(item.pk)
+                obj = objects.get( (item.model_id, item.object_id) )
+                
+                ## These can't change by retrying
+                if obj is None:
+                    email_failed(item, "Object was deleted", permanent=True)
+                    claimed.discard(item.pk)
+                elif not obj.active or not item.recipient:
+                    email_failed(item, "%s is revoked or the email has no recipient" % obj.name, permanent=True)
+                    claimed.discard(item.pk)
+                else:
+                    batch.append( (item, obj) )
+            
+            messages = build_messages([(obj, item.recipient) for item, obj in batch], connection)
+            
+            for (item, obj), (message, error) in zip(batch, messages):
+                if error is not None:
+                    email_failed(item, error)
+                    claimed.discard(item.pk)
+                    continue
+                
+                try:
+                    message.send(fail_silently=False)
+                except Exception, e:
+                    email_failed(item, e)
+                    claimed.discard(item.pk)
+                    
+                    ## The connection may be broken. Reconnect for the next message, the rest waits for the next run if that fails
+                    connection.close()
+                    connection.open()
+                else:
+                    email_sent(item)
+                    claimed.discard(item.pk)
+                    sent += 1
+    except Exception, e:
+        logger.exception( "Email delivery stopped, the remaining emails stay queued: %s" % e )
+    finally:
+        try:
+            ## Release the claimed emails that were not handled
+            if claimed:
+                PkiEmail.objects.filter(pk__in=list(claimed), status='sending').update(status='queued', next_attempt=datetime.datetime.now())
+        finally:
+            connection.close()
+    
+    logger.info( "Delivered %d of %d queued emails" % (sent, len(due)) )
+    
+    return sent
+
+def run_delivery_worker(interval=10, limit=None):
+    """Deliver queued emails every interval seconds until interrupted"""
+    
+    while True:
+        deliver_queued_emails(limit)
+        time.sleep(interval)
@@ -0,0 +1,390 @@
+"""In-process OpenSSL engine for django-pki.
+
+Enable it with PKI_OPENSSL_ENGINE = 'pki.engine.PyOpenssl'. Key, request and certificate
+handling is done with pyOpenSSL, operations that are not implemented here (revoke, CRL
+generation) fall back to the openssl binary.
+"""
+
+import os
+import random
+import datetime
+from logging import getLogger
+
+try:
+    from OpenSSL import crypto
+except ImportError, e:
+    raise Exception( "Failed to import pyOpenSSL. Set PKI_OPENSSL_ENGINE to pki.openssl.Openssl or install pyOpenSSL: %s" % e )
+
+from pki.openssl import Openssl, CertificateInfo, CALock, format_serial, forget_certificate, file_stamp, signing_session
+from pki.settings import PKI_DIR, PKI_SELF_SIGNED_SERIAL
+
+logger = getLogger("pki")
+
+## Message digest. Has to match default_md in openssl.conf.in
+DIGEST = 'sha1'
+
+##------------------------------------------------------------------##
+## Helper functions
+##------------------------------------------------------------------##
+
+def read_file(path):
+    """Return the content of path"""
+    
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    
+    return data
+
+def write_file(path, data):
+    """Write data to path"""
+    
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+def load_certificate(path):
+    """Load a PEM encoded certificate"""
+    
+    return crypto.load_certificate(crypto.FILETYPE_PEM, read_file(path))
+
+def load_privatekey(path, passphrase):
+    """Load a PEM encoded private key.
+    
+    A passphrase is always passed to prevent openssl from prompting on the terminal.
+    """
+    
+    return crypto.load_privatekey(crypto.FILETYPE_PEM, read_file(path), str(passphrase or ''))
+
+def index_time(asn1_time):
+    """Return the ASN.1 time of a certificate the way openssl writes it to index.txt.
+    
+    The time is kept as stored in the certificate: UTCTime (YYMMDDHHMMSSZ) until 2049,
+    GeneralizedTime (YYYYMMDDHHMMSSZ) from 2050 on. GeneralizedTime of earlier years
+    is shortened to UTCTime like openssl does.
+    """
+    
+    if len(asn1_time) == 15 and 1950 <= int(asn1_time[:4]) < 2050:
+        return asn1_time[2:]
+    
+    return asn1_time
+
+def hex_serial(serial):
+    """Return serial as uppercase hex string with even length (openssl style)"""
+    
+    h = '%X' % serial
+    
+    if len(h) % 2 == 1:
+        h = '0' + h
+    
+    return h
+
+##------------------------------------------------------------------##
+## Engine
+##------------------------------------------------------------------##
+
+class PyOpenssl(Openssl):
+    """pyOpenSSL based engine.
+    
+    Drop-in replacement for Openssl that avoids forking the openssl binary
+    for key, CSR and certificate operations.
+    """
+    
+    def set_subject(self, name):
+        """Fill a X509Name with the subject of the instance (same order as subject_for_object)"""
+        
+        name.CN = self.i.common_name
+        name.C  = self.i.country
+        name.ST = self.i.state
+        name.L  = self.i.locality
+        name.O  = self.i.organization
+        
+        if self.i.OU:
+            name.OU = self.i.OU
+        
+        if self.i.email:
+            name.emailAddress = self.i.email
+    
+    def add_extensions(self, cert, issuer):
+        """Add the x509 extensions of the instance to cert.
+        
+        Extensions are added one by one as authorityKeyIdentifier of a self-signed
+        certificate requires the subjectKeyIdentifier to be present.
+        """
+        
+        x509 = self.i.extension
+        
+        ext = [ ('basicConstraints', '%s%s' % (x509.basic_constraints_critical and 'critical,' or '', x509.basic_constraints)),
+                ('keyUsage', x509.key_usage_csv()),
+                ('subjectKeyIdentifier', x509.subject_key_identifier),
+                ('authorityKeyIdentifier', x509.authority_key_identifier),
+              ]
+        
+        if x509.ext_key_usage_csv():
+            ext.append( ('extendedKeyUsage', x509.ext_key_usage_csv()) )
+        
+        if not x509.is_ca():
+            ext.append( ('subjectAltName', self.i.subjaltname) )
+        
+        if x509.crl_distribution_point:
+            ext.append( ('crlDistributionPoints', self.i.crl_dpoints) )
+        
+        for name, value in ext:
+            cert.add_extensions([crypto.X509Extension(name, False, str(value), subject=cert, issuer=issuer)])
+    
+    def generate_key(self):
+        """RSA key generation.
+        
+        Key will be encrypted with des3 if passphrase is given. A ready key from the
+        key reservoir is used when available.
+        """
+        
+        if self.use_reserved_key():
+            return
+        
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, int(self.i.key_length))
+        
+        if self.i.passphrase:
+            pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, key, 'des3', str(self.i.passphrase))
+        else:
+            pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
+        
+        write_file(self.key, pem)
+        
+        logger.debug("Finished %s bit private key generation" % self.i.key_length)
+    
+    def encrypt_key(self, key):
+        """Write the unencrypted key to self.key encrypted with des3 and the instance passphrase"""
+        
+        pkey = load_privatekey(key, None)
+        write_file(self.key, crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey, 'des3', str(self.i.passphrase)))
+    
+    def generate_self_signed_cert(self):
+        """Generate a self signed root certificate.
+        
+        Serial is set to user specified value when PKI_SELF_SIGNED_SERIAL > 0
+        """
+        
+        logger.info("Generating new self-signed certificate (CN=%s, x509 extension=%s)" % (self.i.common_name, self.i.extension))
+        
+        key  = load_privatekey(self.key, self.i.passphrase)
+        cert = crypto.X509()
+        
+        serial = random.getrandbits(64)
+        
+        try:
+            if PKI_SELF_SIGNED_SERIAL and int(PKI_SELF_SIGNED_SERIAL) > 0:
+                serial = int(PKI_SELF_SIGNED_SERIAL)
+        except ValueError, e:
+            logger.error( "Not setting inital serial number to %s. Fallback to random number" % PKI_SELF_SIGNED_SERIAL )
+            logger.error( e )
+        
+        cert.set_version(2)
+        cert.set_serial_number(serial)
+        self.set_subject(cert.get_subject())
+        cert.set_issuer(cert.get_subject())
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(int(self.i.valid_days) * 86400)
+        cert.set_pubkey(key)
+        self.add_extensions(cert, cert)
+        cert.sign(key, DIGEST)
+        
+        write_file(self.crt, crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        forget_certificate(self.crt)
+        
+        logger.info("Finished self-signed certificate creation")
+    
+    def generate_csr(self):
+        """CSR (Certificate Signing Request) generation"""
+        
+        logger.info("Generating new CSR for %s" % self.i.common_name )
+        
+        key = load_privatekey(self.key, self.i.passphrase)
+        req = crypto.X509Req()
+        
+        self.set_subject(req.get_subject())
+        req.set_pubkey(key)
+        req.sign(key, DIGEST)
+        
+        write_file(self.csr, crypto.dump_certificate_request(crypto.FILETYPE_PEM, req))
+    
+    def load_ca(self, ca_name):
+        """Return certificate and private key of the signing CA.
+        
+        Kept in the open signing session of the CA to avoid decrypting the key for every certificate.
+        """
+        
+        session = signing_session(ca_name)
+        pf      = str(self.i.parent_passphrase or '')
+        
+        if session and ('ca', pf) in session.cache:
+            return session.cache[('ca', pf)]
+        
+        ca_dir = os.path.join(PKI_DIR, ca_name)
+        ca     = ( load_certificate(os.path.join(ca_dir, 'certs', '%s.cert.pem' % ca_name)),
+                   load_privatekey(os.path.join(ca_dir, 'private', '%s.key.pem' % ca_name), pf), )
+        
+        if session:
+            session.cache[('ca', pf)] = ca
+        
+        return ca
+    
+    def valid_subjects(self, ca_name, index):
+        """Return the subjects of all valid certificates in index.txt.
+        
+        Kept in the open signing session of the CA as long as index.txt is unchanged.
+        """
+        
+        session = signing_session(ca_name)
+        stamp   = file_stamp(index)
+        
+        if session and session.cache.get('index', (None, None))[0] == stamp:
+            return session.cache['index'][1]
+        
+        subjects = set()
+        for line in read_file(index).splitlines():
+            fields = line.split('\t')
+            if fields[0] == 'V':
+                subjects.add(fields[-1])
+        
+        if session:
+            session.cache['index'] = (stamp, subjects)
+        
+        return subjects
+    
+    def sign_csr(self):
+        """Sign the CSR.
+        
+        Does the job of "openssl ca": The parent's serial and index.txt are updated and
+        the certificate is stored in the parent's certificate directory. The CA lock is
+        held while the CA database is read and written.
+        """
+        
+        ca_name = self.i.parent.name
+        
+        lock = CALock(ca_name)
+        lock.acquire()
+        
+        try:
+            self.sign_csr_locked(ca_name)
+        finally:
+            lock.release()
+    
+    def sign_csr_locked(self, ca_name):
+        """Sign the CSR. Requires the CA lock"""
+        
+        ca_dir          = os.path.join(PKI_DIR, ca_name)
+        ca_cert, ca_key = self.load_ca(ca_name)
+        req             = crypto.load_certificate_request(crypto.FILETYPE_PEM, read_file(self.csr))
+        
+        if not req.verify(req.get_pubkey()):
+            raise Exception( "Signature verification of CSR %s failed" % self.csr )
+        
+        ## policy_anything
+        subject = req.get_subject()
+        
+        for field in ('CN', 'C', 'ST', 'L', 'O'):
+            if not getattr(subject, field):
+                raise Exception( "Field %s of the CSR subject has to be supplied" % field )
+        
+        subj_line = ''.join(['/%s=%s' % (k, v) for k, v in subject.get_components()])
+        index     = os.path.join(ca_dir, 'index.txt')
+        subjects  = self.valid_subjects(ca_name, index)
+        
+        ## unique_subject = yes
+        if subj_line in subjects:
+            raise Exception( "There is already a valid certificate for %s" % subj_line )
+        
+        serial_file = os.path.join(ca_dir, 'serial')
+        serial      = int(read_file(serial_file).strip(), 16)
+        
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.set_serial_number(serial)
+        cert.set_issuer(ca_cert.get_subject())
+        cert.set_subject(subject)
+        cert.set_pubkey(req.get_pubkey())
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(int(self.i.valid_days) * 86400)
+        self.add_extensions(cert, ca_cert)
+        cert.sign(ca_key, DIGEST)
+        
+        pem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+        
+        ## Certificate copy in new_certs_dir and requested output file
+        write_file(os.path.join(ca_dir, 'certs', '%s.pem' % hex_serial(serial)), pem)
+        write_file(self.crt, pem)
+        forget_certificate(self.crt)
+        
+        ## Update database and serial the way openssl does (keep .old files)
+        expiry = index_time(cert.get_notAfter())
+        
+        for f in (index, serial_file):
+            write_file('%s.old' % f, read_file(f))
+        
+        i = open(index, 'ab')
+        i.write('V\t%s\t\t%s\tunknown\t%s\n' % (expiry, hex_serial(serial), subj_line))
+        i.close()
+        
+        write_file(serial_file, '%s\n' % hex_serial(serial + 1))
+        
+        ## Keep the session's subject cache in sync with our own modification
+        subjects.add(subj_line)
+        
+        session = signing_session(ca_name)
+        if session:
+            session.cache['index'] = (file_stamp(index), subjects)
+        
+        self.create_hash_link()
+    
+    def generate_der_encoded(self):
+        """Generate a DER encoded certificate"""
+        
+        logger.info( 'Generating DER encoded certificate for %s' % self.i.common_name )
+        
+        write_file(self.der, crypto.dump_certificate(crypto.FILETYPE_ASN1, load_certificate(self.crt)))
+    
+    def generate_pkcs12_encoded(self):
+        """Generate a PKCS12 encoded certificate"""
+        
+        p12 = crypto.PKCS12()
+        p12.set_certificate(load_certificate(self.crt))
+        p12.set_privatekey(load_privatekey(self.key, self.i.passphrase))
+        
+        write_file(self.pkcs12, p12.export(str(self.i.pkcs12_passphrase)))
+    
+    def certificate_pem(self, cert_file):
+        """Return the PEM block of the given certificate file without text dump"""
+        
+        return crypto.dump_certificate(crypto.FILETYPE_PEM, load_certificate(cert_file))
+    
+    def parse_certificate(self):
+        """Parse the certificate in-process.
+        
+        The text dump requires pyOpenSSL >= 0.15. The openssl binary is used otherwise.
+        """
+        
+        cert = load_certificate(self.crt)
+        date = lambda d: datetime.datetime.strptime(d, '%Y%m%d%H%M%SZ')
+        name = lambda n: ''.join(['/%s=%s' % (k, v) for k, v in n.get_components()])
+        
+        extensions = {}
+        for i in range(cert.get_extension_count()):
+            e = cert.get_extension(i)
+            extensions[e.get_short_name()] = (bool(e.get_critical()), str(e))
+        
+        if hasattr(crypto, 'FILETYPE_TEXT'):
+            text = crypto.dump_certificate(crypto.FILETYPE_TEXT, cert)
+        else:
+            text = Openssl.parse_certificate(self).text
+        
+        return CertificateInfo(serial=format_serial(hex_serial(cert.get_serial_number())),
+                               hash='%08x' % cert.subject_name_hash(),
+                               subject=name(cert.get_subject()),
+                               issuer=name(cert.get_issuer()),
+                               not_before=date(cert.get_notBefore()),
+                               not_after=date(cert.get_notAfter()),
+                               extensions=extensions,
+                               text=text,
+                              )
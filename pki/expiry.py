@@ -0,0 +1,131 @@
+"""Expiry monitoring.
+
+Finds active CA's and certificates that expire within a given number of days with one
+range query per model and groups them by days left (see PKI_EXPIRY_BUCKETS). The queries
+use the composite (active, expiry_date) indexes on pki_certificate and
+pki_certificateauthority created by South migration 0016. Reports can be written as JSON or CSV.
+"""
+
+import csv
+import datetime
+from logging import getLogger
+
+from django.utils import simplejson
+
+from pki.models import CertificateAuthority, Certificate
+from pki.settings import PKI_EXPIRY_BUCKETS
+
+logger = getLogger("pki")
+
+## Columns of a report entry (CSV column order)
+REPORT_FIELDS = ( 'type', 'id', 'name', 'common_name', 'serial', 'parent', 'expiry_date', 'days_left', 'bucket', )
+
+## Models to scan and their report type
+SCANNED_MODELS = ( ('ca', CertificateAuthority), ('certificate', Certificate), )
+
+##------------------------------------------------------------------##
+## Scanner
+##------------------------------------------------------------------##
+
+def bucket_names(buckets):
+    """Return the bucket names for the given upper limits (days), e.g. (7, 30) => expired, 0-7, 8-30"""
+    
+    names = ['expired']
+    lower = 0
+    
+    for upper in buckets:
+        names.append('%d-%d' % (lower, upper))
+        lower = upper + 1
+    
+    return names
+
+def bucket_for(days_left, buckets):
+    """Return the bucket name for days_left"""
+    
+    if days_left < 0:
+        return 'expired'
+    
+    lower = 0
+    for upper in buckets:
+        if days_left <= upper:
+            return '%d-%d' % (lower, upper)
+        lower = upper + 1
+    
+    return None
+
+class ExpiryReport(object):
+    """Result of scan_expiry.
+    
+    entries is a list of dicts (see REPORT_FIELDS) ordered by expiry date, counts the
+    number of entries per bucket.
+    """
+    
+    def __init__(self, today, buckets):
+        self.today   = today
+        self.buckets = buckets
+        self.entries = []
+        self.counts  = dict([(b, 0) for b in bucket_names(buckets)])
+    
+    def add(self, entry):
+        self.entries.append(entry)
+        self.counts[entry['bucket']] += 1
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def as_dict(self):
+        return { 'date': self.today.isoformat(),
+                 'buckets': bucket_names(self.buckets),
+                 'counts': self.counts,
+                 'entries': [dict(e, expiry_date=e['expiry_date'].isoformat()) for e in self.entries],
+               }
+
+def scan_expiry(buckets=None, expired_days=30, today=None):
+    """Return an ExpiryReport of all active objects expiring within max(buckets) days.
+    
+    Objects that expired up to expired_days ago (but were not revoked) are reported in
+    the "expired" bucket. The scan only reads the rows in that date range.
+    """
+    
+    buckets = sorted(buckets or PKI_EXPIRY_BUCKETS)
+    today   = today or datetime.date.today()
+    first   = today - datetime.timedelta(max(expired_days, 0))
+    last    = today + datetime.timedelta(buckets[-1])
+    report  = ExpiryReport(today, buckets)
+    
+    for t, model in SCANNED_MODELS:
+        rows = model.objects.filter(active=True, expiry_date__gte=first, expiry_date__lte=last).order_by('expiry_date') \
+                            .values_list('pk', 'name', 'common_name', 'serial', 'parent__name', 'expiry_date')
+        
+        for pk, name, cn, serial, parent, expiry_date in rows:
+            days_left = (expiry_date - today).days
+            
+            report.add({ 'type': t, 'id': pk, 'name': name, 'common_name': cn, 'serial': serial, 'parent': parent,
+                         'expiry_date': expiry_date, 'days_left': days_left, 'bucket': bucket_for(days_left, buckets), })
+    
+    report.entries.sort(key=lambda e: (e['expiry_date'], e['type'], e['id']))
+    
+    logger.debug( "Expiry scan found %d objects expiring until %s" % (len(report), last) )
+    
+    return report
+
+##------------------------------------------------------------------##
+## Report output
+##------------------------------------------------------------------##
+
+def write_json(report, f):
+    """Write the report as JSON object to the file object f"""
+    
+    simplejson.dump(report.as_dict(), f, indent=2)
+    f.write('\n')
+
+def write_csv(report, f):
+    """Write the report entries as CSV with header line to the file object f"""
+    
+    w = csv.writer(f)
+    w.writerow(REPORT_FIELDS)
+    
+    for e in report.entries:
+        w.writerow([unicode(e[k] if e[k] is not None else '').encode('utf-8') for k in REPORT_FIELDS])
+
+REPORT_FORMATS = { 'json': write_json, 'csv': write_csv, }
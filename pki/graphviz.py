@@ -1,6 +1,12 @@
 """Graphviz support for django-pki"""
 
-from pki.settings import PKI_ENABLE_GRAPHVIZ, PKI_GRAPHVIZ_DIRECTION
+import os
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.contrib.humanize.templatetags.humanize import intcomma
+
+from pki.settings import PKI_ENABLE_GRAPHVIZ, PKI_GRAPHVIZ_DIRECTION, PKI_GRAPHVIZ_LEAF_LIMIT, PKI_CACHE_TIMEOUT, PKI_SHARED_CACHE
 
 if PKI_ENABLE_GRAPHVIZ is True:
     try:
@@ -8,16 +14,18 @@ if PKI_ENABLE_GRAPHVIZ is True:
     except ImportError, e:
         raise Exception( "Failed to import pygraphviz. Disable PKI_ENABLE_GRAPHVIZ or install pygraphviz: %s" % e )
 
-from pki.models import Certificate, CertificateAuthority
+from pki.models import Certificate, CertificateAuthority, hierarchy_version
+from pki.helper import CATree, generate_temp_file, url_for_name, chunks
+from pki.openssl import md5_constructor
 
 ##------------------------------------------------------------------##
 ## Graphviz functions
 ##------------------------------------------------------------------##
 
-def ObjectChain(object, target):
-    """Render object chain PNG.
+def ObjectChain(object, target, format='png'):
+    """Render object chain PNG (or SVG).
     
-    Render a graphviz image for the given object and save the resulting PNG
+    Render a graphviz image for the given object and save the result
     in target.
     """
     
@@ -43,98 +51,123 @@ def ObjectChain(object, target):
     ## Add given object to graph
     G.add_node(object.common_name, shape=o_shape, style="filled, bold", fillcolor=obj_fill, fontcolor="white")
     
-    ## Get parents if any
+    ## Get parents if any. All of them are fetched with one query
     if object.parent != None:
-        ## Set p to objects parent
-        p = object.parent
-        
-        ## Add parent node to graph
-        if p.active:
-            p_color = "green3"
-        else:
-            p_color = "red"
+        parents = object.parent.ancestors()
+        parents.append(object.parent)
         
-        G.add_node(p.common_name, shape="folder", color=p_color, style="bold")
-        
-        ## Set initial edge between requested onject and it's parent
-        edges.append( [p.common_name, object.common_name] )
-        
-        while p != None:
+        for p in parents:
             if p.active:
                 col = "green3"
             else:
                 col = "red"
             
             G.add_node(p.common_name, shape="folder", color=col, style="bold")
-            
-            if p.parent:
-                edges.append( [p.parent.common_name, p.common_name] )
-            
-            p = p.parent
+        
+        ## Edges from the top-level CA down to the requested object
+        names = [p.common_name for p in parents]
+        names.append(object.common_name)
+        
+        for i in range(len(names) - 1):
+            edges.append( [names[i], names[i+1]] )
     
     ## Draw the edges
     for e in edges:
         G.add_edge( e[0], e[1] )
     
     G.layout()
-    G.draw(target, format='png')
+    G.draw(target, format=format)
     
     return True
 
-def ObjectTree(object, target):
-    """Render object tree PNG.
+def leaf_counts(ca_ids):
+    """Return the number of active and revoked certificates per CA as {pk: [active, revoked]}.
     
-    Render a graphviz image for the entire object tree object and save the resulting PNG
-    in target.
+    One query per IN_CHUNK_SIZE CA's.
+    """
+    
+    counts = {}
+    
+    for ids in chunks(ca_ids):
+        for row in Certificate.objects.filter(parent__in=ids).order_by().values('parent', 'active').annotate(n=Count('pk')):
+            c = counts.setdefault(row['parent'], [0, 0])
+            
+            if row['active']:
+                c[0] += row['n']
+            else:
+                c[1] += row['n']
+    
+    return counts
+
+def ObjectTree(object, target, format='png', leaf_limit=PKI_GRAPHVIZ_LEAF_LIMIT):
+    """Render object tree PNG (or SVG).
+    
+    Render a graphviz image for the entire object tree object and save the result in target.
+    Edge CA's with more than leaf_limit certificates get a single node counting their active
+    and revoked certificates, linked to the certificate changelist of the CA in SVG output.
+    The graph is built from three queries, independent of the tree size.
     """
     
     ##-------------------------------------##
-    ## Helper function for tree traversal
+    ## Helper functions for tree traversal
     ##-------------------------------------##
-    def TraverseToBottom(r_id, graph=None):
-        """Traverse the PKI tree down from a given id"""
-        
-        c = CertificateAuthority.objects.get(id=r_id)
+    def TraverseToBottom(c, graph):
+        """Traverse the PKI tree down from a given CA"""
         
         if not c.is_edge_ca():
-            x = CertificateAuthority.objects.filter(parent__id=c.pk)
+            x = tree.child_cas(c)
         else:
             x = [c]
         
         for ca in x:
-            if graph != None:
-                if ca.active is True:
+            if ca.active is True:
+                col = "green3"
+            else:
+                col = "red"
+            
+            graph.add_node(ca.common_name, shape='folder', color=col, style="bold")
+            
+            ## Prevent link to self when this is a toplevel edge rootca
+            if ca != c:
+                graph.add_edge(c.common_name, ca.common_name, color="black", weight="4.5")
+            
+            if not ca.is_edge_ca():
+                TraverseToBottom(ca, graph)
+            else:
+                AddLeaves(ca, graph)
+    
+    def AddLeaves(ca, graph):
+        """Add the certificates of edge CA ca, collapsed into one node above leaf_limit"""
+        
+        active, revoked = counts.get(ca.pk, (0, 0))
+        
+        if ca.pk in collapsed:
+            node = "certificates_%d" % ca.pk
+            url  = '?'.join([url_for_name('admin:pki_certificate_changelist'), 'parent__id__exact=%d' % ca.pk])
+            
+            if active:
+                col = "green3"
+            else:
+                col = "red"
+            
+            graph.add_node(node, label="%s active / %s revoked" % (intcomma(active), intcomma(revoked)), shape='box3d', \
+                           color=col, style="bold", URL=url, target="_blank")
+            graph.add_edge(ca.common_name, node, color="black", weight="4.5")
+        elif ca.pk in leaves:
+            subgraph_list = [ ca.common_name ]
+            
+            for name, cert_active in leaves[ca.pk]:
+                subgraph_list.append( name )
+                
+                if cert_active:
                     col = "green3"
                 else:
                     col = "red"
                 
-                graph.add_node(ca.common_name, shape='folder', color=col, style="bold")
-                
-                ## Prevent link to self when this is a toplevel edge rootca
-                if ca != c:
-                    graph.add_edge(c.common_name, ca.common_name, color="black", weight="4.5")
+                graph.add_node(str(name), shape='note', color=col, style="bold")
+                graph.add_edge(ca.common_name, name, color="black", weight="4.5")
             
-            if not ca.is_edge_ca():
-                TraverseToBottom(ca.pk, graph)
-            else:
-                certs = Certificate.objects.filter(parent__id=ca.pk)
-                
-                if certs:
-                    subgraph_list = [ ca.common_name ]
-                    
-                    for cert in certs:
-                        subgraph_list.append( cert.common_name )
-                        
-                        if graph != None:
-                            if cert.active:
-                                col = "green3"
-                            else:
-                                col = "red"
-                            
-                            graph.add_node(str(cert.common_name), shape='note', color=col, style="bold")
-                            graph.add_edge(ca.common_name, cert.common_name, color="black", weight="4.5")
-                    
-                    sg = graph.subgraph(nbunch=subgraph_list, name="cluster_%d" % ca.pk, style='bold', color='black', label="")
+            sg = graph.subgraph(nbunch=subgraph_list, name="cluster_%d" % ca.pk, style='bold', color='black', label="")
     
     ##-------------------------------------##
     ## Object tree starts here
@@ -152,24 +185,92 @@ def ObjectTree(object, target):
     if not isinstance(object, CertificateAuthority):
         raise Exception( "Object has to be of type CertificateAuthority, not %s" % object.__class__.__name__ )
     
-    ## Find top parents
+    ## Find top parent and load the whole tree below it
     if object.parent != None:
-        p = object.parent
+        p = object.ancestors()[0]
         
-        while p != None:
-            if p.parent == None:
-                if p.active:
-                    col = "green3"
-                else:
-                    col = "red"
-                
-                G.add_node(p.common_name, shape='folder', color=col, style="bold")
-                TraverseToBottom(p.id, G)
-            p = p.parent
+        if p.active:
+            col = "green3"
+        else:
+            col = "red"
+        
+        G.add_node(p.common_name, shape='folder', color=col, style="bold")
     else:
-        TraverseToBottom(object.id, G)
+        p = object
+    
+    tree   = CATree(p, certificates=False)
+    counts = leaf_counts([ca.pk for ca in tree.walk()])
+    
+    ## Only the certificates of the CA's below the limit are loaded (name and state)
+    collapsed = set([pk for pk, c in counts.items() if leaf_limit is not None and sum(c) > leaf_limit])
+    leaves    = {}
+    
+    expanded = [pk for pk in counts.keys() if pk not in collapsed]
+    
+    for ids in chunks(expanded):
+        for parent, name, active in Certificate.objects.filter(parent__in=ids).order_by('pk').values_list('parent', 'common_name', 'active'):
+            leaves.setdefault(parent, []).append( (name, active) )
+    
+    TraverseToBottom(tree.root, G)
     
     G.layout()
-    G.draw(target, format='png')
+    G.draw(target, format=format)
     
     return True
+
+##------------------------------------------------------------------##
+## Render cache
+##------------------------------------------------------------------##
+
+## Graph types and their render function
+GRAPH_RENDERERS = { 'chain': ObjectChain, 'tree': ObjectTree, }
+
+## Output formats and their mimetype
+GRAPH_FORMATS = { 'png': 'image/png', 'svg': 'image/svg+xml', }
+
+def graph_cache_key(kind, obj, format='png'):
+    """Return the cache key of the kind (chain/tree) graph of obj.
+    
+    Contains the hierarchy version, so any change in the hierarchy of obj leads to a new key,
+    and the leaf limit, which changes the rendered tree.
+    """
+    
+    return 'pki_graph_%s_%s_%s_%d_%d_%s' % (kind, format, obj.__class__.__name__.lower(), obj.pk, PKI_GRAPHVIZ_LEAF_LIMIT, hierarchy_version(obj))
+
+def graph_etag(key):
+    """Return the ETag of the graph cached under key"""
+    
+    return '"%s"' % md5_constructor(key).hexdigest()
+
+def render_graph(kind, obj, key=None, format='png'):
+    """Return the kind (chain/tree) graph of obj as PNG or SVG data.
+    
+    Rendered images are cached when the cache is shared by all processes (PKI_SHARED_CACHE),
+    the hierarchy versions in a process local cache would get out of date.
+    """
+    
+    data = None
+    
+    if PKI_SHARED_CACHE:
+        key  = key or graph_cache_key(kind, obj, format)
+        data = cache.get(key)
+    
+    if data is None:
+        target = generate_temp_file()
+        
+        try:
+            GRAPH_RENDERERS[kind](obj, target, format=format)
+            
+            f = open(target, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        finally:
+            if os.path.exists(target):
+                os.remove(target)
+        
+        if PKI_SHARED_CACHE:
+            cache.set(key, data, PKI_CACHE_TIMEOUT)
+    
+    return data
@@ -2,8 +2,11 @@ import os
 import tempfile
 import random
 import zipfile
+import tarfile
 import logging
 import string
+import itertools
+import urlparse
 
 from django.utils.safestring import mark_safe
 from django.core import urlresolvers
@@ -13,6 +16,26 @@ import pki.models
 
 logger = logging.getLogger("pki")
 
+## Ids per IN clause. Keeps the number of query parameters below SQLite's limit (999)
+IN_CHUNK_SIZE = 500
+
+## Zip archives up to this size (bytes) are built in memory, bigger ones in an anonymous temp file
+ZIP_SPOOL_SIZE = 1024 * 1024
+
+def chunks(seq, size=IN_CHUNK_SIZE):
+    """Return seq split into lists of at most size elements (for __in lookups)"""
+    
+    seq = list(seq)
+    return [seq[i:i+size] for i in range(0, len(seq), size)]
+
+def media_path(path):
+    """Return the url of a media file. Relative paths are prefixed with MEDIA_URL (like forms.Media does)"""
+    
+    if path.startswith('http://') or path.startswith('https://') or path.startswith('/'):
+        return path
+    
+    return urlparse.urljoin(MEDIA_URL, path)
+
 def get_pki_icon_html(img, title="", css="centered", id=""):
         """Return HTML for given image.
         
@@ -27,6 +50,46 @@ def get_pki_icon_html(img, title="", css="centered", id=""):
         img_path = os.path.join(PKI_BASE_URL, MEDIA_URL, 'pki/img', img)
         return '<img id="%s" %s src="%s" alt="%s" title="%s"/>' % (id, css_class, img_path, title, title)
 
+## Placeholder id for url_for_id. Has to match \d+ and must not appear elsewhere in a URL
+URL_ID_PLACEHOLDER = 8675309012
+
+## Reversed URL templates of url_for_id
+_url_templates = {}
+
+## Per-request urlconf (Django 1.3+)
+_get_urlconf = getattr(urlresolvers, 'get_urlconf', lambda: None)
+
+def url_for_id(name, id, kwargs=None):
+    """reverse() for URLs that contain an object id.
+    
+    The URL is reversed once per name, kwargs, urlconf and script prefix and the id is
+    filled into the cached template afterwards. The id is passed as positional argument
+    if kwargs is None, otherwise as kwarg "id". Keeps the changelist at a constant number
+    of reverse() calls per page.
+    """
+    
+    key = (name, kwargs and tuple(sorted(kwargs.items())), _get_urlconf(), urlresolvers.get_script_prefix())
+    
+    if key not in _url_templates:
+        if kwargs is None:
+            url = urlresolvers.reverse(name, args=(URL_ID_PLACEHOLDER,))
+        else:
+            url = urlresolvers.reverse(name, kwargs=dict(kwargs, id=URL_ID_PLACEHOLDER))
+        
+        _url_templates[key] = url.replace('%', '%%').replace(str(URL_ID_PLACEHOLDER), '%d')
+    
+    return _url_templates[key] % int(id)
+
+def url_for_name(name):
+    """reverse() for URLs without arguments, cached like url_for_id"""
+    
+    key = (name, _get_urlconf(), urlresolvers.get_script_prefix())
+    
+    if key not in _url_templates:
+        _url_templates[key] = urlresolvers.reverse(name)
+    
+    return _url_templates[key]
+
 def files_for_object(obj):
     """Return files associated to object.
     
@@ -97,10 +160,102 @@ def subject_for_object(obj):
     
     return subj
 
-def chain_recursion(r_id, store, id_dict):
-    """Helper function for recusion"""
+class CATree(object):
+    """In-memory hierarchy of a CA and all its descendants.
+    
+    root is a CertificateAuthority or its id (its path is looked up first). The CA's of the
+    subtree are fetched with one query on the materialized path (all CA's when the path is
+    unknown) and the certificates of the subtree with a second one, independent of the tree size. Parent objects are set
+    from the loaded data, so obj.parent doesn't hit the database below the root. With
+    certificates=False only the CA's are loaded.
+    """
+    
+    def __init__(self, root, certificates=True):
+        self.cas      = {}
+        self.children = {}
+        self.certs    = {}
+        
+        cas = pki.models.CertificateAuthority.objects.select_related('extension').order_by('pk')
+        
+        if isinstance(root, pki.models.CertificateAuthority):
+            root_id = root.pk
+            path    = root.path
+        else:
+            root_id = int(root)
+            path    = pki.models.CertificateAuthority.objects.filter(pk=root_id).values_list('path', flat=True)[0]
+        
+        if path:
+            cas = cas.filter(path__startswith=path)
+        
+        for ca in cas:
+            self.cas[ca.pk] = ca
+        
+        for ca in self.cas.values():
+            if ca.parent_id in self.cas:
+                ca.parent = self.cas[ca.parent_id]
+        
+        ## Iterate in pk order to keep the children sorted
+        for pk in sorted(self.cas.keys()):
+            ca = self.cas[pk]
+            if ca.parent_id:
+                self.children.setdefault(ca.parent_id, []).append(ca)
+        
+        self.root = self.cas[root_id]
+        
+        if not certificates:
+            return
+        
+        certs = pki.models.Certificate.objects.select_related('extension').order_by('pk')
+        
+        if path:
+            certs = certs.filter(parent__path__startswith=path)
+        else:
+            ## Without path query the parent ids in chunks. Keeps the parameters below SQLite's limit
+            certs = itertools.chain(*[certs.filter(parent__in=ids) for ids in chunks([ca.pk for ca in self.walk()])])
+        
+        for cert in certs:
+            cert.parent = self.cas[cert.parent_id]
+            self.certs.setdefault(cert.parent_id, []).append(cert)
+    
+    def walk(self, ca=None):
+        """Return the CA's of the (sub)tree in depth-first order, starting with ca (default: root)"""
+        
+        result = []
+        stack  = [ca or self.root]
+        
+        while stack:
+            c = stack.pop()
+            result.append(c)
+            stack.extend(reversed(self.children.get(c.pk, [])))
+        
+        return result
+    
+    def child_cas(self, ca):
+        return self.children.get(ca.pk, [])
+    
+    def child_certs(self, ca):
+        return self.certs.get(ca.pk, [])
+    
+    def certificates(self):
+        """Return all certificates of the tree"""
+        
+        result = []
+        for ca in self.walk():
+            result.extend(self.child_certs(ca))
+        
+        return result
+
+def chain_recursion(r_id, store, id_dict, tree=None):
+    """Build the nested delete list of CA r_id and its descendants.
+    
+    The ids of all affected objects are added to id_dict. Data is taken from a CATree,
+    so no queries are done per node.
+    """
+    
+    if tree is None:
+        tree = CATree(r_id)
     
-    i = pki.models.CertificateAuthority.objects.get(pk=r_id)
+    i = tree.cas[int(r_id)]
     
     div_content = build_delete_item(i)
     store.append( mark_safe('Certificate Authority: <a href="%s">%s</a> <img src="%spki/img/plus.png" class="switch" /><div class="details">%s</div>' % \
@@ -108,8 +263,8 @@ def chain_recursion(r_id, store, id_dict):
     
     id_dict['ca'].append(i.pk)
     
-    ## Search for child certificates
-    child_certs = pki.models.Certificate.objects.filter(parent=r_id)
+    ## Child certificates
+    child_certs = tree.child_certs(i)
     if child_certs:
         helper = []
         for cert in child_certs:
@@ -119,12 +274,12 @@ def chain_recursion(r_id, store, id_dict):
             id_dict['cert'].append(cert.pk)
         store.append(helper)
     
-    ## Search for related CA's
-    child_cas = pki.models.CertificateAuthority.objects.filter(parent=r_id)
+    ## Related CA's
+    child_cas = tree.child_cas(i)
     if child_cas:
         helper = []
         for ca in child_cas:
-            chain_recursion(ca.pk, helper, id_dict)
+            chain_recursion(ca.pk, helper, id_dict, tree)
         store.append(helper)
 
 def build_delete_item(obj):
@@ -147,38 +302,136 @@ def generate_temp_file():
     
     return f
 
+def spooled_temp_file():
+    """Return a anonymous temp file that is kept in memory up to ZIP_SPOOL_SIZE bytes.
+    
+    The file has no name on disk (or is removed on close) so nothing is left behind.
+    """
+    
+    try:
+        return tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+    except AttributeError:
+        ## python < 2.6
+        return tempfile.TemporaryFile()
+
+def write_zip_for_object(obj, f):
+    """Write the zip with the files of obj to the file object f"""
+    
+    files = files_for_object(obj)
+    c_zip = zipfile.ZipFile(f, 'w')
+    
+    c_zip.write(files['key']['path'], files['key']['name'])
+    c_zip.write(files['pem']['path'], files['pem']['name'])
+    
+    if isinstance(obj, pki.models.CertificateAuthority) or obj.parent:
+        c_zip.write(files['chain']['path'], files['chain']['name'])
+        c_zip.write(files['crl']['path'], files['crl']['name'])
+    
+    try:
+        if obj.pkcs12_encoded:
+            c_zip.write(files['pkcs12']['path'], files['pkcs12']['name'])
+    except AttributeError:
+        pass
+    
+    if obj.der_encoded:
+        c_zip.write(files['der']['path'], files['der']['name'])
+    
+    c_zip.close()
+
 def build_zip_for_object(obj, request):
     """Build zip with filed ob object.
     
-    request is required to check permissions. Zip file path is returned.
+    request is required to check permissions. A spooled temp file positioned at the
+    start of the zip is returned. Closing it releases all resources.
     """
     
+    zip_f = spooled_temp_file()
+    
     try:
-        base_folder = 'PKI_DATA_%s' % obj.name
-        files       = files_for_object(obj)
-        zip_f       = generate_temp_file()
-        
-        c_zip = zipfile.ZipFile(zip_f, 'w')
-        
-        c_zip.write(files['key']['path'], files['key']['name'])
-        c_zip.write(files['pem']['path'], files['pem']['name'])
-        
-        if isinstance(obj, pki.models.CertificateAuthority) or obj.parent:
-            c_zip.write(files['chain']['path'], files['chain']['name'])
-            c_zip.write(files['crl']['path'], files['crl']['name'])
+        write_zip_for_object(obj, zip_f)
+    except Exception, e:
+        zip_f.close()
+        logger.error("Exception during zip file creation: %s" % e)
+        raise Exception(e)
+    
+    zip_f.seek(0)
+    return zip_f
+
+def file_size(f):
+    """Return the size of the file object f. The position is reset to the start"""
+    
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(0)
+    
+    return size
+
+def subtree_for_ca(ca):
+    """Return the CA's subtree as lists (cas, certs). ca is the first element of cas"""
+    
+    tree = CATree(ca)
+    
+    return (tree.walk(), tree.certificates())
+
+## Supported subtree archive formats: { format: (mimetype, file extension) }
+ARCHIVE_FORMATS = { 'zip': ('application/zip', 'zip'),
+                    'tgz': ('application/x-gzip', 'tar.gz'),
+                  }
+
+def files_for_subtree(ca):
+    """Return (path, archive name) of all public files of the CA subtree.
+    
+    Certificates, chains and CRLs are included. Private keys are not.
+    """
+    
+    cas, certs = subtree_for_ca(ca)
+    base       = 'PKI_EXPORT_%s' % ca.name
+    result     = []
+    
+    for c in cas:
+        files = files_for_object(c)
         
-        try:
-            if obj.pkcs12_encoded:
-                c_zip.write(files['pkcs12']['path'], files['pkcs12']['name'])
-        except AttributeError:
-            pass
+        for f in ('pem', 'chain', 'crl'):
+            result.append( (files[f]['path'], os.path.join(base, c.name, files[f]['name'])) )
+    
+    for c in certs:
+        files = files_for_object(c)
+        result.append( (files['pem']['path'], os.path.join(base, c.parent.name, 'certs', files['pem']['name'])) )
+    
+    return [ (p, n) for p, n in result if os.path.exists(p) ]
+
+def write_archive_for_subtree(ca, f, format='zip'):
+    """Write a zip or tar.gz (format tgz) of the CA subtree to the file object f"""
+    
+    files = files_for_subtree(ca)
+    
+    if format == 'zip':
+        archive = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
         
-        if obj.der_encoded:
-            c_zip.write(files['der']['path'], files['der']['name'])
+        for path, name in files:
+            archive.write(path, name)
+    elif format == 'tgz':
+        archive = tarfile.open(fileobj=f, mode='w:gz')
         
-        c_zip.close()
+        for path, name in files:
+            archive.add(path, name)
+    else:
+        raise Exception( "Unsupported archive format %s" % format )
+    
+    archive.close()
+    logger.info( "Exported %d files of CA %s subtree" % (len(files), ca.name) )
+
+def build_archive_for_subtree(ca, format='zip'):
+    """Build the subtree archive of ca. Returns a spooled temp file positioned at the start"""
+    
+    archive_f = spooled_temp_file()
+    
+    try:
+        write_archive_for_subtree(ca, archive_f, format)
     except Exception, e:
-        logger.error("Exception during zip file creation: %s" % e)
+        archive_f.close()
+        logger.error("Exception during archive creation: %s" % e)
         raise Exception(e)
     
-    return zip_f
+    archive_f.seek(0)
+    return archive_f
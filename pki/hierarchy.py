@@ -0,0 +1,96 @@
+"""JSON hierarchy API.
+
+Returns the children of a CA (or the top-level objects) one page at a time, so a client
+can render the tree and load subtrees on demand. Every page is built with a constant
+number of queries, independent of the size of the hierarchy.
+"""
+
+from django.db.models import Count
+
+from pki.models import CertificateAuthority, Certificate
+from pki.helper import url_for_id
+from pki.settings import PKI_HIERARCHY_PAGE_SIZE
+
+## Fields returned per node
+NODE_FIELDS = ( 'pk', 'name', 'common_name', 'active', 'expiry_date', 'parent', )
+
+##------------------------------------------------------------------##
+## Hierarchy pages
+##------------------------------------------------------------------##
+
+def child_counts(ca_ids):
+    """Return the number of child CA's and certificates per CA as {pk: n} (two queries)"""
+    
+    counts = dict([(pk, 0) for pk in ca_ids])
+    
+    if not ca_ids:
+        return counts
+    
+    for model in (CertificateAuthority, Certificate):
+        for row in model.objects.filter(parent__in=ca_ids).order_by().values('parent').annotate(n=Count('pk')):
+            counts[row['parent']] += row['n']
+    
+    return counts
+
+def build_node(t, row, children=None):
+    """Return the JSON node for a values() row of type t (ca/certificate)"""
+    
+    node = { 'type': t,
+             'id': row['pk'],
+             'name': row['name'],
+             'common_name': row['common_name'],
+             'active': row['active'],
+             'expiry_date': row['expiry_date'] and row['expiry_date'].isoformat(),
+             'parent': row['parent'],
+           }
+    
+    if t == 'ca':
+        node['children'] = children
+        node['url'] = url_for_id('pki:hierarchy', row['pk'], {})
+    
+    return node
+
+def hierarchy_page(ca=None, page=1, page_size=None):
+    """Return a page of the children of CertificateAuthority ca as dict.
+    
+    Without ca the top-level CA's and self-signed certificates are returned. Child CA's
+    are listed before certificates, both ordered by name. CA nodes contain the number
+    of their children and the url of their first page.
+    """
+    
+    page_size = page_size or PKI_HIERARCHY_PAGE_SIZE
+    
+    if ca is None:
+        cas   = CertificateAuthority.objects.filter(parent__isnull=True)
+        certs = Certificate.objects.filter(parent__isnull=True)
+    else:
+        cas   = CertificateAuthority.objects.filter(parent=ca)
+        certs = Certificate.objects.filter(parent=ca)
+    
+    n_cas   = cas.count()
+    n_certs = certs.count()
+    count   = n_cas + n_certs
+    pages   = max((count + page_size - 1) // page_size, 1)
+    
+    if page < 1 or page > pages:
+        raise ValueError( "Page %d does not exist" % page )
+    
+    first = (page - 1) * page_size
+    last  = first + page_size
+    nodes = []
+    
+    if first < n_cas:
+        rows   = list(cas.order_by('name').values(*NODE_FIELDS)[first:min(last, n_cas)])
+        counts = child_counts([r['pk'] for r in rows])
+        nodes.extend([build_node('ca', r, counts[r['pk']]) for r in rows])
+    
+    if last > n_cas:
+        rows = certs.order_by('name').values(*NODE_FIELDS)[max(first - n_cas, 0):last - n_cas]
+        nodes.extend([build_node('certificate', r) for r in rows])
+    
+    return { 'parent': ca and ca.pk,
+             'page': page,
+             'pages': pages,
+             'count': count,
+             'nodes': nodes,
+           }
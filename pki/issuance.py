@@ -0,0 +1,260 @@
+"""Bulk certificate issuance.
+
+Issue many certificates under a single CA from a manifest (CSV or JSON). The parent CA,
+its passphrase and the x509 extensions are verified once, keys are generated in parallel,
+all certificates are signed in one signing session and the changelogs are buffered and
+inserted with one executemany() per CHANGELOG_BATCH_SIZE entries (see models.bulk_insert).
+"""
+
+import os
+import re
+import csv
+from logging import getLogger
+
+from django.core.exceptions import ValidationError
+from django.utils import simplejson
+
+from pki.models import Certificate, CertificateAuthority, x509Extension, ChangelogWriter
+from pki.openssl import SigningSession, get_openssl, update_crl, md5_constructor, refresh_pki_metadata
+from pki.keypool import KeyPool, fill_reservoir
+from pki.settings import PKI_DIR, PKI_OPENSSL_CONF
+
+logger = getLogger("pki")
+
+## Certificate fields that can be set in a manifest
+MANIFEST_FIELDS = ( 'common_name', 'name', 'description', 'country', 'state', 'locality', 'organization', 'OU',
+                    'email', 'valid_days', 'key_length', 'passphrase', 'subjaltname', 'crl_dpoints', 'der_encoded',
+                    'pkcs12_encoded', 'pkcs12_passphrase', 'extension', )
+
+## Subject fields that are taken from the parent CA when missing in the manifest
+INHERITED_FIELDS = ( 'country', 'state', 'locality', 'organization', )
+
+##------------------------------------------------------------------##
+## Manifest handling
+##------------------------------------------------------------------##
+
+def load_manifest(path):
+    """Return the list of certificate definitions in the given manifest.
+    
+    JSON manifests (*.json) contain a list of objects, everything else is read as CSV
+    with a header line. Keys/columns are Certificate field names (see MANIFEST_FIELDS).
+    """
+    
+    f = open(path, 'rb')
+    
+    try:
+        if path.lower().endswith('.json'):
+            items = simplejson.load(f)
+            
+            if not isinstance(items, list):
+                raise Exception( "JSON manifest %s has to contain a list of certificates" % path )
+        else:
+            items = list(csv.DictReader(f))
+    finally:
+        f.close()
+    
+    return items
+
+def name_for_common_name(cn):
+    """Build a valid certificate name from the common name (same as the admin's suggestion)"""
+    
+    return re.sub('[^a-zA-Z0-9-_\.]', '_', cn)
+
+##------------------------------------------------------------------##
+## Issuance
+##------------------------------------------------------------------##
+
+class IssuanceResult(object):
+    """Outcome of a bulk issuance.
+    
+    issued contains the created Certificate objects, failed (item number, name, error) tuples.
+    """
+    
+    def __init__(self):
+        self.issued = []
+        self.failed = []
+    
+    def __len__(self):
+        return len(self.issued) + len(self.failed)
+
+def verify_parent(ca, parent_passphrase):
+    """Make sure certificates can be signed by ca"""
+    
+    if not ca.active:
+        raise Exception( 'CA "%s" is revoked' % ca.name )
+    
+    ## Same restriction as the parent choices in the admin
+    if not ca.is_edge_ca():
+        raise Exception( 'CA "%s" is not an edge CA and cannot sign certificates' % ca.name )
+    
+    if ca.passphrase != md5_constructor(str(parent_passphrase or '')).hexdigest():
+        raise Exception( 'Passphrase is wrong. Enter correct passphrase for CA "%s"' % ca.name )
+    
+    ## Make sure openssl finds the CA section. Done once for the whole batch
+    if not os.path.exists(PKI_OPENSSL_CONF):
+        refresh_pki_metadata(CertificateAuthority.objects.all())
+
+def build_certificate(ca, item, defaults, extensions):
+    """Return a validated, unsaved Certificate for the manifest item"""
+    
+    fields = dict(defaults)
+    
+    for k, v in item.items():
+        if k not in MANIFEST_FIELDS:
+            raise ValidationError( 'Unknown field "%s"' % k )
+        
+        if isinstance(v, basestring):
+            v = v.strip()
+        
+        if v not in ('', None):
+            fields[str(k)] = v
+    
+    if not fields.get('common_name'):
+        raise ValidationError( 'Field common_name is required' )
+    
+    for f in INHERITED_FIELDS:
+        fields.setdefault(f, getattr(ca, f))
+    
+    fields.setdefault('name', name_for_common_name(fields['common_name']))
+    fields.setdefault('description', 'Issued by %s' % ca.common_name)
+    
+    ## x509 extensions are looked up once per name
+    ext = fields.pop('extension', None)
+    
+    if isinstance(ext, basestring):
+        if ext not in extensions:
+            try:
+                extensions[ext] = x509Extension.objects.get(name=ext)
+            except x509Extension.DoesNotExist:
+                raise ValidationError( 'x509 extension "%s" does not exist' % ext )
+        
+        ext = extensions[ext]
+    
+    if ext is None:
+        raise ValidationError( 'No x509 extension given' )
+    
+    if ext.is_ca():
+        raise ValidationError( 'x509 extension "%s" is a CA extension' % ext.name )
+    
+    cert = Certificate(parent=ca, extension=ext, **fields)
+    cert.full_clean()
+    
+    if ext.crl_distribution_point and not cert.crl_dpoints:
+        raise ValidationError( 'CRL Distribution Points are required by x509 extension "%s"' % ext.name )
+    
+    if os.path.exists(os.path.join(PKI_DIR, ca.name, 'certs', '%s.key.pem' % cert.name)):
+        raise ValidationError( 'Name "%s" is already in use!' % cert.name )
+    
+    return cert
+
+def discard_certificate(cert, parent_passphrase):
+    """Remove the files of a certificate that failed to be issued.
+    
+    Returns True if the certificate had to be revoked (CRL has to be regenerated).
+    """
+    
+    a = get_openssl(cert)
+    
+    if os.path.exists(a.crt):
+        revoked = not a.get_revoke_status_from_cert()
+        
+        if revoked:
+            a.revoke_certificate(parent_passphrase)
+        
+        a.remove_complete_certificate()
+        return revoked
+    
+    for f in (a.key, a.csr):
+        if os.path.exists(f):
+            os.remove(f)
+    
+    return False
+
+def issue_certificates(ca, parent_passphrase, items, extension=None, defaults=None, user=None):
+    """Issue certificates for all items under ca.
+    
+    items is a list of dicts as returned by load_manifest. extension (x509Extension)
+    and defaults are used for items that don't define them. Items that fail are
+    reported in the result and don't abort the run.
+    """
+    
+    verify_parent(ca, parent_passphrase)
+    
+    if defaults is None:
+        defaults = {}
+    
+    if extension is not None:
+        defaults = dict(defaults, extension=extension)
+    
+    result     = IssuanceResult()
+    extensions = {}
+    changelogs = ChangelogWriter()
+    certs      = []
+    seen       = set()
+    crl_stale  = False
+    
+    logger.info( "Bulk issuance of %d certificates under %s" % (len(items), ca.name) )
+    
+    ## Validate all items first. Duplicates within the manifest aren't in the DB yet
+    for n, item in enumerate(items):
+        try:
+            cert = build_certificate(ca, item, defaults, extensions)
+            
+            if ('name', cert.name) in seen or ('cn', cert.common_name) in seen:
+                raise ValidationError( 'Certificate "%s" is listed more than once' % cert.common_name )
+            
+            seen.add( ('name', cert.name) )
+            seen.add( ('cn', cert.common_name) )
+            certs.append( (n, cert) )
+        except ValidationError, e:
+            result.failed.append( (n+1, item.get('name') or item.get('common_name'), '; '.join(e.messages)) )
+        except Exception, e:
+            result.failed.append( (n+1, item.get('name') or item.get('common_name'), str(e)) )
+    
+    ## Generate the keys in parallel. Each save() takes one from the reservoir
+    key_lengths = {}
+    for n, cert in certs:
+        key_lengths[cert.key_length] = key_lengths.get(cert.key_length, 0) + 1
+    
+    pool = KeyPool()
+    for key_length, count in key_lengths.items():
+        try:
+            fill_reservoir(key_length, count, pool)
+        except Exception, e:
+            logger.exception( "Parallel key generation failed. Keys are generated one by one: %s" % e )
+    
+    ## Hold the CA lock for the whole batch (including the DB writes) and let the engine keep the CA loaded
+    session = SigningSession(ca)
+    session.open()
+    
+    try:
+        for n, cert in certs:
+            cert.parent_passphrase = parent_passphrase
+            cert.user              = user
+            cert.changelog_writer  = changelogs
+            
+            try:
+                cert.save()
+                result.issued.append(cert)
+            except Exception, e:
+                logger.exception( "Failed to issue certificate %s" % cert.name )
+                result.failed.append( (n+1, cert.name, str(e)) )
+                
+                try:
+                    crl_stale = discard_certificate(cert, parent_passphrase) or crl_stale
+                except Exception, e:
+                    logger.exception( "Cleanup of certificate %s failed" % cert.name )
+    finally:
+        try:
+            changelogs.flush()
+            
+            if crl_stale:
+                update_crl(get_openssl(ca), ca.name, parent_passphrase)
+        finally:
+            session.close()
+    
+    result.failed.sort()
+    
+    logger.info( "Bulk issuance under %s finished: %d issued, %d failed" % (ca.name, len(result.issued), len(result.failed)) )
+    
+    return result
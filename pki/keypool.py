@@ -0,0 +1,176 @@
+"""RSA key generation pool and key reservoir.
+
+Keys are generated by up to PKI_KEY_POOL_PROCESSES parallel openssl processes. When
+PKI_KEY_RESERVOIR_SIZE is set, unencrypted keys are kept ready per key length in
+PKI_DIR/_KEY_RESERVOIR and refilled in the background whenever a key is taken.
+"""
+
+import os
+import random
+import string
+import threading
+from subprocess import Popen, PIPE, STDOUT
+from logging import getLogger
+
+from pki.settings import PKI_DIR, PKI_OPENSSL_BIN, PKI_KEY_POOL_PROCESSES, PKI_KEY_RESERVOIR_SIZE
+
+logger = getLogger("pki")
+
+KEY_RESERVOIR_DIR = os.path.join(PKI_DIR, '_KEY_RESERVOIR')
+
+##------------------------------------------------------------------##
+## Key generation pool
+##------------------------------------------------------------------##
+
+class KeyPool(object):
+    """Run genrsa for many keys with a limited number of parallel openssl processes"""
+    
+    def __init__(self, processes=None):
+        self.processes = max(1, int(processes or PKI_KEY_POOL_PROCESSES))
+    
+    def start(self, key_length, path):
+        """Start genrsa for a single key. Output goes to a temp file until it's complete"""
+        
+        tmp  = '%s.tmp' % path
+        proc = Popen([PKI_OPENSSL_BIN, 'genrsa', '-out', tmp, str(key_length)], shell=False, env={ 'PKI_DIR': PKI_DIR }, \
+                     stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        
+        return (proc, tmp, path)
+    
+    def finish(self, job):
+        """Wait for a started job. Returns True when the key was generated"""
+        
+        proc, tmp, path = job
+        stdout_value = proc.communicate()[0]
+        
+        if proc.returncode != 0:
+            logger.error( 'openssl command "genrsa" failed with returncode %d' % proc.returncode )
+            logger.error( stdout_value )
+            
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            
+            return False
+        
+        os.rename(tmp, path)
+        return True
+    
+    def generate(self, jobs):
+        """Generate keys for a list of (key_length, path) tuples.
+        
+        Returns the number of successfully generated keys.
+        """
+        
+        jobs    = list(jobs)
+        running = []
+        done    = 0
+        
+        while jobs or running:
+            while jobs and len(running) < self.processes:
+                running.append(self.start(*jobs.pop(0)))
+            
+            if self.finish(running.pop(0)):
+                done += 1
+        
+        logger.debug( "Key pool generated %d keys" % done )
+        return done
+
+##------------------------------------------------------------------##
+## Key reservoir
+##------------------------------------------------------------------##
+
+def reservoir_dir(key_length):
+    """Return the reservoir directory for the given key length"""
+    
+    return os.path.join(KEY_RESERVOIR_DIR, str(int(key_length)))
+
+def reservoir_keys(key_length):
+    """Return the ready keys of the given key length"""
+    
+    d = reservoir_dir(key_length)
+    
+    if not os.path.isdir(d):
+        return []
+    
+    return [os.path.join(d, f) for f in os.listdir(d) if f.endswith('.key.pem')]
+
+def fill_reservoir(key_length, size, pool=None):
+    """Generate keys until at least size keys of key_length are ready"""
+    
+    d = reservoir_dir(key_length)
+    
+    if not os.path.isdir(d):
+        try:
+            os.makedirs(d, 0700)
+        except OSError:
+            ## Created by a concurrent refill
+            if not os.path.isdir(d):
+                raise
+    
+    missing = size - len(reservoir_keys(key_length))
+    
+    if missing <= 0:
+        return 0
+    
+    logger.info( "Generating %d keys with %s bit for the key reservoir" % (missing, key_length) )
+    
+    jobs = []
+    for i in range(missing):
+        name = "".join(random.sample(string.letters+string.digits, 16))
+        jobs.append( (key_length, os.path.join(d, '%s.key.pem' % name)) )
+    
+    return (pool or KeyPool()).generate(jobs)
+
+def take_key(key_length):
+    """Claim a ready key from the reservoir.
+    
+    Returns the path of the claimed (unencrypted) key or None if the reservoir is empty.
+    The caller has to remove the file. Renaming makes sure a key is only handed out once.
+    """
+    
+    for path in reservoir_keys(key_length):
+        claimed = '%s.claimed' % path
+        
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            continue
+        
+        return claimed
+    
+    return None
+
+## Key lengths a background refill is running for
+_refilling = set()
+_refill_lock = threading.Lock()
+
+def refill_reservoir(key_length):
+    """Refill the reservoir of key_length to PKI_KEY_RESERVOIR_SIZE in a background thread"""
+    
+    if PKI_KEY_RESERVOIR_SIZE <= 0:
+        return
+    
+    _refill_lock.acquire()
+    try:
+        if key_length in _refilling:
+            return
+        _refilling.add(key_length)
+    finally:
+        _refill_lock.release()
+    
+    def run():
+        try:
+            try:
+                fill_reservoir(key_length, PKI_KEY_RESERVOIR_SIZE)
+            except Exception, e:
+                logger.exception( "Refilling the key reservoir failed: %s" % e )
+        finally:
+            _refill_lock.acquire()
+            try:
+                _refilling.discard(key_length)
+            finally:
+                _refill_lock.release()
+    
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
@@ -0,0 +1,66 @@
+import sys
+import getpass
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pki.models import CertificateAuthority
+from pki.openssl import get_openssl, dirty_crls, regenerate_crl, md5_constructor
+
+class Command(BaseCommand):
+    """Regenerate outdated CRLs"""
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--ca', dest='ca_names', action='append', help='Regenerate the CRL of this CA even if it is up to date. Can be given more than once'),
+        make_option('--passphrase', dest='passphrases', action='append', help='CA passphrase as <ca name>=<passphrase>. Prompted for missing CAs'),
+        make_option('--list', dest='list', action='store_true', default=False, help='Only list the CAs with an outdated CRL'),
+    )
+    help = 'Regenerate the CRLs marked outdated by revocations (see PKI_CRL_DEFERRED) and the CRLs of the given CAs'
+    
+    def handle(self, *args, **options):
+        names = sorted(set(dirty_crls() + (options.get('ca_names') or [])))
+        
+        if options['list']:
+            for name in names:
+                print name
+            return
+        
+        if not names:
+            print "All CRLs are up to date"
+            return
+        
+        cas = dict([(ca.name, ca) for ca in CertificateAuthority.objects.filter(name__in=names)])
+        
+        passphrases = {}
+        for p in options.get('passphrases') or []:
+            if '=' not in p:
+                raise CommandError( 'Invalid --passphrase "%s". Use <ca name>=<passphrase>' % p )
+            
+            name, passphrase = p.split('=', 1)
+            passphrases[name] = passphrase
+        
+        failed = 0
+        
+        for name in names:
+            if name not in cas:
+                sys.stderr.write("CA %s does not exist\n" % name)
+                failed += 1
+                continue
+            
+            if name not in passphrases:
+                passphrases[name] = getpass.getpass('Passphrase of CA "%s": ' % name)
+            
+            if cas[name].passphrase != md5_constructor(passphrases[name]).hexdigest():
+                sys.stderr.write("Passphrase of CA %s is wrong\n" % name)
+                failed += 1
+                continue
+            
+            try:
+                regenerate_crl(get_openssl(cas[name]), name, passphrases[name])
+                print "Generated CRL of %s" % name
+            except Exception, e:
+                sys.stderr.write("CRL of %s failed: %s\n" % (name, e))
+                failed += 1
+        
+        if failed:
+            raise CommandError( "%d CRLs failed" % failed )
@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pki.models import CertificateAuthority, Certificate
+from pki.email import deliver_queued_emails, run_delivery_worker, queue_certificate_emails, subtree_objects
+
+class Command(BaseCommand):
+    """Deliver queued certificate emails"""
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--subtree', dest='subtrees', action='append', help='Queue the certificate data of this CA, all CAs below and their certificates. Can be given more than once'),
+        make_option('--certificate', dest='certificates', action='append', type='int', help='Queue the certificate data of the certificate with this id. Can be given more than once'),
+        make_option('--queue-only', dest='queue_only', action='store_true', default=False, help='Only queue, leave the delivery to the next run'),
+        make_option('--limit', dest='limit', type='int', help='Send at most this many emails per run'),
+        make_option('--loop', dest='interval', type='int', help='Keep running and check the queue every INTERVAL seconds'),
+    )
+    help = 'Send the queued certificate emails over one SMTP connection. Failed deliveries are retried with backoff'
+    
+    def handle(self, *args, **options):
+        objs = []
+        
+        if options.get('subtrees'):
+            cas = list(CertificateAuthority.objects.filter(name__in=options['subtrees']))
+            
+            missing = set(options['subtrees']) - set([ca.name for ca in cas])
+            if missing:
+                raise CommandError( 'CA "%s" does not exist' % '", "'.join(sorted(missing)) )
+            
+            objs.extend(subtree_objects(cas))
+        
+        if options.get('certificates'):
+            certs = list(Certificate.objects.filter(pk__in=options['certificates']))
+            
+            if len(certs) != len(set(options['certificates'])):
+                raise CommandError( "Some of the certificates do not exist" )
+            
+            objs.extend(certs)
+        
+        if objs:
+            queued, skipped = queue_certificate_emails(objs)
+            print "%d emails queued, %d revoked objects or objects without email address skipped" % (queued, skipped)
+        
+        if options['queue_only']:
+            return
+        
+        if options.get('interval') is not None:
+            if options['interval'] < 1:
+                raise CommandError( "The interval has to be at least one second" )
+            
+            try:
+                run_delivery_worker(options['interval'], options.get('limit'))
+            except KeyboardInterrupt:
+                pass
+            
+            return
+        
+        sent = deliver_queued_emails(options.get('limit'))
+        
+        print "%d emails sent" % sent
@@ -0,0 +1,42 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pki.expiry import scan_expiry, REPORT_FORMATS
+
+class Command(BaseCommand):
+    """Report expiring CA's and certificates"""
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=REPORT_FORMATS.keys(), default='json', help='json or csv (default: json)'),
+        make_option('--output', dest='output', help='Write the report to this file instead of stdout'),
+        make_option('--buckets', dest='buckets', help='Comma separated upper limits of the days-left buckets (default: PKI_EXPIRY_BUCKETS)'),
+        make_option('--expired-days', dest='expired_days', type='int', default=30, help='Also report objects that expired up to this many days ago (default: 30)'),
+    )
+    help = 'Report active CA\'s and certificates that are about to expire, grouped by days left'
+    
+    def handle(self, *args, **options):
+        buckets = None
+        
+        if options.get('buckets'):
+            try:
+                buckets = [int(b) for b in options['buckets'].split(',')]
+            except ValueError:
+                raise CommandError( "Buckets have to be comma separated numbers" )
+            
+            if [b for b in buckets if b < 0]:
+                raise CommandError( "Buckets cannot be negative" )
+        
+        report = scan_expiry(buckets=buckets, expired_days=options['expired_days'])
+        
+        if options.get('output'):
+            f = open(options['output'], 'wb')
+        else:
+            f = sys.stdout
+        
+        try:
+            REPORT_FORMATS[options['format']](report, f)
+        finally:
+            if f is not sys.stdout:
+                f.close()
@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pki.models import CertificateAuthority
+from pki.helper import write_archive_for_subtree, ARCHIVE_FORMATS
+
+class Command(BaseCommand):
+    """Export a CA subtree as zip or tar.gz"""
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=ARCHIVE_FORMATS.keys(), help='zip or tgz (default: guessed from the file name)'),
+    )
+    help = 'Write the certificates, chains and CRLs of a CA and all its descendants to an archive. Private keys are not exported'
+    args = '<ca name> <archive>'
+    
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError( "Usage: manage.py pki_export %s" % self.args )
+        
+        try:
+            ca = CertificateAuthority.objects.get(name=args[0])
+        except CertificateAuthority.DoesNotExist:
+            raise CommandError( 'CA "%s" does not exist' % args[0] )
+        
+        format = options.get('format')
+        if not format:
+            if args[1].endswith('.tar.gz') or args[1].endswith('.tgz'):
+                format = 'tgz'
+            else:
+                format = 'zip'
+        
+        f = open(args[1], 'wb')
+        
+        try:
+            write_archive_for_subtree(ca, f, format)
+        finally:
+            f.close()
+        
+        print "Exported subtree of %s to %s" % (ca.name, args[1])
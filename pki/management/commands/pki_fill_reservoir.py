@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pki.models import KEY_LENGTH
+from pki.keypool import KeyPool, fill_reservoir, reservoir_keys
+from pki.settings import PKI_KEY_RESERVOIR_SIZE
+
+class Command(BaseCommand):
+    """Fill the key reservoir"""
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--size', dest='size', type='int', default=PKI_KEY_RESERVOIR_SIZE, help='Number of keys per key length (default: PKI_KEY_RESERVOIR_SIZE)'),
+        make_option('--processes', dest='processes', type='int', help='Parallel openssl processes (default: PKI_KEY_POOL_PROCESSES)'),
+    )
+    help = 'Pre-generate RSA keys for the given key lengths (default: all) in PKI_DIR/_KEY_RESERVOIR'
+    args = '[key length ...]'
+    
+    def handle(self, *args, **options):
+        valid = [k for k, v in KEY_LENGTH]
+        
+        try:
+            key_lengths = [int(a) for a in args] or valid
+        except ValueError:
+            raise CommandError( "Key lengths have to be numbers" )
+        
+        for k in key_lengths:
+            if k not in valid:
+                raise CommandError( "Invalid key length %d (supported are %s)" % (k, ', '.join([str(v) for v in valid])) )
+        
+        pool = KeyPool(options.get('processes'))
+        
+        for k in key_lengths:
+            fill_reservoir(k, options['size'], pool)
+            print "%d keys with %d bit ready" % (len(reservoir_keys(k)), k)
@@ -0,0 +1,61 @@
+import sys
+import getpass
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pki.models import CertificateAuthority, x509Extension
+from pki.issuance import load_manifest, issue_certificates
+
+class Command(BaseCommand):
+    """Issue the certificates of a CSV or JSON manifest under one CA"""
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--extension', dest='extension', help='x509 extension for manifest items without "extension"'),
+        make_option('--valid-days', dest='valid_days', type='int', help='Valid days for manifest items without "valid_days"'),
+        make_option('--key-length', dest='key_length', type='int', help='Key length for manifest items without "key_length"'),
+        make_option('--passphrase', dest='passphrase', help='Passphrase of the CA. Prompted if omitted'),
+    )
+    help = 'Issue all certificates listed in a CSV or JSON manifest under the given CA'
+    args = '<ca name> <manifest>'
+    
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError( "Usage: manage.py pki_issue %s" % self.args )
+        
+        try:
+            ca = CertificateAuthority.objects.select_related('extension').get(name=args[0])
+        except CertificateAuthority.DoesNotExist:
+            raise CommandError( 'CA "%s" does not exist' % args[0] )
+        
+        extension = None
+        if options.get('extension'):
+            try:
+                extension = x509Extension.objects.get(name=options['extension'])
+            except x509Extension.DoesNotExist:
+                raise CommandError( 'x509 extension "%s" does not exist' % options['extension'] )
+        
+        defaults = {}
+        for k in ('valid_days', 'key_length'):
+            if options.get(k):
+                defaults[k] = options[k]
+        
+        try:
+            items = load_manifest(args[1])
+        except Exception, e:
+            raise CommandError( "Failed to read manifest %s: %s" % (args[1], e) )
+        
+        passphrase = options.get('passphrase') or getpass.getpass('Passphrase of CA "%s": ' % ca.name)
+        
+        try:
+            result = issue_certificates(ca, passphrase, items, extension=extension, defaults=defaults)
+        except Exception, e:
+            raise CommandError( e )
+        
+        for n, name, error in result.failed:
+            sys.stderr.write("Item %d (%s) failed: %s\n" % (n, name, error))
+        
+        print "%d of %d certificates issued under %s" % (len(result.issued), len(result), ca.name)
+        
+        if result.failed:
+            raise CommandError( "%d certificates failed" % len(result.failed) )
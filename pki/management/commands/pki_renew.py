@@ -0,0 +1,51 @@
+import sys
+import getpass
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pki.renewal import expiring_certificates, renew_certificates
+
+class Command(BaseCommand):
+    """Renew certificates that are about to expire"""
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=30, help='Renew certificates expiring within this many days (default: 30)'),
+        make_option('--ca', dest='ca_names', action='append', help='Only renew certificates of this CA. Can be given more than once'),
+        make_option('--valid-days', dest='valid_days', type='int', help='Valid days of the renewed certificates (default: unchanged)'),
+        make_option('--passphrase', dest='passphrases', action='append', help='CA passphrase as <ca name>=<passphrase>. Prompted for missing CAs'),
+        make_option('--journal', dest='journal', help='Record the outcome per certificate in this file. A repeated run skips certificates renewed before'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False, help='Only list the certificates that would be renewed'),
+    )
+    help = 'Revoke and re-sign all certificates expiring within the given number of days. The CRL of each CA is generated once'
+    
+    def handle(self, *args, **options):
+        certs = list(expiring_certificates(options['days'], options.get('ca_names')))
+        
+        if options['dry_run']:
+            for cert in certs:
+                print "%s\t%s\t%s" % (cert.parent.name, cert.name, cert.expiry_date)
+            print "%d certificates would be renewed" % len(certs)
+            return
+        
+        passphrases = {}
+        for p in options.get('passphrases') or []:
+            if '=' not in p:
+                raise CommandError( 'Invalid --passphrase "%s". Use <ca name>=<passphrase>' % p )
+            
+            name, passphrase = p.split('=', 1)
+            passphrases[name] = passphrase
+        
+        for name in sorted(set([c.parent.name for c in certs])):
+            if name not in passphrases:
+                passphrases[name] = getpass.getpass('Passphrase of CA "%s": ' % name)
+        
+        result = renew_certificates(certs, passphrases, valid_days=options.get('valid_days'), journal=options.get('journal'))
+        
+        for cert, error in result.failed:
+            sys.stderr.write("Certificate %s (%s) failed: %s\n" % (cert.name, cert.parent.name, error))
+        
+        print "%d of %d certificates renewed (%d skipped)" % (len(result.renewed), len(result), len(result.skipped))
+        
+        if result.failed:
+            raise CommandError( "%d certificates failed" % len(result.failed) )
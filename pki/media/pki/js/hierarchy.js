@@ -0,0 +1,62 @@
+// Render the CA hierarchy from the JSON hierarchy API. Subtrees are loaded on demand
+$(document).ready( function() {
+    
+    function NodeLabel(node) {
+        var label = $("<span/>").text(node.common_name + " (" + node.name + ")");
+        
+        if ( !node.active ) {
+            label.addClass("revoked");
+        }
+        
+        if ( node.expiry_date ) {
+            label.attr("title", "Expires " + node.expiry_date);
+        }
+        
+        return label;
+    }
+    
+    function LoadPage(list, url, page) {
+        $.getJSON(url, { page: page }, function(data) {
+            list.children(".more").remove();
+            
+            $.each(data.nodes, function(i, node) {
+                var item = $("<li/>");
+                
+                if ( node.type == "ca" && node.children > 0 ) {
+                    var sub    = $("<ul/>").hide();
+                    var toggle = $("<img class='switch'/>").attr("src", MEDIA_URL + "pki/img/plus.png");
+                    
+                    toggle.click(function() {
+                        if ( !sub.data("loaded") ) {
+                            sub.data("loaded", true);
+                            LoadPage(sub, node.url, 1);
+                        }
+                        
+                        sub.toggle();
+                        toggle.attr("src", MEDIA_URL + (sub.is(":visible") ? "pki/img/minus.png" : "pki/img/plus.png"));
+                    });
+                    
+                    item.append(toggle).append(NodeLabel(node)).append(" [" + node.children + "]").append(sub);
+                }
+                else {
+                    item.append(NodeLabel(node));
+                }
+                
+                list.append(item);
+            });
+            
+            if ( data.page < data.pages ) {
+                var more = $("<li class='more'><a href='#'>" + (data.count - data.page * data.nodes.length) + " more ...</a></li>");
+                
+                more.find("a").click(function() {
+                    LoadPage(list, url, data.page + 1);
+                    return false;
+                });
+                
+                list.append(more);
+            }
+        });
+    }
+    
+    LoadPage($("#pki_hierarchy"), HIERARCHY_URL, 1);
+});
@@ -69,6 +69,39 @@ class PkiExceptionMiddleware(object):
         logger.error( '' )
         logger.error( _get_traceback(exc_info) )
 
+class PkiChangelogMiddleware(object):
+    """Collect the changelogs written during a request and save them with bulk inserts.
+    
+    The entries are dropped when the view raises, as its changes are rolled back.
+    """
+    
+    def process_request(self, request):
+        from pki.models import ChangelogWriter, reset_changelog_writers
+        
+        ## Writers of an earlier request on this thread that never reached process_response
+        stale = reset_changelog_writers()
+        if stale:
+            logger.warning( "Dropped %d stale changelog writer(s)" % stale )
+        
+        request.pki_changelog_writer = ChangelogWriter()
+        request.pki_changelog_writer.open()
+    
+    def process_exception(self, request, exception):
+        writer = getattr(request, 'pki_changelog_writer', None)
+        
+        if writer is not None:
+            del request.pki_changelog_writer
+            writer.cancel()
+    
+    def process_response(self, request, response):
+        writer = getattr(request, 'pki_changelog_writer', None)
+        
+        if writer is not None:
+            del request.pki_changelog_writer
+            writer.close()
+        
+        return response
+
 def _get_traceback(self, exc_info=None):
     """Helper function to return the traceback as a string"""
     import traceback
@@ -1,23 +1,49 @@
 import os
 import re
+import uuid
 import datetime
+import threading
 from logging import getLogger
 
-from django.db import models
-from django.core import urlresolvers
+from django.db import models, transaction, connection
+from django.db.models.query import QuerySet
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 from django.core.validators import MinLengthValidator, MinValueValidator, RegexValidator, URLValidator
 from django.core.exceptions import ValidationError
 from django.contrib.admin.filterspecs import FilterSpec, RelatedFilterSpec
 
-from pki.helper import get_pki_icon_html
-from pki.openssl import Openssl, md5_constructor, refresh_pki_metadata
+from pki.helper import get_pki_icon_html, url_for_id, url_for_name, CATree
+from pki.openssl import get_openssl, md5_constructor, refresh_pki_metadata, refresh_ca_metadata, \
+                        remove_ca_metadata, refresh_x509_metadata, update_crl
 from pki.settings import MEDIA_URL, PKI_DEFAULT_COUNTRY, PKI_ENABLE_GRAPHVIZ, \
-                         PKI_ENABLE_EMAIL, PKI_PASSPHRASE_MIN_LENGTH, PKI_DEFAULT_KEY_LENGTH
+                         PKI_ENABLE_EMAIL, PKI_PASSPHRASE_MIN_LENGTH, PKI_DEFAULT_KEY_LENGTH, PKI_CACHE_TIMEOUT
 
 logger = getLogger("pki")
 
+##------------------------------------------------------------------##
+## Managers
+##------------------------------------------------------------------##
+
+class CertificateQuerySet(QuerySet):
+    """QuerySet of CertificateAuthority and Certificate objects"""
+    
+    def for_changelist(self):
+        """Fetch everything the admin changelist renders per row (parent, x509 extension) in the same query"""
+        
+        return self.select_related('parent', 'extension')
+
+class CertificateManager(models.Manager):
+    """Manager for CertificateAuthority and Certificate"""
+    
+    def get_query_set(self):
+        return CertificateQuerySet(self.model, using=self._db)
+    
+    def for_changelist(self):
+        return self.get_query_set().for_changelist()
+
 ##------------------------------------------------------------------##
 ## Custom filters
 ##------------------------------------------------------------------##
@@ -38,10 +64,13 @@ class x509ExtensionFilterSpec(RelatedFilterSpec):
         self.lookup_kwarg = '%s__%s__exact' % (f.name, rel_name)
         self.lookup_val = request.GET.get(self.lookup_kwarg, None)
         if str(f.name) == 'extension':
+            ## Choices come from the cached extension data. No query per changelist request
+            extensions = x509_extension_data()
+            
             if str(model._meta) == 'pki.certificateauthority':
-                self.lookup_choices = set([(i.pk, i.name) for i in x509Extension.objects.filter(basic_constraints__startswith="CA:TRUE")])
+                self.lookup_choices = set([(pk, e['name']) for pk, e in extensions.items() if e['basic_constraints'].startswith("CA:TRUE")])
             elif str(model._meta) == 'pki.certificate':
-                self.lookup_choices = set([(i.pk, i.name) for i in x509Extension.objects.exclude(extended_key_usage=None)])
+                self.lookup_choices = set([(pk, e['name']) for pk, e in extensions.items() if e['extended_key_usage']])
         else:
             self.lookup_choices = f.get_choices(include_blank=False)
 
@@ -150,11 +179,11 @@ class CertificateBase(models.Model):
     email        = models.EmailField(blank=True, null=True)
     valid_days   = models.IntegerField(validators=[MinValueValidator(1)])
     key_length   = models.IntegerField(choices=KEY_LENGTH, default=PKI_DEFAULT_KEY_LENGTH)
-    expiry_date  = models.DateField(blank=True,null=True)
-    created      = models.DateTimeField(blank=True,null=True)
-    revoked      = models.DateTimeField(blank=True,null=True)
-    active       = models.BooleanField(default=True, help_text="Turn off to revoke this certificate")
-    serial       = models.CharField(max_length=64, blank=True, null=True)
+    expiry_date  = models.DateField(blank=True, null=True, db_index=True)
+    created      = models.DateTimeField(blank=True, null=True, db_index=True)
+    revoked      = models.DateTimeField(blank=True, null=True, db_index=True)
+    active       = models.BooleanField(default=True, db_index=True, help_text="Turn off to revoke this certificate")
+    serial       = models.CharField(max_length=64, blank=True, null=True, db_index=True)
     ca_chain     = models.CharField(max_length=200, blank=True, null=True)
     der_encoded  = models.BooleanField(default=False, verbose_name="DER encoding")
     action       = models.CharField(max_length=32, choices=ACTIONS, default='create', help_text="Yellow fields can/have to be modified!")
@@ -164,6 +193,10 @@ class CertificateBase(models.Model):
     
     extension.x509extension_filter = True
     
+    objects      = CertificateManager()
+    
+    ## Composite indexes on (parent, active, expiry_date) and (active, expiry_date) are
+    ## created by migration 0016 as Django has no Meta option for them
     class Meta:
         abstract = True
     
@@ -276,7 +309,7 @@ class CertificateBase(models.Model):
         """
         
         if PKI_ENABLE_GRAPHVIZ:
-            return '<a href="%s" target="_blank">%s</a>' % (urlresolvers.reverse('pki:chain', kwargs={'model': self.__class__.__name__.lower(), 'id': self.pk}), \
+            return '<a href="%s" target="_blank">%s</a>' % (url_for_id('pki:chain', self.pk, {'model': self.__class__.__name__.lower()}), \
                                             get_pki_icon_html('chain.png', "Show object chain", id="chain_link_%d" % self.pk))
         else:
             return get_pki_icon_html("chain.png", "Enable setting PKI_ENABLE_GRAPHVIZ")
@@ -298,7 +331,7 @@ class CertificateBase(models.Model):
             return get_pki_icon_html("mail--arrow_bw.png", "Certificate is revoked. Disabled", id="email_delivery_%d" % self.pk)
         else:
             if self.email:
-                return '<a href="%s">%s</a>' % (urlresolvers.reverse('pki:email', kwargs={'model': self.__class__.__name__.lower(), 'id': self.pk}), \
+                return '<a href="%s">%s</a>' % (url_for_id('pki:email', self.pk, {'model': self.__class__.__name__.lower()}), \
                                                 get_pki_icon_html("mail--arrow.png", "Send to '<strong>%s</strong>'" % self.email, \
                                                                        id="email_delivery_%d" % self.pk))
             else:
@@ -314,7 +347,7 @@ class CertificateBase(models.Model):
         """
         
         if self.active:
-            return '<a href="%s">%s</a>' % (urlresolvers.reverse('pki:download', kwargs={'model': self.__class__.__name__.lower(), 'id': self.pk}), \
+            return '<a href="%s">%s</a>' % (url_for_id('pki:download', self.pk, {'model': self.__class__.__name__.lower()}), \
                                             get_pki_icon_html("drive-download.png", "Download certificate zip", id="download_link_%d" % self.pk))
         else:
             return get_pki_icon_html("drive-download_bw.png", "Certificate is revoked. Disabled", id="download_link_%d" % self.pk)
@@ -329,9 +362,9 @@ class CertificateBase(models.Model):
         """
         
         if self.parent:
-            return '<a href="%s">%s</a>' % (urlresolvers.reverse('admin:pki_certificateauthority_change', args=(self.parent.pk,)), self.parent.common_name)
+            return '<a href="%s">%s</a>' % (url_for_id('admin:pki_certificateauthority_change', self.parent_id), self.parent.common_name)
         else:
-            return '<a href="%s">self-signed</a>' % (urlresolvers.reverse('admin:pki_%s_change' % self.__class__.__name__.lower(), args=(self.pk,)))
+            return '<a href="%s">self-signed</a>' % (url_for_id('admin:pki_%s_change' % self.__class__.__name__.lower(), self.pk))
     
     Parent_link.allow_tags = True
     Parent_link.short_description = 'Parent'
@@ -341,8 +374,8 @@ class CertificateBase(models.Model):
         """Dump of the certificate"""
         
         if self.pk and self.active:
-            a = Openssl(self)
-            return "<textarea id=\"certdump\">%s</textarea>" % a.dump_certificate()
+            a = get_openssl(self)
+            return "<textarea id=\"certdump\">%s</textarea>" % a.cached_dump_certificate()
         else:
             return "Nothing to display"
     
@@ -357,14 +390,28 @@ class CertificateBase(models.Model):
     CA_Clock.short_description = "CA clock"
     
     def Update_Changelog(self, obj, user, action, changes):
-        """Update changelog for given object"""
+        """Update changelog for given object.
         
-        PkiChangelog(model_id=ContentType.objects.get_for_model(obj).pk, object_id=obj.pk, action=action, user=user, changes="; ".join(changes)).save()
+        The entry goes to self.changelog_writer or the writer opened in the current
+        thread (see ChangelogWriter) and is only saved directly when there is none.
+        """
+        
+        writer = getattr(self, 'changelog_writer', None) or current_changelog_writer()
+        
+        if writer is not None:
+            writer.add(obj, user, action, changes)
+        else:
+            PkiChangelog(model_id=changelog_model_id(obj), object_id=obj.pk, action=action, user=user, changes="; ".join(changes)).save()
     
     def Delete_Changelog(self, obj):
-        """Delete changelogs for a given object"""
+        """Delete changelogs for a given object (including the ones not written yet)"""
+        
+        writer = getattr(self, 'changelog_writer', None) or current_changelog_writer()
         
-        PkiChangelog.objects.filter(model_id=ContentType.objects.get_for_model(obj).pk, object_id=obj.pk).delete()
+        if writer is not None:
+            writer.discard(obj)
+        
+        PkiChangelog.objects.filter(model_id=changelog_model_id(obj), object_id=obj.pk).delete()
     
 ##------------------------------------------------------------------##
 ## Certificate authority class
@@ -381,6 +428,7 @@ class CertificateAuthority(CertificateBase):
     name              = models.CharField(max_length=64, unique=True, validators=[RegexValidator("[a-zA-Z0-9-_\.]+", message='Name may only contain characters in range a-Z0-9_-.')], \
                                          help_text="Only change the suggestion if you really know what you're doing")
     parent            = models.ForeignKey('self', blank=True, null=True)
+    path              = models.CharField(max_length=255, blank=True, null=True, db_index=True, editable=False)
     passphrase        = models.CharField(max_length=255, blank=True, validators=[MinLengthValidator(PKI_PASSPHRASE_MIN_LENGTH)],  help_text="At least 8 characters. Remeber this passphrase - <font color='red'> \
                                                                     <strong>IT'S NOT RECOVERABLE</strong></font><br>Will be shown as md5 encrypted string")
     parent_passphrase = models.CharField(max_length=255, null=True, blank=True, help_text="Leave empty if this is a top-level CA")
@@ -413,7 +461,7 @@ class CertificateAuthority(CertificateBase):
         
         if self.pk:
             if self.action in ('update', 'revoke', 'renew'):
-                action = Openssl(self)
+                action = get_openssl(self)
                 prev   = CertificateAuthority.objects.get(pk=self.pk)
                 
                 if self.action in ('revoke', 'renew'):
@@ -421,9 +469,9 @@ class CertificateAuthority(CertificateBase):
                         if not self.parent:
                             raise Exception( "You cannot revoke a self-signed certificate! No parent => No revoke" )
                         
-                        ## Revoke and generate CRL
+                        ## Revoke and update CRL
                         action.revoke_certificate(self.parent_passphrase)
-                        action.generate_crl(self.parent.name, self.parent_passphrase)
+                        update_crl(action, self.parent.name, self.parent_passphrase)
                         
                         ## Modify fields
                         prev.active            = False
@@ -434,10 +482,9 @@ class CertificateAuthority(CertificateBase):
                     elif self.action == 'renew':
                         c_list.append('Renewed certificate "%s"' % self.common_name)
                         
-                        ## Revoke if certificate is active
+                        ## Revoke if certificate is active. The parent CRL is updated once after signing
                         if self.parent and not action.get_revoke_status_from_cert():
                             action.revoke_certificate(self.parent_passphrase)
-                            action.generate_crl(self.parent.name, self.parent_passphrase)
                         
                         ## Rebuild the ca metadata
                         self.rebuild_ca_metadata(modify=True, task='replace')
@@ -445,11 +492,11 @@ class CertificateAuthority(CertificateBase):
                         ## Renew certificate and update CRL
                         if self.parent == None:
                             action.generate_self_signed_cert()
-                            action.generate_crl(self.name, self.passphrase)
+                            update_crl(action, self.name, self.passphrase, force=True)
                         else:
                             action.generate_csr()
                             action.sign_csr()
-                            action.generate_crl(self.parent.name, self.parent_passphrase)
+                            update_crl(action, self.parent.name, self.parent_passphrase)
                         
                         action.update_ca_chain_file()
                         
@@ -459,7 +506,7 @@ class CertificateAuthority(CertificateBase):
                         prev.expiry_date = datetime.datetime.now() + delta
                         
                         if prev.valid_days != self.valid_days:
-                            c_list.append("Changed valid days to %d" % (prev.valid_days, self.valid_days))
+                            c_list.append("Changed valid days from %d to %d" % (prev.valid_days, self.valid_days))
                         
                         prev.valid_days  = self.valid_days
                         prev.active      = True
@@ -482,32 +529,8 @@ class CertificateAuthority(CertificateBase):
                         prev.serial = action.get_serial_from_cert()
                         c_list.append("Serial number changed to %s" % prev.serial)
                         
-                    ## DB-revoke all related certs
-                    garbage = []
-                    id_dict = { 'cert': [], 'ca': [], }
-                    
-                    from pki.views import chain_recursion as r_chain_recursion
-                    r_chain_recursion(self.id, garbage, id_dict)
-                    
-                    for i in id_dict['cert']:
-                        x = Certificate.objects.get(pk=i)
-                        x.active         = False
-                        x.der_encoded    = False
-                        x.pkcs12_encoded = False
-                        x.revoked        = datetime.datetime.now()
-                        
-                        super(Certificate, x).save(*args, **kwargs)
-                        self.Update_Changelog(obj=x, user=c_user, action='broken', changes=(['Broken by %s of CA "%s"' % (c_action, self.common_name),]))
-                    
-                    for i in id_dict['ca']:
-                        x = CertificateAuthority.objects.get(pk=i)
-                        x.active      = False
-                        x.der_encoded = False
-                        x.revoked     = datetime.datetime.now()
-                        
-                        super(CertificateAuthority, x).save(*args, **kwargs)
-                        if x.pk != self.pk:
-                            self.Update_Changelog(obj=x, user=c_user, action='broken', changes=(['Broken by %s of CA "%s"' % (c_action, self.common_name),]))
+                    ## DB-revoke all related certs and CA's
+                    self.revoke_subtree(user=c_user, action=c_action)
                 
                 ## Update description. This is always allowed
                 if prev.description != self.description:
@@ -542,7 +565,7 @@ class CertificateAuthority(CertificateBase):
             self.rebuild_ca_metadata(modify=True, task='append')
             
             ## Generate keys and certificates
-            action = Openssl(self)
+            action = get_openssl(self)
             action.generate_key()
             
             if not self.parent:
@@ -554,36 +577,20 @@ class CertificateAuthority(CertificateBase):
             if self.der_encoded:
                 action.generate_der_encoded()
             
-            ## Generate CRL
-            action.generate_crl(self.name, self.passphrase)
+            ## Generate the initial CRL right away, it has to exist for the CA to be usable
+            update_crl(action, self.name, self.passphrase, force=True)
             
             ## Get the serial from certificate
             self.serial = action.get_serial_from_cert()
             
-            ## Generate ca chain (db field and chain file)
-            chain = []
-            chain_str = ''
-            
-            p = self.parent
-            
+            ## Generate ca chain (db field and chain file). All parents are fetched with one query
             if self.parent == None:
-                chain.append('self-signed')
+                chain = ['self-signed']
             else:
+                chain = [p.common_name for p in self.ancestors()]
                 chain.append( self.common_name )
-                while p != None:
-                    chain.append(p.common_name)
-                    p = p.parent
-            
-            chain.reverse()
-            
-            ## Build chain string and file
-            for i in chain:
-                if chain_str == '':
-                    chain_str += '%s' % i
-                else:
-                    chain_str += '&nbsp;&rarr;&nbsp;%s' % i
             
-            self.ca_chain = chain_str
+            self.ca_chain = '&nbsp;&rarr;&nbsp;'.join(chain)
             action.update_ca_chain_file()
             
             ## Encrypt passphrase and blank parent's passphrase
@@ -598,6 +605,11 @@ class CertificateAuthority(CertificateBase):
         ## Save the data
         super(CertificateAuthority, self).save(*args, **kwargs)
         
+        ## The path contains the pk, so it can only be set for new objects after the insert
+        if not self.path:
+            self.path = self.build_path()
+            CertificateAuthority.objects.filter(pk=self.pk).update(path=self.path)
+        
         ## Update changelog
         self.Update_Changelog(obj=self, user=c_user, action=c_action, changes=c_list)
     
@@ -612,31 +624,19 @@ class CertificateAuthority(CertificateBase):
         ## Is a revoke required?
         revoke_required = True
         
-        ## Helper function for recusion
-        def chain_recursion(r_id):
-            
-            ca = CertificateAuthority.objects.get(pk=r_id)
-            self.remove_chain.append(ca.pk)
-            
-            ## Search for related CA's
-            child_cas = CertificateAuthority.objects.filter(parent=r_id)
-            if child_cas:
-                for ca in child_cas:
-                    chain_recursion(ca.pk)
-        
         if not self.parent:
             logger.info( "No revoking of certitifcates. %s is a toplevel CA" % self.name )
             revoke_required = False
         
-        ## Collect child CA's and certificates
-        chain_recursion(self.pk)
+        ## Collect child CA's
+        self.remove_chain = list(self.subtree().values_list("pk", flat=True))
         logger.info( "Full chain is %s and pf is %s" % (self.remove_chain, self.passphrase))
         
         ## Remoke first ca in the chain
         if revoke_required:
-            a = Openssl(CertificateAuthority.objects.get(pk=self.pk))
+            a = get_openssl(CertificateAuthority.objects.get(pk=self.pk))
             a.revoke_certificate(passphrase)
-            a.generate_crl(ca=self.parent.name, pf=passphrase)
+            update_crl(a, self.parent.name, passphrase)
         
         ## Rebuild the ca metadata
         self.rebuild_ca_metadata(modify=True, task='exclude', skip_list=self.remove_chain)
@@ -652,7 +652,24 @@ class CertificateAuthority(CertificateBase):
     ##---------------------------------##
     
     def rebuild_ca_metadata(self, modify, task, skip_list=[]):
-        """Wrapper around refresh_pki_metadata"""
+        """Wrapper around refresh_pki_metadata.
+        
+        append/replace only update this CA and exclude only removes the CAs in skip_list.
+        Falls back to a full refresh when openssl.conf cannot be patched.
+        """
+        
+        if modify:
+            if task in ('append', 'replace'):
+                if refresh_ca_metadata(self):
+                    return
+            elif task == 'exclude':
+                names = set(CertificateAuthority.objects.filter(pk__in=skip_list).values_list('name', flat=True))
+                
+                if self.pk in skip_list:
+                    names.add(self.name)
+                
+                if remove_ca_metadata(names):
+                    return
         
         if modify:
             if task == 'append':
@@ -675,6 +692,85 @@ class CertificateAuthority(CertificateBase):
         
         return "pathlen:0" in self.extension.basic_constraints.lower()
     
+    def build_path(self):
+        """Return the materialized path ("/<root pk>/.../<own pk>/") of a saved CA"""
+        
+        return '/%s/' % '/'.join([str(i) for i in self.ancestor_ids() + [self.pk]])
+    
+    def ancestor_ids(self):
+        """Return the pk's of all parent CA's, top-level CA first"""
+        
+        if self.path:
+            return [int(i) for i in self.path.strip('/').split('/')[:-1]]
+        
+        ## Not saved yet (or created before paths existed)
+        if self.parent_id:
+            return self.parent.ancestor_ids() + [self.parent_id]
+        
+        return []
+    
+    def ancestors(self):
+        """Return all parent CA's, top-level CA first. Done with one query"""
+        
+        ids = self.ancestor_ids()
+        
+        if not ids:
+            return []
+        
+        cas = CertificateAuthority.objects.select_related('extension').in_bulk(ids)
+        return [cas[i] for i in ids]
+    
+    def subtree(self):
+        """Return a QuerySet of this CA and all CA's below it (one indexed query)"""
+        
+        if not self.path:
+            return CertificateAuthority.objects.filter(pk__in=[ca.pk for ca in CATree(self.pk).walk()])
+        
+        return CertificateAuthority.objects.filter(path__startswith=self.path)
+    
+    def descendants(self):
+        """Return a QuerySet of all CA's below this one"""
+        
+        return self.subtree().exclude(pk=self.pk)
+    
+    def revoke_subtree(self, user, action):
+        """Mark this CA, all CA's below it and their certificates as revoked in the DB.
+        
+        Uses one UPDATE per model and bulk inserted changelogs, independent of the number
+        of affected objects. Transactions are left to the caller (e.g. TransactionMiddleware).
+        When a ChangelogWriter is active, the changelogs are written when it is closed.
+        """
+        
+        now      = datetime.datetime.now()
+        subtree  = self.subtree()
+        certs    = Certificate.objects.filter(parent__in=subtree)
+        changes  = 'Broken by %s of CA "%s"' % (action, self.common_name)
+        
+        ## Collect the ids for the changelog before the update
+        ca_ids   = [pk for pk in subtree.values_list('pk', flat=True) if pk != self.pk]
+        cert_ids = list(certs.values_list('pk', flat=True))
+        
+        certs.update(active=False, der_encoded=False, pkcs12_encoded=False, revoked=now)
+        subtree.update(active=False, der_encoded=False, revoked=now)
+        
+        ## Use the active writer if any, so the entries are part of its bulk insert
+        writer = getattr(self, 'changelog_writer', None) or current_changelog_writer()
+        flush  = writer is None
+        
+        if flush:
+            writer = ChangelogWriter()
+        
+        writer.add_many(Certificate, cert_ids, user, 'broken', changes)
+        writer.add_many(CertificateAuthority, ca_ids, user, 'broken', changes)
+        
+        if flush:
+            writer.flush()
+        
+        ## update() doesn't send signals
+        bump_hierarchy_version(self)
+        
+        logger.info( "%s of CA %s broke %d CA's and %d certificates" % (action, self.name, len(ca_ids), len(cert_ids)) )
+    
     ##---------------------------------##
     ## View functions
     ##---------------------------------##
@@ -682,10 +778,12 @@ class CertificateAuthority(CertificateBase):
     def Tree_link(self):
         
         if PKI_ENABLE_GRAPHVIZ:
-            return '<a href="%s" target="_blank">%s</a>' % (urlresolvers.reverse('pki:tree', kwargs={'id': self.pk}), \
+            return '<a href="%s" target="_blank">%s</a>' % (url_for_id('pki:tree', self.pk, {}) + '?format=svg', \
                                                             get_pki_icon_html("tree.png", "Show CA tree", id="tree_link_%d" % self.pk))
         else:
-            return get_pki_icon_html("tree_disabled.png", "Enable setting PKI_ENABLE_GRAPHVIZ")
+            ## Tree rendered by the browser from the JSON hierarchy API
+            return '<a href="%s" target="_blank">%s</a>' % (url_for_id('pki:browse', self.pk, {}), \
+                                                            get_pki_icon_html("tree.png", "Show CA tree", id="tree_link_%d" % self.pk))
     
     Tree_link.allow_tags = True
     Tree_link.short_description = 'Tree'
@@ -696,7 +794,7 @@ class CertificateAuthority(CertificateBase):
         if not self.is_edge_ca():
             return get_pki_icon_html("blue-document-tree_bw.png", "No children", id="show_child_certs_%d" % self.pk)
         else:
-            return "<a href=\"%s\" target=\"_blank\">%s</a>" % ('?'.join([urlresolvers.reverse('admin:pki_certificate_changelist'), 'parent__id__exact=%d' % self.pk]), \
+            return "<a href=\"%s\" target=\"_blank\">%s</a>" % ('?'.join([url_for_name('admin:pki_certificate_changelist'), 'parent__id__exact=%d' % self.pk]), \
                                                                 get_pki_icon_html("blue-document-tree.png", "Show child certificates", \
                                                                                        id="show_child_certs_%d" % self.pk))
     
@@ -747,7 +845,7 @@ class Certificate(CertificateBase):
         
         if self.pk:
             if self.action in ('update', 'revoke', 'renew'):
-                action = Openssl(self)
+                action = get_openssl(self)
                 prev   = Certificate.objects.get(pk=self.pk)
                 
                 if self.action == 'revoke':
@@ -756,7 +854,7 @@ class Certificate(CertificateBase):
                     
                     ## Revoke and generate CRL
                     action.revoke_certificate(self.parent_passphrase)
-                    action.generate_crl(self.parent.name, self.parent_passphrase)
+                    update_crl(action, self.parent.name, self.parent_passphrase)
                     
                     ## Modify fields
                     prev.active            = False
@@ -770,15 +868,14 @@ class Certificate(CertificateBase):
                     ## Revoke if certificate is active
                     if self.parent and not action.get_revoke_status_from_cert():
                         action.revoke_certificate(self.parent_passphrase)
-                        action.generate_crl(self.parent.name, self.parent_passphrase)
                     
-                    ## Renew certificate and update CRL
+                    ## Renew certificate and update CRL (once per batch when a CRLBatch is open)
                     if self.parent == None:
                         action.generate_self_signed_cert()
                     else:
                         action.generate_csr()
                         action.sign_csr()
-                        action.generate_crl(self.parent.name, self.parent_passphrase)
+                        update_crl(action, self.parent.name, self.parent_passphrase)
                     
                     ## Modify fields
                     prev.created     = datetime.datetime.now()
@@ -786,7 +883,7 @@ class Certificate(CertificateBase):
                     prev.expiry_date = datetime.datetime.now() + delta
                     
                     if prev.valid_days != self.valid_days:
-                        c_list.append("Changed valid days to %d" % (prev.valid_days, self.valid_days))
+                        c_list.append("Changed valid days from %d to %d" % (prev.valid_days, self.valid_days))
                     
                     prev.valid_days  = self.valid_days
                     prev.active      = True
@@ -857,7 +954,7 @@ class Certificate(CertificateBase):
             logger.info( "***** { New certificate generation: %s } *****" % self.name )
             
             ## Generate key and certificate
-            action = Openssl(self)
+            action = get_openssl(self)
             action.generate_key()
             
             if self.parent:
@@ -900,11 +997,11 @@ class Certificate(CertificateBase):
         """Delete the Certificate object"""
         
         ## Time for some rm action
-        a = Openssl(self)
+        a = get_openssl(self)
         
         if self.parent:
             a.revoke_certificate(passphrase)
-            a.generate_crl(ca=self.parent.name, pf=passphrase)
+            update_crl(a, self.parent.name, passphrase)
         
         a.remove_complete_certificate()
         
@@ -931,6 +1028,169 @@ class PkiChangelog(models.Model):
     def __unicode__(self):
         return str(self.pk)
 
+class PkiEmail(models.Model):
+    """Outbox of certificate data emails. Delivered by "manage.py pki_email" (see pki.email)"""
+    
+    STATUS_CHOICES = ( ('queued', 'queued'), ('sending', 'sending'), ('sent', 'sent'), ('failed', 'failed'), )
+    
+    model_id     = models.IntegerField()
+    object_id    = models.IntegerField()
+    recipient    = models.CharField(max_length=255)
+    user         = models.ForeignKey(User, blank=True, null=True)
+    status       = models.CharField(max_length=16, choices=STATUS_CHOICES, default='queued')
+    attempts     = models.IntegerField(default=0)
+    created      = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=datetime.datetime.now)
+    sent         = models.DateTimeField(blank=True, null=True)
+    last_error   = models.TextField(blank=True)
+    
+    ## The composite index on (status, next_attempt) used by the worker is created by migration 0017.
+    ## While status is "sending", next_attempt is the end of the delivery worker's lease
+    class Meta:
+        db_table = 'pki_email'
+        ordering = ['next_attempt']
+    
+    def __unicode__(self):
+        return str(self.pk)
+
+##------------------------------------------------------------------##
+## Changelog writer
+##------------------------------------------------------------------##
+
+## Changelogs per bulk insert. Keeps the number of query parameters below SQLite's limit
+CHANGELOG_BATCH_SIZE = 100
+
+## ContentType ids by model, resolved once per process
+_changelog_model_ids = {}
+
+## Writers opened in the current thread
+_changelog_state = threading.local()
+
+def changelog_model_id(obj):
+    """Return the ContentType id used as PkiChangelog.model_id for a model or instance"""
+    
+    if isinstance(obj, type):
+        model = obj
+    else:
+        model = obj.__class__
+    
+    if model not in _changelog_model_ids:
+        _changelog_model_ids[model] = ContentType.objects.get_for_model(model).pk
+    
+    return _changelog_model_ids[model]
+
+def current_changelog_writer():
+    """Return the ChangelogWriter opened last in this thread or None"""
+    
+    writers = getattr(_changelog_state, 'writers', None)
+    
+    if writers:
+        return writers[-1]
+    
+    return None
+
+class ChangelogWriter(object):
+    """Buffer PkiChangelog entries and write them with bulk inserts.
+    
+    While a writer is open, Update_Changelog of all objects in the current thread adds
+    to it. close() (or flush()) writes the entries. Used per request by
+    PkiChangelogMiddleware and per run by bulk operations.
+    """
+    
+    def __init__(self):
+        self.entries = []
+    
+    def add(self, obj, user, action, changes):
+        """Add an entry for obj. changes is a list of strings"""
+        
+        self.entries.append(PkiChangelog(model_id=changelog_model_id(obj), object_id=obj.pk, action=action, user=user, changes="; ".join(changes)))
+    
+    def add_many(self, model, ids, user, action, changes):
+        """Add the same change (a string) for all ids of model"""
+        
+        model_id = changelog_model_id(model)
+        
+        for i in ids:
+            self.entries.append(PkiChangelog(model_id=model_id, object_id=i, action=action, user=user, changes=changes))
+    
+    def discard(self, obj):
+        """Drop the buffered entries of obj"""
+        
+        model_id = changelog_model_id(obj)
+        self.entries = [e for e in self.entries if not (e.model_id == model_id and e.object_id == obj.pk)]
+    
+    def flush(self):
+        """Save all buffered entries"""
+        
+        entries, self.entries = self.entries, []
+        save_changelogs(entries)
+    
+    def open(self):
+        """Make this the active writer of the current thread"""
+        
+        if not hasattr(_changelog_state, 'writers'):
+            _changelog_state.writers = []
+        
+        _changelog_state.writers.append(self)
+    
+    def deactivate(self):
+        """Remove the writer from the active writers of the current thread"""
+        
+        writers = getattr(_changelog_state, 'writers', [])
+        
+        if self in writers:
+            writers.remove(self)
+    
+    def close(self):
+        """Deactivate the writer and save the buffered entries"""
+        
+        self.deactivate()
+        self.flush()
+    
+    def cancel(self):
+        """Deactivate the writer and drop the buffered entries (e.g. after a rollback)"""
+        
+        self.deactivate()
+        self.entries = []
+
+def reset_changelog_writers():
+    """Drop all writers left open in the current thread. Returns their number"""
+    
+    writers = getattr(_changelog_state, 'writers', [])
+    _changelog_state.writers = []
+    
+    for writer in writers:
+        writer.entries = []
+    
+    return len(writers)
+
+def bulk_insert(model, objs, batch_size):
+    """Insert the unsaved model instances objs with one executemany() per batch_size objects.
+    
+    Works on all supported Django versions (bulk_create needs Django 1.4). Field defaults,
+    auto_now and auto_now_add are applied like on save(), but no signals are sent and the
+    primary keys of objs are not set.
+    """
+    
+    if not objs:
+        return
+    
+    fields  = [f for f in model._meta.local_fields if not isinstance(f, models.AutoField)]
+    columns = ', '.join([connection.ops.quote_name(f.column) for f in fields])
+    sql     = 'INSERT INTO %s (%s) VALUES (%s)' % (connection.ops.quote_name(model._meta.db_table), columns, ', '.join(['%s'] * len(fields)))
+    cursor  = connection.cursor()
+    
+    for i in range(0, len(objs), batch_size):
+        rows = [[f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields] for obj in objs[i:i+batch_size]]
+        cursor.executemany(sql, rows)
+    
+    transaction.commit_unless_managed()
+
+def save_changelogs(entries):
+    """Save a list of PkiChangelog objects with one bulk insert per CHANGELOG_BATCH_SIZE entries"""
+    
+    bulk_insert(PkiChangelog, entries, CHANGELOG_BATCH_SIZE)
+
 class x509Extension(models.Model):
     """x509 extensions"""
     
@@ -980,6 +1240,12 @@ class x509Extension(models.Model):
         
         if not self.pk:
             super(x509Extension, self).save(*args, **kwargs)
+            self.refresh_metadata()
+    
+    def refresh_metadata(self):
+        """Update the extension's section in openssl.conf"""
+        
+        if not refresh_x509_metadata(self):
             refresh_pki_metadata(CertificateAuthority.objects.all())
     
     def CrlDpoint_center(self):
@@ -997,12 +1263,26 @@ class x509Extension(models.Model):
         
         return "CA:TRUE" in self.basic_constraints.upper()
     
+    def usage_names(self):
+        """Return (key usage names, extended key usage names). Taken from x509_extension_data"""
+        
+        data = x509_extension_data()
+        
+        ## Created after the data was cached or not saved yet
+        if self.pk not in data:
+            if not self.pk:
+                return ([], [])
+            
+            forget_x509_extension_data()
+            data = x509_extension_data()
+        
+        return (data[self.pk]['key_usage'], data[self.pk]['extended_key_usage'])
+    
     def key_usage_csv(self):
         r = []
         if self.key_usage_critical:
             r.append('critical')
-        for x in self.key_usage.all():
-            r.append(x.name)
+        r.extend(self.usage_names()[0])
         return ",".join(r)
     
     key_usage_csv.short_description = 'Key Usage'
@@ -1011,12 +1291,119 @@ class x509Extension(models.Model):
         r = []
         if self.extended_key_usage_critical:
             r.append('critical')
-        for x in self.extended_key_usage.all():
-            r.append(x.name)
+        r.extend(self.usage_names()[1])
         return ",".join(r)
     
     ext_key_usage_csv.short_description = "Extended Key Usage"
     
+##------------------------------------------------------------------##
+## Hierarchy versions
+##------------------------------------------------------------------##
+
+HIERARCHY_VERSION_KEY = 'pki_hierarchy_%s'
+
+def hierarchy_key(obj):
+    """Return the name of the hierarchy (top-level CA or self-signed certificate) obj belongs to"""
+    
+    if isinstance(obj, CertificateAuthority):
+        return 'ca_%d' % (obj.ancestor_ids() or [obj.pk])[0]
+    
+    if obj.parent_id:
+        return hierarchy_key(obj.parent)
+    
+    return 'certificate_%d' % obj.pk
+
+def hierarchy_version(obj):
+    """Return a token that changes whenever a CA or certificate in the hierarchy of obj changes.
+    
+    Used to key data derived from the whole hierarchy, e.g. rendered Graphviz images. The
+    token lives in the Django cache, so it is only reliable across processes with a shared
+    cache (see PKI_SHARED_CACHE).
+    """
+    
+    key     = HIERARCHY_VERSION_KEY % hierarchy_key(obj)
+    version = cache.get(key)
+    
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(key, version, PKI_CACHE_TIMEOUT)
+    
+    return version
+
+def bump_hierarchy_version(obj):
+    """Invalidate everything keyed by the hierarchy version of obj"""
+    
+    cache.set(HIERARCHY_VERSION_KEY % hierarchy_key(obj), uuid.uuid4().hex, PKI_CACHE_TIMEOUT)
+
+def hierarchy_changed(sender, instance, **kwargs):
+    """Signal handler bumping the hierarchy version of a saved or deleted object"""
+    
+    try:
+        bump_hierarchy_version(instance)
+    except CertificateAuthority.DoesNotExist:
+        ## Parent deleted in the same cascade. Its own post_delete bumps the version
+        pass
+
+post_save.connect(hierarchy_changed, sender=CertificateAuthority)
+post_save.connect(hierarchy_changed, sender=Certificate)
+post_delete.connect(hierarchy_changed, sender=CertificateAuthority)
+post_delete.connect(hierarchy_changed, sender=Certificate)
+
+##------------------------------------------------------------------##
+## x509 extension cache
+##------------------------------------------------------------------##
+
+X509_CACHE_KEY = 'pki_x509_extensions'
+
+def x509_extension_data(fresh=False):
+    """Return name, basicConstraints and (extended) key usage names of all x509 extensions by pk.
+    
+    Built with three queries and kept in the Django cache. Extensions cannot be changed
+    after creation, the cache is dropped whenever an extension or usage is saved/deleted.
+    Signals only reach the cache of the current process, other processes see the change
+    only with a shared cache (see PKI_SHARED_CACHE). With fresh the data is read from
+    the database, used before openssl.conf is written.
+    """
+    
+    data = None
+    
+    if not fresh:
+        data = cache.get(X509_CACHE_KEY)
+    
+    if data is None:
+        data = {}
+        
+        for pk, name, bc in x509Extension.objects.values_list('pk', 'name', 'basic_constraints'):
+            data[pk] = { 'name': name, 'basic_constraints': bc, 'key_usage': [], 'extended_key_usage': [], }
+        
+        ## Rows of the m2m tables in the order the usages were added
+        for ext, name in x509Extension.key_usage.through.objects.order_by('pk').values_list('x509extension', 'keyusage__name'):
+            data[ext]['key_usage'].append(name)
+        
+        for ext, name in x509Extension.extended_key_usage.through.objects.order_by('pk').values_list('x509extension', 'extendedkeyusage__name'):
+            data[ext]['extended_key_usage'].append(name)
+        
+        cache.set(X509_CACHE_KEY, data, PKI_CACHE_TIMEOUT)
+    
+    return data
+
+def forget_x509_extension_data(**kwargs):
+    """Drop the cached x509 extension data. Used as signal handler"""
+    
+    cache.delete(X509_CACHE_KEY)
+
+def x509Extension_m2m_changed(sender, instance, action, **kwargs):
+    """Key usages are saved after the extension. Update openssl.conf once they're set"""
+    
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, x509Extension):
+        forget_x509_extension_data()
+        instance.refresh_metadata()
+
+m2m_changed.connect(x509Extension_m2m_changed, sender=x509Extension.key_usage.through)
+m2m_changed.connect(x509Extension_m2m_changed, sender=x509Extension.extended_key_usage.through)
+post_save.connect(forget_x509_extension_data, sender=x509Extension)
+post_delete.connect(forget_x509_extension_data, sender=x509Extension)
+
 class KeyUsage(models.Model):
     """Container table for KeyUsage"""
     
@@ -1032,4 +1419,6 @@ class ExtendedKeyUsage(models.Model):
     
     def __unicode__(self):
         return self.name
-    
\ No newline at end of file
+    
+post_save.connect(forget_x509_extension_data, sender=KeyUsage)
+post_save.connect(forget_x509_extension_data, sender=ExtendedKeyUsage)
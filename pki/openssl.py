@@ -1,18 +1,25 @@
 import os
 import re
 import string
+import fcntl
 import random
+import datetime
+import threading
 
 from subprocess import Popen, PIPE, STDOUT
 from shutil import rmtree
 from logging import getLogger
 
+from django.core.cache import cache
 from django.template.loader import render_to_string
+from django.utils.importlib import import_module
 
 import pki.models
 from pki.helper import subject_for_object
+from pki.keypool import take_key, refill_reservoir
 from pki.settings import PKI_OPENSSL_BIN, PKI_OPENSSL_CONF, PKI_DIR, PKI_OPENSSL_TEMPLATE, \
-                         PKI_SELF_SIGNED_SERIAL, PKI_CA_NAME_BLACKLIST
+                         PKI_SELF_SIGNED_SERIAL, PKI_CA_NAME_BLACKLIST, PKI_OPENSSL_ENGINE, \
+                         PKI_CACHE_TIMEOUT, PKI_CRL_DEFERRED
 
 try:
     # available in python-2.5 and greater
@@ -23,12 +30,16 @@ except ImportError:
 
 logger = getLogger("pki")
 
-def refresh_pki_metadata(ca_list):
-    """Refresh pki metadata (PKI storage directories and openssl configuration files)
+##------------------------------------------------------------------##
+## PKI metadata
+##------------------------------------------------------------------##
 
-    Each ca_list element is a dictionary:
-    'name': CA name
-    """
+## Templates of the openssl.conf sections. Wrapped in BEGIN/END markers to allow incremental updates
+PKI_OPENSSL_CA_TEMPLATE   = 'pki/openssl_ca.conf.in'
+PKI_OPENSSL_X509_TEMPLATE = 'pki/openssl_x509.conf.in'
+
+def create_ca_directory(ca):
+    """Create the directory structure and database files of a CA if it's missing"""
     
     # refresh directory structure
     dirs = { 'certs'  : 0755,
@@ -36,6 +47,118 @@ def refresh_pki_metadata(ca_list):
              'crl'    : 0755,
            }
     
+    ca_dir = os.path.join(PKI_DIR, ca.name)
+    
+    if os.path.isdir(ca_dir):
+        return
+    
+    logger.info("Creating base directory for new CA %s" % ca.name)
+    os.mkdir(ca_dir)
+    
+    # create nested directories for key storage with proper permissions
+    for d, m in dirs.items():
+        os.mkdir(os.path.join(ca_dir, d), m)
+    
+    initial_serial = 0x01
+    
+    try:
+        if not ca.parent and int(PKI_SELF_SIGNED_SERIAL) > 0:
+            initial_serial = PKI_SELF_SIGNED_SERIAL+1 
+    except ValueError:
+        logger.error( "PKI_SELF_SIGNED_SERIAL failed conversion to int!" )
+    
+    h2s = '%X' % initial_serial
+    
+    if len(h2s) % 2 == 1:
+        h2s = '0' + h2s
+    
+    # initialize certificate serial number
+    s = open(os.path.join(ca_dir, 'serial'), 'wb')
+    s.write(h2s)
+    s.close()
+    
+    logger.info("Initial serial number set to %s" % h2s)
+    
+    # initialize CRL serial number
+    s = open(os.path.join(ca_dir, 'crlnumber'), 'wb')
+    s.write('01')
+    s.close()
+    
+    # touch certificate index file
+    open(os.path.join(ca_dir, 'index.txt'), 'wb').close()
+
+def purge_ca_directory(d):
+    """Remove a CA directory tree"""
+    
+    if os.path.isdir(d):
+        # extra check in order to keep unrelated directory from recursive removal...
+        # (in case if something wrong with paths)
+        # probably can be removed when debugging will be finished
+        if os.path.isfile(os.path.join(d, 'crlnumber')):
+            logger.debug("Purging CA directory tree %s" % d)
+            rmtree(d)
+        else:
+            logger.warning('Directory %s does not contain any metadata, preserving it' % d)
+
+def write_openssl_conf(conf):
+    """Write openssl.conf. Skipped when the content is unchanged"""
+    
+    if os.path.exists(PKI_OPENSSL_CONF):
+        f = open(PKI_OPENSSL_CONF, 'rb')
+        old = f.read()
+        f.close()
+        
+        if old == conf:
+            logger.debug("openssl.conf is unchanged")
+            return
+    
+    f = open(PKI_OPENSSL_CONF, 'wb')
+    f.write(conf)
+    f.close()
+
+def patch_openssl_conf(kind, name, section=None):
+    """Replace, add or remove (section=None) a single section of openssl.conf.
+    
+    kind is CA or X509. Returns False when openssl.conf is missing or has no section markers.
+    """
+    
+    if not os.path.exists(PKI_OPENSSL_CONF):
+        return False
+    
+    f = open(PKI_OPENSSL_CONF, 'rb')
+    conf = f.read()
+    f.close()
+    
+    begin    = '## BEGIN %s %s\n' % (kind, name)
+    end      = '## END %s %s\n' % (kind, name)
+    list_end = '## END %s LIST\n' % kind
+    
+    if list_end not in conf:
+        return False
+    
+    b = conf.find(begin)
+    
+    if b != -1:
+        e = conf.find(end, b)
+        
+        if e == -1:
+            return False
+        
+        conf = conf[:b] + (section or '') + conf[e+len(end):]
+    elif section:
+        i = conf.find(list_end)
+        conf = conf[:i] + section + conf[i:]
+    
+    write_openssl_conf(conf)
+    return True
+
+def refresh_pki_metadata(ca_list):
+    """Refresh pki metadata (PKI storage directories and openssl configuration files)
+
+    Each ca_list element is a dictionary:
+    'name': CA name
+    """
+    
     try:
         # create base PKI directory if necessary
         if not os.path.exists(PKI_DIR):
@@ -48,79 +171,483 @@ def refresh_pki_metadata(ca_list):
         
         # loop over CAs and create necessary filesystem objects
         for ca in ca_list:
-            ca_dir = os.path.join(PKI_DIR, ca.name)
-            
-            # create CA directory if necessary
-            if not ca_dir in purge_dirs:
-                logger.info("Creating base directory for new CA %s" % ca.name)
-                os.mkdir(ca_dir)
-                
-                # create nested directories for key storage with proper permissions
-                for d, m in dirs.items():
-                    os.mkdir(os.path.join(ca_dir, d), m)
-                
-                initial_serial = 0x01
-                
-                try:
-                    if not ca.parent and int(PKI_SELF_SIGNED_SERIAL) > 0:
-                        initial_serial = PKI_SELF_SIGNED_SERIAL+1 
-                except ValueError:
-                    logger.error( "PKI_SELF_SIGNED_SERIAL failed conversion to int!" )
-                
-                h2s = '%X' % initial_serial
-                
-                if len(h2s) % 2 == 1:
-                    h2s = '0' + h2s
-                
-                # initialize certificate serial number
-                s = open(os.path.join(ca_dir, 'serial'), 'wb')
-                s.write(h2s)
-                s.close()
-                
-                logger.info("Initial serial number set to %s" % h2s)
-                
-                # initialize CRL serial number
-                s = open(os.path.join(ca_dir, 'crlnumber'), 'wb')
-                s.write('01')
-                s.close()
-                
-                # touch certificate index file
-                open(os.path.join(ca_dir, 'index.txt'), 'wb').close()
+            create_ca_directory(ca)
             
             # do not delete existing CA dir
-            purge_dirs.discard(ca_dir)
+            purge_dirs.discard(os.path.join(PKI_DIR, ca.name))
         
         # purge unused CA directories
         for d in purge_dirs:
-            if os.path.isdir(d):
-                # extra check in order to keep unrelated directory from recursive removal...
-                # (in case if something wrong with paths)
-                # probably can be removed when debugging will be finished
-                if os.path.isfile(os.path.join(d, 'crlnumber')):
-                    logger.debug("Purging CA directory tree %s" % d)
-                    rmtree(d)
-                else:
-                    logger.warning('Directory %s does not contain any metadata, preserving it' % d)
-        
-        x509_list =[]
-        for x509 in pki.models.x509Extension.objects.all():
-            if x509.is_ca():
-                x509.ca = True
-            else:
-                x509.ca = False
-            x509_list.append(x509)
+            purge_ca_directory(d)
         
-        # render template and save result to openssl.conf
-        conf = render_to_string(PKI_OPENSSL_TEMPLATE, {'ca_list': ca_list, 'x509_extensions': x509_list,})
-        
-        f = open(PKI_OPENSSL_CONF, 'wb')
-        f.write(conf)
-        f.close()
+        # render template and save result to openssl.conf. Key usages are read from the DB, a process local cache may be outdated
+        pki.models.x509_extension_data(fresh=True)
+        conf = render_to_string(PKI_OPENSSL_TEMPLATE, {'ca_list': ca_list, 'x509_extensions': pki.models.x509Extension.objects.all(),})
+        write_openssl_conf(conf)
     except Exception, e:
         logger.exception("Refreshing PKI metadata failed: %s" % e)
     
     logger.info("Successfully finished PKI metadata refresh")
 
+def refresh_ca_metadata(ca):
+    """Incremental refresh for a single CA.
+    
+    Creates the CA directory if necessary and replaces or adds the CA's section in openssl.conf.
+    Returns False when openssl.conf cannot be patched and a full refresh is required.
+    """
+    
+    if not os.path.exists(PKI_DIR):
+        return False
+    
+    create_ca_directory(ca)
+    return patch_openssl_conf('CA', ca.name, render_to_string(PKI_OPENSSL_CA_TEMPLATE, {'ca': ca}))
+
+def remove_ca_metadata(names):
+    """Incremental refresh for removed CAs.
+    
+    Purges the CA directories and removes the CA sections from openssl.conf.
+    Returns False when openssl.conf cannot be patched and a full refresh is required.
+    """
+    
+    for name in names:
+        purge_ca_directory(os.path.join(PKI_DIR, name))
+        
+        if not patch_openssl_conf('CA', name):
+            return False
+    
+    return True
+
+def refresh_x509_metadata(x509):
+    """Incremental refresh for a single x509 extension.
+    
+    Returns False when openssl.conf cannot be patched and a full refresh is required.
+    """
+    
+    pki.models.x509_extension_data(fresh=True)
+    return patch_openssl_conf('X509', x509.name, render_to_string(PKI_OPENSSL_X509_TEMPLATE, {'x509': x509}))
+
+def format_serial(serial):
+    """Format a hex serial the way it's stored in the DB.
+    
+    Serials longer than one byte are lowercased and colon separated (0a:1b:...).
+    """
+    
+    if (len(serial) > 2):
+        sl = re.findall('[a-fA-F0-9]{2}', serial.lower())
+        return ':'.join(sl)
+    
+    return serial.lower()
+
+##------------------------------------------------------------------##
+## Parsed certificates
+##------------------------------------------------------------------##
+
+## Short names of the extensions written by django-pki (text dump => short name)
+EXTENSION_NAMES = { 'X509v3 Basic Constraints'         : 'basicConstraints',
+                    'X509v3 Key Usage'                 : 'keyUsage',
+                    'X509v3 Extended Key Usage'        : 'extendedKeyUsage',
+                    'X509v3 Subject Key Identifier'    : 'subjectKeyIdentifier',
+                    'X509v3 Authority Key Identifier'  : 'authorityKeyIdentifier',
+                    'X509v3 Subject Alternative Name'  : 'subjectAltName',
+                    'X509v3 CRL Distribution Points'   : 'crlDistributionPoints',
+                  }
+
+class CertificateInfo(object):
+    """Certificate metadata parsed once per PEM file.
+    
+    serial: Serial in DB format (see format_serial)
+    hash: Subject hash as used for the CA's hash links
+    subject, issuer: Oneline DN (/CN=.../C=...)
+    not_before, not_after: Validity as datetime (UTC)
+    extensions: dict of short extension name => (critical, value)
+    text: Text dump of the certificate
+    """
+    
+    def __init__(self, serial, hash, subject, issuer, not_before, not_after, extensions, text):
+        self.serial     = serial
+        self.hash       = hash
+        self.subject    = subject
+        self.issuer     = issuer
+        self.not_before = not_before
+        self.not_after  = not_after
+        self.extensions = extensions
+        self.text       = text
+
+## Parsed certificates by path: { path: ((mtime, size), CertificateInfo) }
+_certificate_cache = {}
+CERTIFICATE_CACHE_SIZE = 1000
+
+def parsed_certificate(path, parser):
+    """Return the CertificateInfo of path.
+    
+    parser is only called when the file is unknown or was modified since it was parsed.
+    """
+    
+    key    = file_stamp(path)
+    cached = _certificate_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    
+    info = parser()
+    
+    if len(_certificate_cache) >= CERTIFICATE_CACHE_SIZE:
+        _certificate_cache.clear()
+    
+    _certificate_cache[path] = (key, info)
+    return info
+
+def forget_certificate(path):
+    """Drop the parsed certificate and cached dump of path. Called whenever the file is rewritten"""
+    
+    _certificate_cache.pop(path, None)
+    cache.delete(dump_cache_key(path))
+
+def dump_cache_key(path):
+    """Django cache key for the text dump of path"""
+    
+    return 'pki_dump_%s' % md5_constructor(path).hexdigest()
+
+def file_stamp(path):
+    """Return (mtime, size) of path to detect modifications without reading it"""
+    
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+def parse_extensions(text):
+    """Extract the x509v3 extensions from a certificate text dump"""
+    
+    extensions = {}
+    lines = text.split('\n')
+    
+    for i, l in enumerate(lines):
+        if l.strip() == 'X509v3 extensions:':
+            base = len(l) - len(l.lstrip())
+            name = None
+            
+            for e in lines[i+1:]:
+                indent = len(e) - len(e.lstrip())
+                
+                if not e.strip() or indent <= base:
+                    break
+                elif indent == base + 4:
+                    name, sep, flag = e.strip().partition(':')
+                    name = EXTENSION_NAMES.get(name, name)
+                    extensions[name] = (flag.strip() == 'critical', '')
+                elif name:
+                    critical, value = extensions[name]
+                    extensions[name] = (critical, '\n'.join([v for v in (value, e.strip()) if v]))
+            break
+    
+    return extensions
+
+##------------------------------------------------------------------##
+## Revocation index
+##------------------------------------------------------------------##
+
+def serial_to_int(serial):
+    """Convert a serial in DB format (0a:1b:...) or openssl format (0A1B...) to int"""
+    
+    return int(serial.replace(':', ''), 16)
+
+class RevocationIndex(object):
+    """Serials revoked by a CA.
+    
+    Built from the CA's index.txt (the source openssl uses to generate the CRL) and
+    reloaded only when the file was modified by someone else.
+    """
+    
+    def __init__(self, path):
+        self.path    = path
+        self.stamp   = None
+        self.serials = set()
+    
+    def refresh(self):
+        """Reload the index when index.txt was modified"""
+        
+        if not os.path.exists(self.path):
+            self.stamp   = None
+            self.serials = set()
+        elif file_stamp(self.path) != self.stamp:
+            self.stamp = file_stamp(self.path)
+            serials    = set()
+            
+            f = open(self.path, 'r')
+            for line in f:
+                fields = line.split('\t')
+                if fields[0] == 'R':
+                    serials.add(int(fields[3], 16))
+            f.close()
+            
+            self.serials = serials
+    
+    def is_revoked(self, serial):
+        """Return True if serial (int) is revoked"""
+        
+        self.refresh()
+        return serial in self.serials
+    
+    def add(self, serial):
+        """Record a revocation we just did. Avoids a reload of index.txt"""
+        
+        self.serials.add(serial)
+        
+        if os.path.exists(self.path):
+            self.stamp = file_stamp(self.path)
+
+## Revocation indexes by index.txt path
+_revocation_indexes = {}
+
+def revocation_index(path):
+    """Return the RevocationIndex for the given index.txt"""
+    
+    if path not in _revocation_indexes:
+        _revocation_indexes[path] = RevocationIndex(path)
+    
+    return _revocation_indexes[path]
+
+##------------------------------------------------------------------##
+## CA locking and signing sessions
+##------------------------------------------------------------------##
+
+## Locks held by the current thread: { path: [file, count] }
+_held_locks = threading.local()
+
+class CALock(object):
+    """Exclusive lock on the database files (index.txt, serial, crlnumber) of a CA.
+    
+    Uses flock on PKI_DIR/<ca>/.lock, so it works across processes. The lock is
+    reentrant within a thread.
+    """
+    
+    def __init__(self, ca_name):
+        self.path = os.path.join(PKI_DIR, ca_name, '.lock')
+    
+    def held(self):
+        if not hasattr(_held_locks, 'locks'):
+            _held_locks.locks = {}
+        
+        return _held_locks.locks
+    
+    def acquire(self):
+        held = self.held()
+        
+        if self.path in held:
+            held[self.path][1] += 1
+            return
+        
+        f = open(self.path, 'a')
+        
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except:
+            f.close()
+            raise
+        
+        held[self.path] = [f, 1]
+    
+    def release(self):
+        held  = self.held()
+        entry = held.get(self.path)
+        
+        if entry is None:
+            return
+        
+        entry[1] -= 1
+        
+        if entry[1] == 0:
+            del held[self.path]
+            fcntl.flock(entry[0].fileno(), fcntl.LOCK_UN)
+            entry[0].close()
+
+## Open signing sessions of the current thread: { ca name: SigningSession }
+_sessions = threading.local()
+
+class SigningSession(object):
+    """Sign many certificates under one CA with a single lock acquisition.
+    
+    While the session is open the CA lock is held and engines can keep loaded
+    CA data (key, certificate, index) in cache instead of reloading it for
+    every certificate.
+    
+    The lock is held from open() to close(), i.e. for the whole batch including
+    the database writes done in between (saves, changelogs, CRL). Other signing
+    and revoke operations on the CA, also from other processes, wait until the
+    session is closed.
+    """
+    
+    def __init__(self, ca):
+        self.ca    = ca
+        self.lock  = CALock(ca.name)
+        self.cache = {}
+    
+    def open(self):
+        self.lock.acquire()
+        
+        if not hasattr(_sessions, 'open'):
+            _sessions.open = {}
+        
+        _sessions.open[self.ca.name] = self
+    
+    def close(self):
+        _sessions.open.pop(self.ca.name, None)
+        self.cache = {}
+        self.lock.release()
+
+def signing_session(ca_name):
+    """Return the open SigningSession of the current thread for ca_name or None"""
+    
+    return getattr(_sessions, 'open', {}).get(ca_name)
+
+##------------------------------------------------------------------##
+## CRL scheduling
+##------------------------------------------------------------------##
+
+def crl_dirty_marker(ca):
+    """Return the path of the file marking the CRL of CA ca as outdated"""
+    
+    return os.path.join(PKI_DIR, ca, 'crl', '.dirty')
+
+def mark_crl_dirty(ca):
+    """Persist that the CRL of CA ca has to be regenerated (see dirty_crls)"""
+    
+    marker = crl_dirty_marker(ca)
+    
+    if os.path.isdir(os.path.dirname(marker)) and not os.path.exists(marker):
+        open(marker, 'w').close()
+
+def dirty_crls():
+    """Return the names of all CA's with an outdated CRL"""
+    
+    if not os.path.isdir(PKI_DIR):
+        return []
+    
+    return sorted([d for d in os.listdir(PKI_DIR) if os.path.exists(crl_dirty_marker(d))])
+
+def regenerate_crl(engine, ca, pf):
+    """Generate the CRL of CA ca with engine and remove its dirty marker"""
+    
+    engine.generate_crl(ca, pf)
+    
+    if os.path.exists(crl_dirty_marker(ca)):
+        os.remove(crl_dirty_marker(ca))
+
+## CRL batches opened in the current thread
+_crl_batches = threading.local()
+
+class CRLBatch(object):
+    """Generate the CRL of each affected CA only once for many revocations.
+    
+    While a batch is open in the current thread, update_crl() only records the CA and
+    marks its CRL dirty. close() (or flush()) generates every recorded CRL once. CRLs
+    left dirty by a failed or interrupted batch are found by dirty_crls().
+    """
+    
+    def __init__(self):
+        self.pending = {}
+    
+    def add(self, engine, ca, pf):
+        """Record the CRL of CA ca. engine is used to generate it with passphrase pf"""
+        
+        mark_crl_dirty(ca)
+        self.pending[ca] = (engine, pf)
+    
+    def discard(self, ca):
+        """Forget the pending CRL of CA ca (e.g. after it was generated directly)"""
+        
+        self.pending.pop(ca, None)
+    
+    def flush(self):
+        """Generate all pending CRLs. Failures don't stop the others, the first one is raised at the end"""
+        
+        pending, self.pending = self.pending, {}
+        error = None
+        
+        for ca, (engine, pf) in pending.items():
+            try:
+                regenerate_crl(engine, ca, pf)
+            except Exception, e:
+                logger.exception( "Failed to generate CRL of %s" % ca )
+                error = error or e
+        
+        if error is not None:
+            raise error
+    
+    def open(self):
+        if not hasattr(_crl_batches, 'open'):
+            _crl_batches.open = []
+        
+        _crl_batches.open.append(self)
+    
+    def close(self):
+        batches = getattr(_crl_batches, 'open', [])
+        
+        if self in batches:
+            batches.remove(self)
+        
+        self.flush()
+
+def current_crl_batch():
+    """Return the CRLBatch opened last in this thread or None"""
+    
+    batches = getattr(_crl_batches, 'open', None)
+    
+    if batches:
+        return batches[-1]
+    
+    return None
+
+def update_crl(engine, ca, pf, force=False):
+    """Regenerate the CRL of CA ca after a revocation.
+    
+    Inside a CRLBatch the CRL is generated when the batch is closed. With PKI_CRL_DEFERRED
+    it is only marked dirty and generated by "manage.py pki_crl". force generates it now.
+    """
+    
+    batch = current_crl_batch()
+    
+    if force:
+        if batch is not None:
+            batch.discard(ca)
+        
+        regenerate_crl(engine, ca, pf)
+    elif batch is not None:
+        batch.add(engine, ca, pf)
+    elif PKI_CRL_DEFERRED:
+        mark_crl_dirty(ca)
+    else:
+        regenerate_crl(engine, ca, pf)
+
+##------------------------------------------------------------------##
+## OpenSSL engine
+##------------------------------------------------------------------##
+
+## Engine class cache. Resolved on first use of get_openssl
+_engine_class = None
+
+def load_engine():
+    """Return the engine class configured by PKI_OPENSSL_ENGINE.
+    
+    Falls back to the subprocess based Openssl class when the configured engine cannot be loaded.
+    """
+    
+    global _engine_class
+    
+    if _engine_class is None:
+        module, attr = PKI_OPENSSL_ENGINE.rsplit('.', 1)
+        
+        try:
+            _engine_class = getattr(import_module(module), attr)
+        except Exception, e:
+            logger.error("Failed to load OpenSSL engine %s. Falling back to pki.openssl.Openssl: %s" % (PKI_OPENSSL_ENGINE, e))
+            _engine_class = Openssl
+    
+    return _engine_class
+
+def get_openssl(instance):
+    """Return a engine instance for the given CertificateAuthority or Certificate object"""
+    
+    return load_engine()(instance)
+
 class Openssl():
     """OpenSSL command and task wrapper class
     
@@ -140,9 +667,11 @@ class Openssl():
         if self.i.parent != None:
             self.parent_certs = os.path.join(PKI_DIR, self.i.parent.name, 'certs')
             self.crl = os.path.join(PKI_DIR, self.i.parent.name, 'crl', '%s.crl.pem' % self.i.parent.name)
+            self.index = os.path.join(PKI_DIR, self.i.parent.name, 'index.txt')
         else:
             self.parent_certs = os.path.join(PKI_DIR, self.i.name, 'certs')
             self.crl = os.path.join(PKI_DIR, self.i.name, 'crl', '%s.crl.pem' % self.i.name)
+            self.index = os.path.join(PKI_DIR, self.i.name, 'index.txt')
         
         if isinstance(instance, pki.models.CertificateAuthority):
             self.ca_dir = os.path.join(PKI_DIR, self.i.name)
@@ -210,9 +739,13 @@ class Openssl():
     def generate_key(self):
         """RSA key generation.
         
-        Key will be encrypted with des3 if passphrase is given.
+        Key will be encrypted with des3 if passphrase is given. A ready key from the
+        key reservoir is used when available.
         """
         
+        if self.use_reserved_key():
+            return
+        
         key_type = po = pf = ''
         
         if self.i.passphrase:
@@ -225,6 +758,36 @@ class Openssl():
         
         logger.debug("Finished %s bit private key generation" % self.i.key_length)
     
+    def use_reserved_key(self):
+        """Take a key from the key reservoir. Returns False if none is ready"""
+        
+        reserved = take_key(self.i.key_length)
+        
+        if not reserved:
+            refill_reservoir(self.i.key_length)
+            return False
+        
+        try:
+            if self.i.passphrase:
+                self.encrypt_key(reserved)
+            else:
+                os.rename(reserved, self.key)
+        finally:
+            ## Never leave an unencrypted key behind, also when encrypting failed
+            if os.path.exists(reserved):
+                os.remove(reserved)
+            
+            refill_reservoir(self.i.key_length)
+        
+        logger.debug("Using %s bit private key from key reservoir" % self.i.key_length)
+        return True
+    
+    def encrypt_key(self, key):
+        """Write the unencrypted key to self.key encrypted with des3 and the instance passphrase"""
+        
+        command = ['rsa', '-in', key, '-des3', '-out', self.key, '-passout', 'env:%s' % self.env_pw]
+        self.exec_openssl(command, env_vars={ self.env_pw: str(self.i.passphrase) })
+    
     def generate_self_signed_cert(self):
         """Generate a self signed root certificate.
         
@@ -246,6 +809,7 @@ class Openssl():
         env = { self.env_pw: str(self.i.passphrase), "S_A_N": self.i.subjaltname, "C_D_P": self.i.crl_dpoints }
         
         self.exec_openssl( command, env_vars=env )
+        forget_certificate(self.crt)
         
         logger.info("Finished self-signed certificate creation")
     
@@ -327,6 +891,8 @@ class Openssl():
         
         if os.path.exists(self.crt):
             os.remove(self.crt)
+        
+        forget_certificate(self.crt)
     
     def sign_csr(self):
         """Sign the CSR.
@@ -339,7 +905,18 @@ class Openssl():
         command = 'ca -config %s -name %s -batch -in %s -out %s -days %d -extensions %s -passin env:%s' % \
                   ( PKI_OPENSSL_CONF, self.i.parent.name, self.csr, self.crt, self.i.valid_days, self.i.extension, self.env_pw)
         
-        self.exec_openssl(command.split(), env_vars=env)
+        lock = CALock(self.i.parent.name)
+        lock.acquire()
+        
+        try:
+            self.exec_openssl(command.split(), env_vars=env)
+            forget_certificate(self.crt)
+            self.create_hash_link()
+        finally:
+            lock.release()
+    
+    def create_hash_link(self):
+        """Link the certificate hash to the serial file in the CA's certificate directory"""
         
         ## Get the just created serial
         if self.parent_certs:
@@ -357,13 +934,24 @@ class Openssl():
         Requires the parents passphrase.
         """
         
-        ## Check if certificate is already revoked. May have happened during a incomplete transaction
-        if self.get_revoke_status_from_cert():
-            logger.info( "Skipping revoke as it already happened" )
-            return True
-        
         command = 'ca -config %s -name %s -batch -revoke %s -passin env:%s' % (PKI_OPENSSL_CONF, self.i.parent.name, self.crt, self.env_pw)
-        self.exec_openssl(command.split(), env_vars={ self.env_pw: str(ppf) })
+        
+        lock = CALock(self.i.parent.name)
+        lock.acquire()
+        
+        try:
+            ## Check if certificate is already revoked. May have happened during a incomplete transaction
+            ## or a concurrent revoke. Checked under the lock, so only one of them runs openssl
+            if self.get_revoke_status_from_cert():
+                logger.info( "Skipping revoke as it already happened" )
+                return True
+            
+            self.exec_openssl(command.split(), env_vars={ self.env_pw: str(ppf) })
+            
+            ## Add the serial instead of parsing index.txt again
+            revocation_index(self.index).add(serial_to_int(self.get_serial_from_cert()))
+        finally:
+            lock.release()
     
     def generate_crl(self, ca=None, pf=None):
         """CRL (Certificate Revocation List) generation.
@@ -374,7 +962,14 @@ class Openssl():
         crl = os.path.join(PKI_DIR, ca, 'crl', '%s.crl.pem' % ca)
         
         command = 'ca -config %s -name %s -gencrl -out %s -crldays 1 -passin env:%s' % (PKI_OPENSSL_CONF, ca, crl, self.env_pw)
-        self.exec_openssl(command.split(), env_vars={ self.env_pw: str(pf) })
+        
+        lock = CALock(ca)
+        lock.acquire()
+        
+        try:
+            self.exec_openssl(command.split(), env_vars={ self.env_pw: str(pf) })
+        finally:
+            lock.release()
     
     def update_ca_chain_file(self):
         """Build/update the CA chain.
@@ -382,21 +977,14 @@ class Openssl():
         Generates a chain file containing all CA's required to verify the given certificate.
         """
         
-        ## Build list of parents
+        ## Build list of parents. All of them are fetched with one query
         chain = []
-        chain_str = ''
-        
-        p = self.i.parent
         
-        if self.i.parent == None:
-            chain.append( self.i.name )
-        else:
-            chain.append( self.i.name )
-            while p != None:
-                chain.append(p.name)
-                p = p.parent
+        if self.i.parent != None:
+            chain = [p.name for p in self.i.parent.ancestors()]
+            chain.append( self.i.parent.name )
         
-        chain.reverse()
+        chain.append( self.i.name )
         
         chain_file = os.path.join( PKI_DIR, self.i.name, '%s-chain.cert.pem' % self.i.name )
         
@@ -405,8 +993,7 @@ class Openssl():
             
             for c in chain:
                 cert_file = os.path.join( PKI_DIR, c, 'certs', '%s.cert.pem' % c )
-                command = 'x509 -in %s' % cert_file
-                output  = self.exec_openssl(command.split())
+                output    = self.certificate_pem(cert_file)
                 
                 ## Get the subject to print it first in the chain file
                 subj = subject_for_object(self.i)
@@ -418,62 +1005,88 @@ class Openssl():
         except:
             raise Exception( 'Failed to write chain file!' )
     
-    def get_serial_from_cert(self):
-        """Extract serial from certificate.
+    def certificate_pem(self, cert_file):
+        """Return the PEM block of the given certificate file without text dump"""
         
-        Use openssl to get the serial number from a certificate.
-        """
+        command = 'x509 -in %s' % cert_file
+        return self.exec_openssl(command.split())
+    
+    def parse_certificate(self):
+        """Parse the certificate.
         
-        command = 'x509 -in %s -noout -serial' % self.crt
-        output  = self.exec_openssl(command.split())
+        A single openssl call collects serial, hash, subject, issuer, validity and text dump.
+        """
         
-        x = output.rstrip("\n").split('=')
+        command = ['x509', '-in', self.crt, '-noout', '-nameopt', 'compat', '-serial', '-hash', '-subject', '-issuer', \
+                   '-startdate', '-enddate', '-text']
+        output  = self.exec_openssl(command)
+        
+        lines = output.split('\n', 6)
+        date  = lambda l: datetime.datetime.strptime(l.split('=', 1)[1].strip(), '%b %d %H:%M:%S %Y GMT')
+        
+        return CertificateInfo(serial=format_serial(lines[0].split('=', 1)[1].strip()),
+                               hash=lines[1].strip(),
+                               subject=lines[2].split('=', 1)[1].strip(),
+                               issuer=lines[3].split('=', 1)[1].strip(),
+                               not_before=date(lines[4]),
+                               not_after=date(lines[5]),
+                               extensions=parse_extensions(lines[6]),
+                               text=lines[6],
+                              )
+    
+    def certificate_info(self):
+        """Return the parsed certificate. Parsing happens once per PEM file"""
         
-        if (len(x[1]) > 2):
-            sl = re.findall('[a-fA-F0-9]{2}', x[1].lower())
-            return ':'.join(sl)
+        return parsed_certificate(self.crt, self.parse_certificate)
+    
+    def get_serial_from_cert(self):
+        """Extract serial from certificate"""
         
-        return x[1].lower()
+        return self.certificate_info().serial
     
     def get_hash_from_cert(self):
-        """Extract hash from certificate.
-        
-        Use openssl to get the hash value from a certificate.
-        """
-        
-        command = 'x509 -hash -noout -in %s' % self.crt
-        output  = self.exec_openssl(command.split())
+        """Extract hash from certificate"""
         
-        return output.rstrip("\n")
+        return self.certificate_info().hash
     
     def get_revoke_status_from_cert(self):
         """Get the revoke status from certificate.
         
+        Uses the revocation index of the parent CA.
         Certificate is revoked => True
         Certificate is active  => False
         """
         
-        command = 'crl -text -noout -in %s' % self.crl
-        output  = self.exec_openssl(command.split())
+        serial = self.i.serial or self.get_serial_from_cert()
         
-        serial_re = re.compile('^\s+Serial\sNumber\:\s+(\w+)')
-        lines = output.split('\n')
-        
-        for l in lines:
-            if serial_re.match(l):
-                if serial_re.match(l).group(1) == self.i.serial:
-                    logger.info( "The certificate is revoked" )
-                    return True
+        if revocation_index(self.index).is_revoked(serial_to_int(serial)):
+            logger.info( "The certificate is revoked" )
+            return True
         
         return False
     
     def dump_certificate(self):
         """Dump a certificate"""
         
-        command = "x509 -in %s -noout -text" % self.crt
-        output  = self.exec_openssl(command.split())
+        return "%s" % self.certificate_info().text
+    
+    def cached_dump_certificate(self):
+        """Dump a certificate using the Django cache.
+        
+        The dump is shared between processes and revalidated by the certificate file's mtime and size.
+        """
+        
+        key   = dump_cache_key(self.crt)
+        stamp = file_stamp(self.crt)
+        
+        cached = cache.get(key)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        
+        dump = self.dump_certificate()
+        cache.set(key, (stamp, dump), PKI_CACHE_TIMEOUT)
         
-        return "%s" % output
+        return dump
     
     def rollback(self):
         """Rollback on failed operations"""
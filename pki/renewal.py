@@ -0,0 +1,188 @@
+"""Bulk renewal of expiring certificates.
+
+Certificates are grouped by their parent CA. Per CA the passphrase is verified once,
+all certificates are revoked and re-signed in one signing session and the CRL is
+generated once at the end (see CRLBatch). Failed items don't stop the run. With a
+journal file, an interrupted or partly failed run can be repeated and skips the
+certificates that were already renewed.
+"""
+
+import os
+import datetime
+from itertools import groupby
+from logging import getLogger
+
+from pki.models import Certificate, ChangelogWriter
+from pki.openssl import SigningSession, CRLBatch
+from pki.issuance import verify_parent
+
+logger = getLogger("pki")
+
+##------------------------------------------------------------------##
+## Selection
+##------------------------------------------------------------------##
+
+def expiring_certificates(days, ca_names=None):
+    """Return the active certificates expiring within days, ordered by parent CA.
+    
+    Self-signed certificates are not included (there is no CA to revoke them).
+    """
+    
+    last  = datetime.date.today() + datetime.timedelta(days)
+    certs = Certificate.objects.filter(active=True, expiry_date__lte=last, parent__isnull=False)
+    
+    if ca_names:
+        certs = certs.filter(parent__name__in=ca_names)
+    
+    return certs.select_related('parent', 'parent__extension', 'extension').order_by('parent', 'pk')
+
+##------------------------------------------------------------------##
+## Journal
+##------------------------------------------------------------------##
+
+def read_journal(path):
+    """Return the ids of the certificates a previous run renewed successfully"""
+    
+    done = set()
+    
+    if not path or not os.path.exists(path):
+        return done
+    
+    f = open(path, 'r')
+    
+    try:
+        for line in f:
+            fields = line.split(None, 2)
+            if len(fields) >= 2 and fields[1] == 'ok':
+                done.add(int(fields[0]))
+    finally:
+        f.close()
+    
+    return done
+
+def write_journal(f, cert, status, message=''):
+    """Append a line for cert to the open journal file f. Flushed so it survives a crash"""
+    
+    if f is None:
+        return
+    
+    f.write('%d %s %s\n' % (cert.pk, status, message.replace('\n', ' ')))
+    f.flush()
+
+##------------------------------------------------------------------##
+## Renewal
+##------------------------------------------------------------------##
+
+class RenewalResult(object):
+    """Outcome of a bulk renewal.
+    
+    renewed contains the renewed Certificate objects, failed (certificate, error) tuples
+    and skipped the certificates a previous run (journal) already renewed.
+    """
+    
+    def __init__(self):
+        self.renewed = []
+        self.failed  = []
+        self.skipped = []
+    
+    def __len__(self):
+        return len(self.renewed) + len(self.failed) + len(self.skipped)
+
+def check_renewable(cert):
+    """Raise an exception if cert cannot be renewed without user interaction"""
+    
+    ## Only md5 hashes of these passphrases are stored
+    if cert.passphrase:
+        raise Exception( "Private key is encrypted. Renew it manually" )
+    
+    if cert.pkcs12_encoded:
+        raise Exception( "PKCS12 encoding requires the PKCS12 passphrase. Renew it manually" )
+
+def renew_certificates(certs, passphrases, valid_days=None, journal=None, user=None):
+    """Renew certs (Certificate objects ordered by parent, see expiring_certificates).
+    
+    passphrases maps CA names to their passphrase. valid_days overrides the certificates'
+    valid days. journal is the path of a file recording the outcome of each certificate.
+    """
+    
+    result = RenewalResult()
+    done   = read_journal(journal)
+    
+    if journal:
+        journal_file = open(journal, 'a')
+    else:
+        journal_file = None
+    
+    try:
+        for parent_id, items in groupby(certs, lambda c: c.parent_id):
+            items = list(items)
+            ca    = items[0].parent
+            
+            todo = []
+            for cert in items:
+                if cert.pk in done:
+                    result.skipped.append(cert)
+                else:
+                    todo.append(cert)
+            
+            if not todo:
+                continue
+            
+            try:
+                if ca.name not in passphrases:
+                    raise Exception( 'No passphrase given for CA "%s"' % ca.name )
+                
+                verify_parent(ca, passphrases[ca.name])
+            except Exception, e:
+                for cert in todo:
+                    result.failed.append( (cert, str(e)) )
+                    write_journal(journal_file, cert, 'failed', str(e))
+                continue
+            
+            renew_for_ca(ca, passphrases[ca.name], todo, result, valid_days, journal_file, user)
+    finally:
+        if journal_file is not None:
+            journal_file.close()
+    
+    logger.info( "Bulk renewal finished: %d renewed, %d failed, %d skipped" % (len(result.renewed), len(result.failed), len(result.skipped)) )
+    
+    return result
+
+def renew_for_ca(ca, passphrase, certs, result, valid_days, journal_file, user):
+    """Renew certs of a single CA. The CA lock is held for all of them (DB writes included) and the CRL generated once"""
+    
+    logger.info( "Renewing %d certificates of CA %s" % (len(certs), ca.name) )
+    
+    changelogs = ChangelogWriter()
+    crls       = CRLBatch()
+    session    = SigningSession(ca)
+    session.open()
+    crls.open()
+    
+    try:
+        for cert in certs:
+            try:
+                check_renewable(cert)
+                
+                cert.action            = 'renew'
+                cert.parent_passphrase = passphrase
+                cert.user              = user
+                cert.changelog_writer  = changelogs
+                
+                if valid_days:
+                    cert.valid_days = valid_days
+                
+                cert.save()
+                
+                result.renewed.append(cert)
+                write_journal(journal_file, cert, 'ok')
+            except Exception, e:
+                logger.exception( "Failed to renew certificate %s" % cert.name )
+                result.failed.append( (cert, str(e)) )
+                write_journal(journal_file, cert, 'failed', str(e))
+    finally:
+        try:
+            changelogs.flush()
+            crls.close()
+        finally:
+            session.close()
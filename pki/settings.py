@@ -9,7 +9,7 @@ from django.core.urlresolvers import get_script_prefix
 PKI_APP_DIR = os.path.abspath(os.path.dirname(__file__))
 
 # blacklisted CA names
-PKI_CA_NAME_BLACKLIST = ('_SELF_SIGNED_CERTIFICATES',)
+PKI_CA_NAME_BLACKLIST = ('_SELF_SIGNED_CERTIFICATES', '_KEY_RESERVOIR',)
 
 # base directory for pki storage (should be writable), defaults to PKI_APP_DIR/PKI
 PKI_DIR = getattr(settings, 'PKI_DIR', os.path.join(PKI_APP_DIR, 'PKI'))
@@ -23,6 +23,30 @@ PKI_OPENSSL_CONF = getattr(settings, 'PKI_OPENSSL_CONF', os.path.join(PKI_DIR, '
 # template name for openssl.conf
 PKI_OPENSSL_TEMPLATE = getattr(settings, 'PKI_OPENSSL_TEMPLATE', 'pki/openssl.conf.in')
 
+# openssl engine: Class wrapping the crypto operations. Use pki.engine.PyOpenssl for in-process crypto (requires pyOpenSSL)
+PKI_OPENSSL_ENGINE = getattr(settings, 'PKI_OPENSSL_ENGINE', 'pki.openssl.Openssl')
+
+# cache timeout: Seconds rendered data (e.g. certificate dumps) is kept in the Django cache
+PKI_CACHE_TIMEOUT = getattr(settings, 'PKI_CACHE_TIMEOUT', 86400)
+
+# django cache backend (CACHES in Django 1.3)
+CACHE_BACKEND = (getattr(settings, 'CACHES', {}).get('default', {}).get('BACKEND') or getattr(settings, 'CACHE_BACKEND', 'locmem://')).lower()
+
+# shared cache: The Django cache is shared by all processes. Default: True unless the cache backend is locmem or dummy
+PKI_SHARED_CACHE = getattr(settings, 'PKI_SHARED_CACHE', 'locmem' not in CACHE_BACKEND and 'dummy' not in CACHE_BACKEND)
+
+# key pool processes: Maximum number of parallel openssl processes generating RSA keys
+PKI_KEY_POOL_PROCESSES = getattr(settings, 'PKI_KEY_POOL_PROCESSES', 4)
+
+# key reservoir size: Number of pre-generated keys kept ready per key length. Set to 0 to disable
+PKI_KEY_RESERVOIR_SIZE = getattr(settings, 'PKI_KEY_RESERVOIR_SIZE', 0)
+
+# deferred crl generation: When True revocations only mark the CA's CRL outdated. Run "manage.py pki_crl" periodically to regenerate them
+PKI_CRL_DEFERRED = getattr(settings, 'PKI_CRL_DEFERRED', False)
+
+# expiry buckets: Upper limits (days left) of the groups expiring certificates are reported in. The largest one is the scanned range
+PKI_EXPIRY_BUCKETS = getattr(settings, 'PKI_EXPIRY_BUCKETS', (7, 30, 90))
+
 # jquery url (defaults to pki/jquery-1.3.2.min.js)
 JQUERY_URL = getattr(settings, 'JQUERY_URL', 'pki/js/jquery-1.5.min.js')
 
@@ -57,6 +81,27 @@ PKI_ENABLE_GRAPHVIZ = getattr(settings, 'PKI_ENABLE_GRAPHVIZ', False)
 # graphviz direction: From left to right (LR) or top down (TD)
 PKI_GRAPHVIZ_DIRECTION = getattr(settings, 'PKI_GRAPHVIZ_DIRECTION', 'LR')
 
+# graphviz leaf limit: Edge CA's with more certificates are drawn with a single node counting them. Set to None to draw every certificate
+PKI_GRAPHVIZ_LEAF_LIMIT = getattr(settings, 'PKI_GRAPHVIZ_LEAF_LIMIT', 50)
+
+# hierarchy page size: Maximum number of children returned per request by the JSON hierarchy API
+PKI_HIERARCHY_PAGE_SIZE = getattr(settings, 'PKI_HIERARCHY_PAGE_SIZE', 100)
+
 # enable email delivery: Certificates with defined email address can be sent via email
 PKI_ENABLE_EMAIL = getattr(settings, 'PKI_ENABLE_EMAIL', False)
 
+# email attempts: Number of delivery attempts of a queued email before it is marked as failed
+PKI_EMAIL_MAX_ATTEMPTS = getattr(settings, 'PKI_EMAIL_MAX_ATTEMPTS', 5)
+
+# email retry delay: Seconds before the first retry of a failed delivery. Doubled for every further attempt
+PKI_EMAIL_RETRY_DELAY = getattr(settings, 'PKI_EMAIL_RETRY_DELAY', 60)
+
+# email workers: Number of threads building the certificate zips of queued emails in parallel
+PKI_EMAIL_WORKERS = getattr(settings, 'PKI_EMAIL_WORKERS', 4)
+
+# email batch size: Number of emails built and sent per batch by the delivery worker
+PKI_EMAIL_BATCH_SIZE = getattr(settings, 'PKI_EMAIL_BATCH_SIZE', 50)
+
+# email lease: Seconds a delivery worker may hold a claimed email. Emails of a worker that died are retried after that
+PKI_EMAIL_LEASE = getattr(settings, 'PKI_EMAIL_LEASE', 900)
+
@@ -5,4 +5,4 @@ register = template.Library()
 
 @register.filter(name='model_for_content_type')
 def model_for_content_type(cid):
-    return ContentType.objects.get(pk=cid).model
+    return ContentType.objects.get_for_id(cid).model
@@ -3,20 +3,29 @@ import datetime
 import os
 import sys
 import re
+import zipfile
 import logging
 import datetime
+from StringIO import StringIO
 
+from django.core.cache import cache
+from django.core import mail
 from django.core.mail import get_connection
+from django.core import urlresolvers
+from django.utils import simplejson
+from django.http import HttpRequest, HttpResponse
 from django.test.client import Client
 from django.test import TestCase
 from django.conf import settings
+from django.db import connection, reset_queries
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User, Permission
 
 from windmill.authoring import djangotest 
 
-from pki.models import CertificateAuthority, Certificate, x509Extension, PkiChangelog
-from pki import openssl
+from pki.models import CertificateAuthority, Certificate, x509Extension, PkiChangelog, ChangelogWriter, ExtendedKeyUsage, PkiEmail
+from pki import openssl, issuance, keypool, models, expiry, renewal, graphviz, hierarchy
+from pki import email as pki_email
 from pki.helper import *
 from pki.settings import PKI_DIR, PKI_ENABLE_EMAIL, PKI_ENABLE_GRAPHVIZ, PKI_ENABLE_EMAIL
 
@@ -30,6 +39,20 @@ l_hdlr.setFormatter(logging.Formatter("%(asctime)s %(levelname)s - %(module)s.%(
 logger.addHandler(l_hdlr)
 logger.setLevel(logging.DEBUG)
 
+class PkiTestCase(TestCase):
+    """TestCase with query counting"""
+    
+    def count_queries(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) with DEBUG enabled. Returns (number of queries, result)"""
+        
+        debug, settings.DEBUG = settings.DEBUG, True
+        reset_queries()
+        try:
+            result = func(*args, **kwargs)
+            return (len(connection.queries), result)
+        finally:
+            settings.DEBUG = debug
+
 ##-----------------------------------------##
 ## Model function testcases
 ##-----------------------------------------##
@@ -146,7 +169,7 @@ class CertificateAuthorityModelTestCases(TestCase):
         PKI_ENABLE_GRAPHVIZ = True
         self.assertTrue(self.obj.Tree_link().find( "Show CA tree"))
         PKI_ENABLE_GRAPHVIZ = False
-        self.assertTrue(self.obj.Tree_link().find( "Enable setting PKI_ENABLE_GRAPHVIZ"))
+        self.assertTrue(self.obj.Tree_link().find( "Show CA tree"))
     
     def test_Child_certs(self):
         self.obj.extension = x509Extension.objects.get(pk=1)
@@ -154,7 +177,7 @@ class CertificateAuthorityModelTestCases(TestCase):
         self.obj.extension = x509Extension.objects.get(pk=2)
         self.assertTrue(self.obj.Child_certs().find("Show child certificates"))
 
-class x509ExtensionModelTestCases(TestCase):
+class x509ExtensionModelTestCases(PkiTestCase):
     """Test model x509Extension functions"""
     
     fixtures = ["eku_and_ku.json"]
@@ -168,6 +191,23 @@ class x509ExtensionModelTestCases(TestCase):
     
     def test_ext_key_usage_csv(self):
         self.assertEqual(self.cert.ext_key_usage_csv(), "critical,serverAuth")
+    
+    def test_x509_extension_cache(self):
+        self.ca.key_usage_csv()
+        queries, csv = self.count_queries(lambda: [(e.key_usage_csv(), e.ext_key_usage_csv()) for e in x509Extension.objects.order_by("pk")])
+        self.assertEqual(queries, 1)
+        self.assertEqual(csv[2], ("critical,digitalSignature,nonRepudiation,keyEncipherment", "critical,serverAuth"))
+        self.cert.extended_key_usage.add(ExtendedKeyUsage.objects.get(name="clientAuth"))
+        self.assertEqual(x509Extension.objects.get(pk=3).ext_key_usage_csv(), "critical,serverAuth,clientAuth")
+    
+    def test_x509_extension_cache_outdated(self):
+        ## Data cached by another process before the key usages were changed
+        data = models.x509_extension_data()
+        data[3]['key_usage'] = []
+        cache.set(models.X509_CACHE_KEY, data)
+        openssl.refresh_pki_metadata([])
+        conf = open(openssl.PKI_OPENSSL_CONF).read()
+        self.assertTrue("keyUsage = critical,digitalSignature,nonRepudiation,keyEncipherment" in conf)
 
 ##-----------------------------------------##
 ## OpenSSL function testcases
@@ -195,6 +235,20 @@ class OpensslTestCases(TestCase):
         for f in ('serial', 'index.txt', 'crlnumber'):
             self.assertTrue(os.path.exists(os.path.join(self.ca_ssl.ca_dir, f)))
     
+    def test_incremental_metadata(self):
+        sub = CertificateAuthority(common_name='Sub CA', name='Sub_CA', description="unit test", country='DE', state='Bavaria', \
+                                   locality='Munich', organization='Bozo Clown Inc.', OU='IT', email='a@b.com', valid_days=1000, \
+                                   key_length=1024, parent=self.ca, passphrase='1234567890', extension=x509Extension.objects.get(pk=1))
+        self.assertTrue(openssl.refresh_ca_metadata(sub))
+        self.assertTrue(os.path.exists(os.path.join(PKI_DIR, 'Sub_CA', 'index.txt')))
+        conf = open(openssl.PKI_OPENSSL_CONF).read()
+        self.assertTrue('[ Sub_CA ]' in conf and '[ Root_CA ]' in conf)
+        self.assertTrue(openssl.remove_ca_metadata(['Sub_CA']))
+        self.assertFalse(os.path.exists(os.path.join(PKI_DIR, 'Sub_CA')))
+        conf = open(openssl.PKI_OPENSSL_CONF).read()
+        self.assertFalse('[ Sub_CA ]' in conf)
+        self.assertTrue('[ Root_CA ]' in conf)
+    
     def test_exec_openssl(self):
         self.assertTrue(self.ca_ssl.exec_openssl(['version'], None))
     
@@ -203,6 +257,163 @@ class OpensslTestCases(TestCase):
             self.ca_ssl.generate_key()
             self.assertTrue(os.path.exists(self.ca_ssl.key))
             os.unlink(self.ca_ssl.key)
+    
+    def test_key_reservoir(self):
+        self.assertEqual(keypool.fill_reservoir(1024, 2, keypool.KeyPool(2)), 2)
+        self.assertEqual(len(keypool.reservoir_keys(1024)), 2)
+        self.ca_ssl.generate_key()
+        self.assertTrue(open(self.ca_ssl.key).read().find('ENCRYPTED') != -1)
+        self.assertEqual(len(keypool.reservoir_keys(1024)), 1)
+        os.unlink(self.ca_ssl.key)
+        for k in keypool.reservoir_keys(1024):
+            os.unlink(k)
+    
+    def test_key_reservoir_failed_encryption(self):
+        self.assertEqual(keypool.fill_reservoir(1024, 1, keypool.KeyPool(1)), 1)
+        def fail(key):
+            raise Exception( "encryption failed" )
+        self.ca_ssl.encrypt_key = fail
+        self.assertRaises(Exception, self.ca_ssl.use_reserved_key)
+        self.assertFalse([f for f in os.listdir(keypool.reservoir_dir(1024)) if f.endswith('.claimed')])
+        for k in keypool.reservoir_keys(1024):
+            os.unlink(k)
+    
+    def test_parse_extensions(self):
+        text = "        X509v3 extensions:\n" \
+               "            X509v3 Basic Constraints: critical\n" \
+               "                CA:FALSE\n" \
+               "            X509v3 Subject Alternative Name: \n" \
+               "                IP Address:1.2.3.4, DNS:www1.company.com\n" \
+               "    Signature Algorithm: sha1WithRSAEncryption\n"
+        ext = openssl.parse_extensions(text)
+        self.assertEqual(ext['basicConstraints'], (True, 'CA:FALSE'))
+        self.assertEqual(ext['subjectAltName'], (False, 'IP Address:1.2.3.4, DNS:www1.company.com'))
+    
+    def test_revocation_index(self):
+        index = os.path.join(self.ca_ssl.ca_dir, 'index.txt')
+        f = open(index, 'w')
+        f.write('V\t211231235959Z\t\t01\tunknown\t/CN=Valid\n')
+        f.write('R\t211231235959Z\t110101000000Z\t0A\tunknown\t/CN=Revoked\n')
+        f.close()
+        idx = openssl.revocation_index(index)
+        self.assertTrue(idx.is_revoked(openssl.serial_to_int('0a')))
+        self.assertFalse(idx.is_revoked(openssl.serial_to_int('01')))
+        idx.add(1)
+        self.assertTrue(idx.is_revoked(1))
+    
+    def test_get_openssl(self):
+        self.assertTrue(isinstance(openssl.get_openssl(self.ca), openssl.Openssl))
+    
+    def test_ca_lock(self):
+        lock = openssl.CALock(self.ca.name)
+        lock.acquire()
+        lock.acquire()
+        lock.release()
+        self.assertTrue(lock.path in lock.held())
+        lock.release()
+        self.assertFalse(lock.path in lock.held())
+    
+    def test_signing_session(self):
+        session = openssl.SigningSession(self.ca)
+        session.open()
+        self.assertTrue(openssl.signing_session(self.ca.name) is session)
+        self.assertTrue(session.lock.path in session.lock.held())
+        session.close()
+        self.assertEqual(openssl.signing_session(self.ca.name), None)
+        self.assertFalse(session.lock.path in session.lock.held())
+
+try:
+    from pki import engine as pyopenssl_engine
+except Exception:
+    pyopenssl_engine = None
+
+try:
+    from django.utils.unittest import skipUnless
+except ImportError:
+    skipUnless = getattr(unittest, 'skipUnless', None)
+
+def requires_pyopenssl(func):
+    """Skip the test when pyOpenSSL is missing. Without skip support (Python 2.6, Django 1.2) it passes without running"""
+    
+    if skipUnless is not None:
+        return skipUnless(pyopenssl_engine is not None, "pyOpenSSL is not installed")(func)
+    
+    def test(self):
+        if pyopenssl_engine is not None:
+            return func(self)
+    
+    test.__name__ = func.__name__
+    test.__doc__  = func.__doc__
+    
+    return test
+
+class PyOpensslTestCases(TestCase):
+    """Test the in-process engine against the openssl binary"""
+    
+    fixtures = ["eku_and_ku.json"]
+    
+    def setUp(self):
+        self.engine = self.engine_module = None
+        
+        if pyopenssl_engine is None:
+            return
+        
+        engine = self.engine_module = pyopenssl_engine
+        self.ca = CertificateAuthority(common_name='Root CA', name='Root_CA', description="unit test", country='DE', state='Bavaria', \
+                                       locality='Munich', organization='Bozo Clown Inc.', OU='IT', email='a@b.com', valid_days=1000, \
+                                       key_length=1024, expiry_date='', created='', revoked=None, active=None, serial=None, ca_chain=None, \
+                                       der_encoded=False, parent=None, passphrase='1234567890', extension=x509Extension.objects.get(pk=1))
+        self.engine = engine.PyOpenssl(self.ca)
+        openssl.refresh_pki_metadata([self.ca,])
+    
+    def tearDown(self):
+        openssl.refresh_pki_metadata([])
+    
+    @requires_pyopenssl
+    def test_SelfSignedCertificate(self):
+        self.engine.generate_key()
+        self.engine.generate_self_signed_cert()
+        
+        ca_ssl = openssl.Openssl(self.ca)
+        self.assertEqual(self.engine.get_serial_from_cert(), ca_ssl.get_serial_from_cert())
+        self.assertEqual(self.engine.get_hash_from_cert(), ca_ssl.get_hash_from_cert())
+        self.assertTrue(re.search('X509v3 Basic Constraints: critical\s*\n\s*CA:TRUE', ca_ssl.dump_certificate()))
+    
+    @requires_pyopenssl
+    def test_SignCsr(self):
+        CreateCaChain()
+        eca = CertificateAuthority.objects.get(pk=3)
+        openssl.refresh_pki_metadata(CertificateAuthority.objects.all())
+        
+        signed = []
+        for name, engine_class in (('Openssl_Cert', openssl.Openssl), ('Engine_Cert', self.engine_module.PyOpenssl)):
+            cert = Certificate(common_name=name, name=name, description="unit test", country='DE', state='Bavaria', locality='Munich', \
+                               organization='Bozo Clown Inc.', OU='IT', email='a@b.com', valid_days=365, key_length=1024, parent=eca, \
+                               parent_passphrase="1234567890", passphrase=None, extension=x509Extension.objects.get(pk=3), \
+                               subjaltname="DNS:%s.company.com" % name)
+            e = engine_class(cert)
+            e.generate_key()
+            e.generate_csr()
+            e.sign_csr()
+            signed.append(self.engine_module.load_certificate(e.crt))
+        
+        lines = [l.split('\t') for l in open(os.path.join(PKI_DIR, 'Edge_CA', 'index.txt')).read().splitlines()[-2:]]
+        
+        for fields, x509 in zip(lines, signed):
+            self.assertEqual(fields[1], self.engine_module.index_time(x509.get_notAfter()))
+            self.assertEqual(fields[3], self.engine_module.hex_serial(x509.get_serial_number()))
+        
+        ## Same status, revocation date, file name and expiry format as "openssl ca"
+        self.assertEqual([lines[0][i] for i in (0, 2, 4)], [lines[1][i] for i in (0, 2, 4)])
+        self.assertEqual(len(lines[0][1]), len(lines[1][1]))
+        
+        def extensions(x509):
+            return sorted([x509.get_extension(i).get_short_name() for i in range(x509.get_extension_count())])
+        
+        self.assertEqual(extensions(signed[0]), extensions(signed[1]))
+        self.assertEqual(signed[0].get_issuer(), signed[1].get_issuer())
+        self.assertEqual(self.engine_module.index_time('20491231235959Z'), '491231235959Z')
+        self.assertEqual(self.engine_module.index_time('20500101000000Z'), '20500101000000Z')
 
 ##-----------------------------------------##
 ## Helper function testcases
@@ -221,6 +432,15 @@ class HelperTestCase(TestCase):
         
         self.obj = CertificateAuthority.objects.get(pk=1)
     
+    def test_media_path(self):
+        self.assertEqual(media_path('http://static.company.com/js/jquery.js'), 'http://static.company.com/js/jquery.js')
+        self.assertEqual(media_path('/js/jquery.js'), '/js/jquery.js')
+        self.assertEqual(media_path('pki/js/jquery.js'), settings.MEDIA_URL + 'pki/js/jquery.js')
+    
+    def test_chunks(self):
+        self.assertEqual(chunks(range(5), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual(chunks([]), [])
+    
     def test_files_for_object(self):
         f = files_for_object(self.obj)
         for i in ('chain', 'crl', 'pem', 'csr', 'der', 'pkcs12', 'key'):
@@ -356,8 +576,22 @@ class CertificateAuthorityTestCase(TestCase):
     def test_ParseRawCertificate(self):
         self.assertTrue(re.search('X509v3 Basic Constraints: critical\s*\n\s*CA:TRUE', self.rca_openssl.dump_certificate()))
         self.assertTrue(re.search('X509v3 Basic Constraints: critical\s*\n\s*CA:TRUE, pathlen:0', self.eca_openssl.dump_certificate()))
+    
+    def test_CertificateInfo(self):
+        info = self.eca_openssl.certificate_info()
+        self.assertTrue(info is self.eca_openssl.certificate_info())
+        self.assertEqual(info.serial, self.eca.serial)
+        self.assertEqual(info.extensions['basicConstraints'], (True, 'CA:TRUE, pathlen:0'))
+        self.assertTrue(info.not_after > info.not_before)
+        self.assertTrue(info.subject.find('/CN=Edge CA') != -1)
+    
+    def test_CachedCertificateDump(self):
+        dump = self.rca_openssl.cached_dump_certificate()
+        self.assertEqual(cache.get(openssl.dump_cache_key(self.rca_openssl.crt))[1], dump)
+        openssl.forget_certificate(self.rca_openssl.crt)
+        self.assertEqual(cache.get(openssl.dump_cache_key(self.rca_openssl.crt)), None)
 
-class CertificateTestCase(TestCase):
+class CertificateTestCase(PkiTestCase):
     """Edge certificate testcases"""
     
     fixtures = ["eku_and_ku.json"]
@@ -419,6 +653,59 @@ class CertificateTestCase(TestCase):
         self.assertFalse(Certificate.objects.get(pk=self.srv.pk).active)
         self.assertFalse(Certificate.objects.get(pk=self.usr.pk).active)
     
+    def test_RevokeSubtree(self):
+        self.ica.action = "revoke"
+        self.ica.parent_passphrase = "1234567890"
+        self.ica.save()
+        self.assertFalse(Certificate.objects.filter(parent=self.eca, active=True).count())
+        self.assertFalse(Certificate.objects.filter(parent=self.eca, revoked=None).count())
+        self.assertTrue(CertificateAuthority.objects.get(pk=self.rca.pk).active)
+        self.assertEqual(PkiChangelog.objects.filter(action='broken').count(), 3)
+    
+    def test_RevokeSubtreeQueries(self):
+        count = PkiChangelog.objects.count()
+        queries = self.count_queries(self.rca.revoke_subtree, user=None, action='revoke')[0]
+        
+        ## 2 id lookups + 2 updates + 1 changelog insert (+ ContentType lookups), independent of the subtree size
+        self.assertTrue(queries <= 5 + 2, queries)
+        self.assertEqual(PkiChangelog.objects.count(), count + 4)
+        self.assertEqual(PkiChangelog.objects.filter(action='broken', model_id=models.changelog_model_id(Certificate)).count(), 2)
+        self.assertFalse(CertificateAuthority.objects.filter(parent__isnull=False, active=True).count())
+    
+    def test_ChangelogWriter(self):
+        count = PkiChangelog.objects.count()
+        writer = ChangelogWriter()
+        writer.open()
+        try:
+            self.srv.action = "update"
+            self.srv.description = "changed"
+            self.srv.save()
+            self.assertEqual(PkiChangelog.objects.count(), count)
+        finally:
+            writer.close()
+        self.assertEqual(PkiChangelog.objects.count(), count + 1)
+        self.assertEqual(models.current_changelog_writer(), None)
+    
+    def test_ChangelogMiddleware(self):
+        from pki.middleware import PkiChangelogMiddleware
+        
+        count = PkiChangelog.objects.count()
+        middleware = PkiChangelogMiddleware()
+        request = HttpRequest()
+        
+        ## Writer of a request that never got a response
+        ChangelogWriter().open()
+        middleware.process_request(request)
+        self.assertEqual(models._changelog_state.writers, [request.pki_changelog_writer])
+        
+        self.srv.action = "update"
+        self.srv.description = "changed"
+        self.srv.save()
+        middleware.process_exception(request, Exception())
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(PkiChangelog.objects.count(), count)
+        self.assertEqual(models.current_changelog_writer(), None)
+    
     def test_RevokeEdgeCertificate(self):
         self.srv.action = "revoke"
         self.srv.parent_passphrase = "1234567890"
@@ -426,6 +713,96 @@ class CertificateTestCase(TestCase):
         self.assertFalse(Certificate.objects.get(pk=self.srv.pk).active)
         self.assertTrue(self.srv_openssl.get_revoke_status_from_cert())
     
+    def test_HierarchyVersion(self):
+        version = models.hierarchy_version(self.srv)
+        self.assertEqual(models.hierarchy_version(self.rca), version)
+        self.ica.revoke_subtree(user=None, action='revoke')
+        self.assertNotEqual(models.hierarchy_version(self.srv), version)
+        version = models.hierarchy_version(self.eca)
+        self.usr.delete(passphrase="1234567890")
+        self.assertNotEqual(models.hierarchy_version(self.rca), version)
+    
+    def test_LeafCounts(self):
+        self.usr.action = "revoke"
+        self.usr.parent_passphrase = "1234567890"
+        self.usr.save()
+        self.assertEqual(graphviz.leaf_counts([self.rca.pk, self.ica.pk, self.eca.pk]), {self.eca.pk: [1, 1]})
+    
+    def test_HierarchyPage(self):
+        page = hierarchy.hierarchy_page(self.rca)
+        self.assertEqual([(n['type'], n['id'], n['children']) for n in page['nodes']], [('ca', self.ica.pk, 1)])
+        page = hierarchy.hierarchy_page(self.eca, page=2, page_size=1)
+        self.assertEqual((page['count'], page['pages'], len(page['nodes'])), (2, 2, 1))
+        self.assertEqual(page['nodes'][0]['type'], 'certificate')
+        self.assertRaises(ValueError, hierarchy.hierarchy_page, self.eca, 3, 1)
+    
+    def test_EmailQueue(self):
+        item = pki_email.SendCertificateData(self.srv, None)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(pki_email.deliver_queued_emails(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.srv.email])
+        self.assertEqual(PkiEmail.objects.get(pk=item.pk).status, 'sent')
+        ## Sent to the recipient of the queued email
+        PkiEmail.objects.create(model_id=models.changelog_model_id(self.srv), object_id=self.srv.pk, recipient='c@d.com')
+        self.assertEqual(pki_email.deliver_queued_emails(), 1)
+        self.assertEqual(mail.outbox[-1].to, ['c@d.com'])
+        self.usr.action = "revoke"
+        self.usr.parent_passphrase = "1234567890"
+        self.usr.save()
+        item = pki_email.SendCertificateData(self.usr, None)
+        self.assertEqual(pki_email.deliver_queued_emails(), 0)
+        item = PkiEmail.objects.get(pk=item.pk)
+        self.assertEqual((item.status, item.attempts), ('failed', 1))
+        self.assertEqual(pki_email.deliver_queued_emails(), 0)
+        self.assertEqual(PkiEmail.objects.get(pk=item.pk).attempts, 1)
+    
+    def test_EmailClaim(self):
+        item = pki_email.SendCertificateData(self.srv, None)
+        ## Claimed by another worker
+        self.assertTrue(pki_email.claim_email(PkiEmail.objects.get(pk=item.pk)))
+        self.assertFalse(pki_email.claim_email(item))
+        self.assertEqual(pki_email.deliver_queued_emails(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(PkiEmail.objects.get(pk=item.pk).status, 'sending')
+        ## The worker holding it died, the lease expires
+        PkiEmail.objects.filter(pk=item.pk).update(next_attempt=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(pki_email.deliver_queued_emails(), 1)
+        self.assertEqual(PkiEmail.objects.get(pk=item.pk).status, 'sent')
+    
+    def test_BulkEmail(self):
+        objs = pki_email.subtree_objects([self.ica, self.eca])
+        self.assertEqual(len(objs), 4)
+        queries, queued = self.count_queries(pki_email.queue_certificate_emails, objs)
+        self.assertEqual(queued, (4, 0))
+        ## One insert (+ ContentType lookups), independent of the number of objects
+        self.assertTrue(queries <= 1 + 2, queries)
+        self.assertEqual(PkiEmail.objects.filter(status='queued').count(), 4)
+        queries, sent = self.count_queries(pki_email.deliver_queued_emails)
+        self.assertEqual(sent, 4)
+        ## Queued emails, ContentTypes, objects of both models, one claim and one save per email. Zips are built without queries
+        self.assertTrue(queries <= 1 + 2 + 2 + 4 * 3)
+        self.assertEqual(sorted([m.attachments[0][0] for m in mail.outbox])[0], 'PKI_DATA_Edge_CA.zip')
+    
+    def test_CRLBatch(self):
+        crl = open(self.srv_openssl.crl).read()
+        batch = openssl.CRLBatch()
+        batch.open()
+        try:
+            for cert in (self.srv, self.usr):
+                cert.action = "revoke"
+                cert.parent_passphrase = "1234567890"
+                cert.save()
+            self.assertEqual(open(self.srv_openssl.crl).read(), crl)
+            self.assertEqual(openssl.dirty_crls(), ['Edge_CA'])
+        finally:
+            batch.close()
+        self.assertNotEqual(open(self.srv_openssl.crl).read(), crl)
+        self.assertEqual(openssl.dirty_crls(), [])
+        openssl.mark_crl_dirty('Edge_CA')
+        openssl.update_crl(openssl.Openssl(self.eca), 'Edge_CA', '1234567890', force=True)
+        self.assertEqual(openssl.dirty_crls(), [])
+    
     def test_RemoveEdgeCertificate(self):
         self.srv.delete(passphrase="1234567890")
         self.assertFalse(os.path.exists(self.srv_openssl.key))
@@ -467,7 +844,122 @@ class CertificateTestCase(TestCase):
         self.assertTrue(re.search('X509v3 Basic Constraints: critical\s*\n\s*CA:FALSE', c))
         self.assertTrue(re.search('X509v3 Subject Alternative Name:\s*\n\s*IP Address:1.2.3.4, DNS:www1.company.com', c))
         self.assertTrue(re.search('X509v3 Extended Key Usage: critical\s*\n\s*TLS Web Server Authentication', c))
+    
+    def test_CATree(self):
+        def delete_list():
+            tree = CATree(self.ica.pk)
+            store, id_dict = [], { 'cert': [], 'ca': [], }
+            chain_recursion(self.ica.pk, store, id_dict, tree)
+            return tree, id_dict
+        queries, (tree, id_dict) = self.count_queries(delete_list)
+        ## Path of the root, CA's and certificates of the subtree
+        self.assertEqual(queries, 3)
+        self.assertEqual(sorted(tree.cas.keys()), [self.ica.pk, self.eca.pk])
+        self.assertEqual([c.pk for c in tree.walk()], [self.ica.pk, self.eca.pk])
+        self.assertEqual(id_dict['ca'], [self.ica.pk, self.eca.pk])
+        self.assertEqual(sorted(id_dict['cert']), [self.srv.pk, self.usr.pk])
+    
+    def test_MaterializedPath(self):
+        self.assertEqual(self.rca.path, '/%d/' % self.rca.pk)
+        self.assertEqual(self.eca.path, '/%d/%d/%d/' % (self.rca.pk, self.ica.pk, self.eca.pk))
+        self.assertEqual([c.pk for c in self.eca.ancestors()], [self.rca.pk, self.ica.pk])
+        self.assertEqual(sorted(self.rca.descendants().values_list('pk', flat=True)), [self.ica.pk, self.eca.pk])
+        self.assertEqual(self.eca.ca_chain, 'Root CA&nbsp;&rarr;&nbsp;Intermediate CA&nbsp;&rarr;&nbsp;Edge CA')
+        queries, tree = self.count_queries(CATree, self.ica)
+        self.assertEqual(queries, 2)
+        self.assertEqual(sorted(tree.cas.keys()), [self.ica.pk, self.eca.pk])
+    
+    def test_ChangelistQuerySet(self):
+        certs = Certificate.objects.for_changelist().filter(active=True).order_by('expiry_date')
+        queries, names = self.count_queries(lambda: [(c.parent.common_name, c.extension.name) for c in certs])
+        self.assertEqual(queries, 1)
+        self.assertEqual(len(names), 2)
+    
+    def test_ExpiryScan(self):
+        queries, report = self.count_queries(expiry.scan_expiry, buckets=[30, 400])
+        self.assertEqual(queries, 2)
+        self.assertEqual(report.counts, {'expired': 0, '0-30': 0, '31-400': 4})
+        self.assertEqual(sorted([(e['type'], e['id']) for e in report.entries]),
+                         [('ca', self.ica.pk), ('ca', self.eca.pk), ('certificate', self.srv.pk), ('certificate', self.usr.pk)])
+        report = expiry.scan_expiry(buckets=[30, 400], today=datetime.date.today() + datetime.timedelta(340))
+        self.assertEqual(report.counts['0-30'], 4)
+        f = StringIO()
+        expiry.write_csv(report, f)
+        self.assertEqual(len(f.getvalue().splitlines()), 5)
+    
+    def test_BulkRenewal(self):
+        certs = list(renewal.expiring_certificates(400))
+        self.assertEqual([c.pk for c in certs], [self.srv.pk, self.usr.pk])
+        journal = os.path.join(PKI_DIR, 'renewal.journal')
+        try:
+            result = renewal.renew_certificates(certs, {'Edge_CA': '1234567890'}, valid_days=800, journal=journal)
+            self.assertEqual((len(result.renewed), len(result.failed)), (2, 0))
+            self.assertEqual(renewal.expiring_certificates(400).count(), 0)
+            self.assertEqual(Certificate.objects.get(pk=self.srv.pk).valid_days, 800)
+            self.assertFalse(openssl.Openssl(Certificate.objects.get(pk=self.srv.pk)).get_revoke_status_from_cert())
+            result = renewal.renew_certificates(certs, {'Edge_CA': '1234567890'}, journal=journal)
+            self.assertEqual(len(result.skipped), 2)
+        finally:
+            os.remove(journal)
+    
+    def test_SubtreeArchive(self):
+        cas, certs = subtree_for_ca(self.rca)
+        self.assertEqual([c.pk for c in cas], [self.rca.pk, self.ica.pk, self.eca.pk])
+        self.assertEqual(len(certs), 2)
+        archive = build_archive_for_subtree(self.ica, 'zip')
+        names = zipfile.ZipFile(archive).namelist()
+        archive.close()
+        self.assertTrue('PKI_EXPORT_Intermediate_CA/Edge_CA/certs/Server_Edge_Certificate.cert.pem' in names)
+        self.assertTrue('PKI_EXPORT_Intermediate_CA/Intermediate_CA/Intermediate_CA.crl.pem' in names)
+        self.assertFalse([n for n in names if n.endswith('.key.pem')])
 
+class BulkIssuanceTestCase(TestCase):
+    """Bulk certificate issuance testcases"""
+    
+    fixtures = ["eku_and_ku.json"]
+    
+    def setUp(self):
+        
+        CreateCaChain()
+        
+        self.eca = CertificateAuthority.objects.get(pk=3)
+        openssl.refresh_pki_metadata(CertificateAuthority.objects.all())
+        
+        self.manifest = os.path.join(PKI_DIR, 'manifest.csv')
+        f = open(self.manifest, 'w')
+        f.write("common_name,email,subjaltname\n")
+        f.write("device1.company.com,a@b.com,DNS:device1.company.com\n")
+        f.write("device2.company.com,,\n")
+        f.write(",a@b.com,\n")
+        f.close()
+    
+    def tearDown(self):
+        CertificateAuthority.objects.all().delete()
+        Certificate.objects.all().delete()
+        os.remove(self.manifest)
+    
+    def test_LoadManifest(self):
+        items = issuance.load_manifest(self.manifest)
+        self.assertEqual(len(items), 3)
+        self.assertEqual(items[0]['common_name'], 'device1.company.com')
+    
+    def test_IssueCertificates(self):
+        items  = issuance.load_manifest(self.manifest)
+        result = issuance.issue_certificates(self.eca, '1234567890', items, extension=x509Extension.objects.get(pk=3), \
+                                             defaults={'valid_days': 365, 'key_length': 1024})
+        self.assertEqual(len(result.issued), 2)
+        self.assertEqual(result.failed[0][0], 3)
+        
+        cert = Certificate.objects.get(name='device1_company_com')
+        self.assertTrue(cert.active)
+        self.assertEqual(cert.parent, self.eca)
+        self.assertEqual(cert.country, self.eca.country)
+        self.assertTrue(os.path.exists(openssl.Openssl(cert).crt))
+        self.assertEqual(PkiChangelog.objects.filter(model_id=ContentType.objects.get_for_model(cert).pk).count(), 2)
+    
+    def test_IssueCertificatesWrongPassphrase(self):
+        self.assertRaises(Exception, issuance.issue_certificates, self.eca, 'wrong', [], extension=x509Extension.objects.get(pk=3))
+    
 class x509ExtensionTestCase(TestCase):
     
     fixtures = ["eku_and_ku.json"]
@@ -497,7 +989,7 @@ class EmailDeliveryTestCase(unittest.TestCase):
 ## HTTP testcases
 ##-----------------------------------------##
 
-class HttpClientTestCase(TestCase):
+class HttpClientTestCase(PkiTestCase):
     
     fixtures = ["test_users.json", "eku_and_ku.json"]
     
@@ -617,6 +1109,51 @@ class HttpClientTestCase(TestCase):
         self.failUnlessEqual(r.status_code, 200)
         self.assertEqual(r['Content-Type'], 'application/force-download')
     
+    def test_ExportCertificateAuthority(self):
+        r = self.c.get('/pki/export/1/tgz/')
+        self.failUnlessEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Type'], 'application/x-gzip')
+        self.assertEqual(len(r.content), int(r['Content-Length']))
+    
+    def test_ChangelistQueries(self):
+        def changelist_queries(url):
+            queries, r = self.count_queries(self.c.get, url)
+            self.failUnlessEqual(r.status_code, 200)
+            return queries
+        queries = changelist_queries('/admin/pki/certificate/')
+        ca_queries = changelist_queries('/admin/pki/certificateauthority/')
+        for i in range(5):
+            cert = Certificate.objects.get(pk=1)
+            cert.pk, cert.name, cert.common_name = None, 'copy_%d' % i, 'Copy %d' % i
+            super(Certificate, cert).save()
+        self.assertEqual(changelist_queries('/admin/pki/certificate/'), queries)
+        self.assertEqual(changelist_queries('/admin/pki/certificateauthority/'), ca_queries)
+        self.assertEqual(url_for_id('pki:download', 7, {'model': 'certificate'}),
+                         urlresolvers.reverse('pki:download', kwargs={'model': 'certificate', 'id': 7}))
+    
+    def test_ChangelogHistory(self):
+        def history_queries():
+            queries, r = self.count_queries(self.c.get, '/admin/pki/certificateauthority/1/history/')
+            self.failUnlessEqual(r.status_code, 200)
+            return queries
+        queries = history_queries()
+        writer = ChangelogWriter()
+        writer.add_many(CertificateAuthority, [1] * 10, User.objects.get(username="admin"), 'update', 'unit test')
+        writer.flush()
+        self.assertEqual(history_queries(), queries)
+    
+    def test_HierarchyApi(self):
+        r = self.c.get(urlresolvers.reverse('pki:hierarchy_root'))
+        self.failUnlessEqual(r.status_code, 200)
+        data = simplejson.loads(r.content)
+        self.assertEqual([(n['name'], n['children']) for n in data['nodes']], [('Root_CA', 1)])
+        r = self.c.get(urlresolvers.reverse('pki:hierarchy', kwargs={'id': 3}))
+        self.assertEqual([n['name'] for n in simplejson.loads(r.content)['nodes']], ['Server_cert'])
+        r = self.c.get(urlresolvers.reverse('pki:hierarchy', kwargs={'id': 3}), {'page': 2})
+        self.failUnlessEqual(r.status_code, 400)
+        r = self.c.get(urlresolvers.reverse('pki:browse', kwargs={'id': 1}))
+        self.assertContains(r, urlresolvers.reverse('pki:hierarchy', kwargs={'id': 1}))
+    
     def test_DownloadCertificate(self):
         self.c.logout()
         ct = model_id=ContentType.objects.get(model='certificate')
@@ -633,3 +1170,5 @@ class HttpClientTestCase(TestCase):
         r = self.c.get('/pki/download/certificate/1/', follow=True)
         self.failUnlessEqual(r.status_code, 200)
         self.assertEqual(r['Content-Type'], 'application/force-download')
+        self.assertEqual(r.content[:2], 'PK')
+        self.assertEqual(len(r.content), int(r['Content-Length']))
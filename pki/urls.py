@@ -3,8 +3,13 @@ from pki.views import *
 
 urlpatterns = patterns('',
     url(r'^pki/download/(?P<model>certificate|certificateauthority)/(?P<id>\d+)/$', pki_download, name="download"),
+    url(r'^pki/export/(?P<id>\d+)/(?P<format>zip|tgz)/$', pki_export, name="export"),
     url(r'^pki/chain/(?P<model>certificate|certificateauthority)/(?P<id>\d+)/$', pki_chain, name="chain"),
     url(r'^pki/tree/(?P<id>\d+)/$', pki_tree, name="tree"),
+    url(r'^pki/hierarchy/$', pki_hierarchy, name="hierarchy_root"),
+    url(r'^pki/hierarchy/(?P<id>\d+)/$', pki_hierarchy, name="hierarchy"),
+    url(r'^pki/browse/$', pki_browse, name="browse_root"),
+    url(r'^pki/browse/(?P<id>\d+)/$', pki_browse, name="browse"),
     url(r'^pki/email/(?P<model>certificate|certificateauthority)/(?P<id>\d+)/$', pki_email, name="email"),
     url(r'^pki/refresh_metadata/$', pki_refresh_metadata, name="refresh_metadata"),
 )
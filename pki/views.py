@@ -1,20 +1,23 @@
-import os
 import logging
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponse, Http404, HttpResponseRedirect, HttpResponseBadRequest
+from django.http import HttpResponse, Http404, HttpResponseRedirect, HttpResponseBadRequest, HttpResponseNotModified
 from django.utils.safestring import mark_safe
 from django.template import RequestContext
 from django.core import urlresolvers
+from django.core.servers.basehttp import FileWrapper
+from django.utils import simplejson
 
-from pki.settings import PKI_LOG, MEDIA_URL, PKI_ENABLE_GRAPHVIZ, PKI_ENABLE_EMAIL
+from pki.settings import PKI_LOG, MEDIA_URL, PKI_ENABLE_GRAPHVIZ, PKI_ENABLE_EMAIL, JQUERY_URL, PKI_SHARED_CACHE
 from pki.models import CertificateAuthority, Certificate
 from pki.forms import DeleteForm
-from pki.graphviz import ObjectChain, ObjectTree
+from pki.graphviz import graph_cache_key, graph_etag, render_graph, GRAPH_FORMATS
 from pki.email import SendCertificateData
-from pki.helper import files_for_object, chain_recursion, build_delete_item, generate_temp_file, build_zip_for_object
+from pki.helper import files_for_object, chain_recursion, CATree, build_delete_item, build_zip_for_object, file_size, \
+                       build_archive_for_subtree, ARCHIVE_FORMATS, url_for_id, url_for_name, media_path
+from pki.hierarchy import hierarchy_page
 from pki.openssl import refresh_pki_metadata
 
 logger = logging.getLogger("pki")
@@ -47,20 +50,34 @@ def pki_download(request, model, id):
     
     zip = build_zip_for_object(c, request)
     
-    ## open and read the file if it exists
-    if os.path.exists(zip):
-        f = open(zip)
-        x = f.readlines()
-        f.close()
-        
-        ## return the HTTP response
-        response = HttpResponse(x, mimetype='application/force-download')
-        response['Content-Disposition'] = 'attachment; filename="PKI_DATA_%s.zip"' % c.name
-        
-        return response
-    else:
-        logger.error( "File not found: %s" % zip )
-        raise Http404
+    ## Stream the zip. The spooled file is closed (and released) by the handler when the response is finished
+    response = HttpResponse(FileWrapper(zip), mimetype='application/force-download')
+    response['Content-Disposition'] = 'attachment; filename="PKI_DATA_%s.zip"' % c.name
+    response['Content-Length'] = file_size(zip)
+    
+    return response
+
+@login_required
+def pki_export(request, id, format):
+    """Download the certificates, chains and CRLs of a CA and all its descendants.
+    
+    format is zip or tgz. Private keys are not exported.
+    """
+    
+    if not request.user.has_perm('pki.can_download'):
+        messages.error(request, "Permission denied!")
+        return HttpResponseRedirect(urlresolvers.reverse('admin:pki_certificateauthority_changelist'))
+    
+    ca = get_object_or_404(CertificateAuthority, pk=id)
+    mimetype, extension = ARCHIVE_FORMATS[format]
+    
+    archive = build_archive_for_subtree(ca, format)
+    
+    response = HttpResponse(FileWrapper(archive), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename="PKI_EXPORT_%s.%s"' % (ca.name, extension)
+    response['Content-Length'] = file_size(archive)
+    
+    return response
 
 ##------------------------------------------------------------------##
 ## Graphviz views
@@ -83,28 +100,15 @@ def pki_chain(request, model, id):
     elif model == "certificate":
         obj = get_object_or_404(Certificate, pk=id)
     
-    png = generate_temp_file()
-    ObjectChain(obj, png)
-    
-    try:
-        if os.path.exists(png):
-            f = open(png)
-            x = f.read()
-            f.close()
-            os.remove(png)
-    except OSError,e:
-        logger.error( "Failed to load depency tree: %s" % e)
-        raise Exception( e )
-    
-    response = HttpResponse(x, mimetype='image/png')
-    return response
+    return graph_response(request, 'chain', obj)
 
 @login_required
 def pki_tree(request, id):
-    """Display the CA tree as PNG.
+    """Display the CA tree as PNG (or SVG with ?format=svg).
     
     Requires PKI_ENABLE_GRAPHVIZ set to true. Only works for Certificate Authorities.
     All object related to the CA obj are fetched and displayed in a Graphviz tree.
+    Large edge CA's are collapsed (see PKI_GRAPHVIZ_LEAF_LIMIT).
     """
     
     if PKI_ENABLE_GRAPHVIZ is not True:
@@ -112,24 +116,81 @@ def pki_tree(request, id):
         return HttpResponseRedirect(urlresolvers.reverse('admin:pki_certificateauthority_changelist'))
     
     obj = get_object_or_404(CertificateAuthority, pk=id)
-    png = generate_temp_file()
     
-    ObjectTree(obj, png)
+    return graph_response(request, 'tree', obj)
+
+def graph_response(request, kind, obj):
+    """Return the cached kind (chain/tree) graph of obj or 304 if the client's copy is current.
+    
+    The image format (png or svg) is taken from the format GET parameter. Without a shared
+    cache (PKI_SHARED_CACHE) the graph is rendered on every request and sent without ETag.
+    """
+    
+    format = request.GET.get('format', 'png')
+    
+    if format not in GRAPH_FORMATS:
+        return HttpResponseBadRequest()
+    
+    key = etag = None
+    
+    if PKI_SHARED_CACHE:
+        key  = graph_cache_key(kind, obj, format)
+        etag = graph_etag(key)
+        
+        if etag in [e.strip() for e in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            return HttpResponseNotModified()
     
     try:
-        if os.path.exists(png):
-            f = open(png)
-            x = f.read()
-            f.close()
-            
-            os.remove(png)
-    except OSError,e:
+        data = render_graph(kind, obj, key, format)
+    except OSError, e:
         logger.error( "Failed to load depency tree: %s" % e)
         raise Exception( e )
     
-    response = HttpResponse(x, mimetype='image/png')
+    response = HttpResponse(data, mimetype=GRAPH_FORMATS[format])
+    
+    if etag:
+        response['ETag'] = etag
+    
     return response
 
+##------------------------------------------------------------------##
+## Hierarchy views
+##------------------------------------------------------------------##
+
+@login_required
+def pki_hierarchy(request, id=None):
+    """Return a page of the children of CA id (or the top-level objects) as JSON.
+    
+    The page number is taken from the page GET parameter (default: 1).
+    """
+    
+    ca = None
+    
+    if id is not None:
+        ca = get_object_or_404(CertificateAuthority, pk=id)
+    
+    try:
+        data = hierarchy_page(ca, int(request.GET.get('page', 1)))
+    except ValueError:
+        return HttpResponseBadRequest()
+    
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+@login_required
+def pki_browse(request, id=None):
+    """Display the hierarchy below CA id (or all CA's) rendered by the browser from the JSON API"""
+    
+    if id is not None:
+        obj   = get_object_or_404(CertificateAuthority, pk=id)
+        url   = url_for_id('pki:hierarchy', obj.pk, {})
+        title = "PKI tree of %s" % obj.common_name
+    else:
+        url   = url_for_name('pki:hierarchy_root')
+        title = "PKI tree"
+    
+    return render_to_response('admin/pki/hierarchy.html', { 'hierarchy_url': url, 'title': title, 'jquery_url': media_path(JQUERY_URL),
+                                                          }, RequestContext(request))
+
 ##------------------------------------------------------------------##
 ## Email views
 ##------------------------------------------------------------------##
@@ -139,7 +200,7 @@ def pki_email(request, model, id):
     """Send email with certificate data attached.
     
     Requires PKI_ENABLE_EMAIL set to true. Type (ca/cert) and ID are used to determine the object.
-    Build ZIP, send email and return to changelist.
+    Queue the email (sent by "manage.py pki_email") and return to changelist.
     """
     
     if PKI_ENABLE_EMAIL is not True:
@@ -156,7 +217,7 @@ def pki_email(request, model, id):
     else:
         raise Http404
     
-    messages.info(request, 'Email to "%s" was sent successfully.' % obj.email)
+    messages.info(request, 'Email to "%s" was queued for delivery.' % obj.email)
     return HttpResponseRedirect(urlresolvers.reverse('admin:pki_%s_changelist' % model))
 
 ##------------------------------------------------------------------##
@@ -185,14 +246,14 @@ def pki_refresh_metadata(request):
 def admin_history(request, model, id):
     """Overwrite the default admin history view"""
     
-    from django.contrib.contenttypes.models import ContentType
-    from pki.models import PkiChangelog
+    from django.db.models import get_model
+    from pki.models import PkiChangelog, changelog_model_id
     
-    ct  = ContentType.objects.get(model=model)
-    model_obj = ct.model_class()
+    model_obj = get_model('pki', model)
     obj = model_obj.objects.get(pk=id)
     
-    changelogs = PkiChangelog.objects.filter(model_id=ct.pk).filter(object_id=id)
+    ## Users are fetched with the changelogs instead of one query per row
+    changelogs = PkiChangelog.objects.filter(model_id=changelog_model_id(model_obj)).filter(object_id=id).select_related('user')
     
     return render_to_response('admin/pki/object_changelogs.html', { 'changelogs': changelogs, 'title': "Change history: %s" % obj.common_name,
                                                                     'app_label': model_obj._meta.app_label, 'object': obj,
@@ -210,7 +271,7 @@ def admin_delete(request, model, id):
     if model == 'certificateauthority':
         ## Get the list of objects to delete as list of lists
         item = get_object_or_404(CertificateAuthority, pk=id)
-        chain_recursion(item.id, deleted_objects, id_dict={ 'cert': [], 'ca': [], })
+        chain_recursion(item.id, deleted_objects, id_dict={ 'cert': [], 'ca': [], }, tree=CATree(item))
         
         ## Fill the required data for delete_confirmation.html template
         opts       = CertificateAuthority._meta